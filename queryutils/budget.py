@@ -0,0 +1,240 @@
+import json
+import os
+import signal
+
+from hashlib import md5
+from logging import getLogger as get_logger
+from time import time
+
+logger = get_logger("queryutils")
+
+MAX_SECONDS = 10.
+MAX_LENGTH = 20000 # bytes
+
+TOO_LONG = "too long"
+TIMEOUT = "timeout"
+RECURSION = "recursion"
+
+
+class ParseTimeout(BaseException):
+    """Raised when a query takes longer to parse than its budget allows.
+
+    This derives from BaseException rather than Exception so that it is
+    not caught, and turned into a syntax error, by the splparser rules
+    that catch any Exception raised while parsing a stage.
+    """
+    pass
+
+
+class ParseBudget(object):
+    """A limit on the time and size of each query parsed, and a quarantine for those over it.
+
+    Queries longer than `max_length` bytes are not parsed at all, and
+    parsing a query is stopped once it has taken `seconds` of wall-clock
+    time, or once it exceeds the recursion limit. Such queries are added to
+    the quarantine, if there is one, and not parsed again in later runs.
+
+    The time limit is enforced with SIGALRM, so it only applies on
+    platforms that have it and when parsing in the main thread.
+    """
+
+    def __init__(self, seconds=MAX_SECONDS, max_length=MAX_LENGTH, quarantine=None):
+        """Create a ParseBudget.
+
+        :param self: The object being created
+        :type self: queryutils.budget.ParseBudget
+        :param seconds: The wall-clock time allowed to parse each query, or None for no limit
+        :type seconds: float
+        :param max_length: The length in bytes of the longest query to parse, or None for no limit
+        :type max_length: int
+        :param quarantine: The quarantine to record the queries over the budget in, if any
+        :type quarantine: queryutils.budget.Quarantine
+        :rtype: queryutils.budget.ParseBudget
+        """
+        self.seconds = seconds
+        self.max_length = max_length
+        self.quarantine = quarantine
+
+    def parse(self, text, parse):
+        """Parse the given query text with the given function, within the budget.
+
+        Return the result of the function and None, or, if the query is over
+        the budget or already quarantined, None and the reason. Any other
+        exception raised by the function is raised as usual.
+
+        :param self: The current object
+        :type self: queryutils.budget.ParseBudget
+        :param text: The UTF-8 encoded query text
+        :type text: str
+        :param parse: The function to parse the text with
+        :type parse: function
+        :rtype: tuple
+        """
+        if self.quarantine is not None:
+            reason = self.quarantine.reason(text)
+            if reason is not None:
+                return (None, "quarantined (%s)" % reason)
+        if self.max_length is not None and len(text) > self.max_length:
+            self.offend(text, TOO_LONG, 0.)
+            return (None, TOO_LONG)
+        start = time()
+        try:
+            with Timer(self.seconds):
+                return (parse(text), None)
+        except ParseTimeout:
+            reason = TIMEOUT
+        except RuntimeError as e:
+            if "maximum recursion depth" not in str(e):
+                raise
+            reason = RECURSION
+        except Exception as e:
+            # splparser wraps the errors raised while parsing a stage.
+            if "maximum recursion depth" not in str(e.args):
+                raise
+            reason = RECURSION
+        self.offend(text, reason, time() - start)
+        return (None, reason)
+
+    def offend(self, text, reason, seconds):
+        """Log that the given query is over the budget, and quarantine it.
+
+        :param self: The current object
+        :type self: queryutils.budget.ParseBudget
+        :param text: The UTF-8 encoded query text
+        :type text: str
+        :param reason: Why the query is over the budget
+        :type reason: str
+        :param seconds: How long the query was parsed for
+        :type seconds: float
+        :rtype: None
+        """
+        logger.warning("Query over parse budget (%s after %.3fs, %d bytes): %s" %
+            (reason, seconds, len(text), abbreviate(text)))
+        if self.quarantine is not None:
+            self.quarantine.add(text, reason, seconds)
+
+
+class Timer(object):
+    """A context manager that raises ParseTimeout if its block runs for too long.
+    """
+
+    def __init__(self, seconds):
+        """Create a Timer.
+
+        :param self: The object being created
+        :type self: queryutils.budget.Timer
+        :param seconds: The wall-clock time the block may run for, or None for no limit
+        :type seconds: float
+        :rtype: queryutils.budget.Timer
+        """
+        self.seconds = seconds
+        self.handler = None
+
+    def __enter__(self):
+        if self.seconds is None or not hasattr(signal, "setitimer"):
+            return self
+        try:
+            self.handler = signal.signal(signal.SIGALRM, _raise_timeout)
+        except ValueError: # not in the main thread
+            return self
+        signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.handler is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self.handler)
+            self.handler = None
+        return False
+
+
+def _raise_timeout(signum, frame):
+    raise ParseTimeout()
+
+
+class Quarantine(object):
+    """A record of the queries that were over the parse budget, so later runs can skip them.
+
+    The record is a file with one JSON object per line, with the MD5 hash
+    of the query text, the reason it was quarantined, how long it was
+    parsed for, its length and the start of its text. Lines are appended as
+    queries are quarantined, so the file can be shared by processes.
+    """
+
+    def __init__(self, path):
+        """Create a Quarantine, loading the queries in the given file if it exists.
+
+        :param self: The object being created
+        :type self: queryutils.budget.Quarantine
+        :param path: The path to the quarantine file
+        :type path: str
+        :rtype: queryutils.budget.Quarantine
+        """
+        self.path = path
+        self.reasons = {}
+        if os.path.isfile(path):
+            with open(path) as quarantinefile:
+                for line in quarantinefile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError: # a line cut short by an interrupted run
+                        continue
+                    self.reasons[record["key"]] = record["reason"]
+
+    def reason(self, text):
+        """Return why the given query is quarantined, or None if it is not.
+
+        :param self: The current object
+        :type self: queryutils.budget.Quarantine
+        :param text: The UTF-8 encoded query text
+        :type text: str
+        :rtype: str
+        """
+        return self.reasons.get(quarantine_key(text), None)
+
+    def add(self, text, reason, seconds):
+        """Quarantine the given query.
+
+        :param self: The current object
+        :type self: queryutils.budget.Quarantine
+        :param text: The UTF-8 encoded query text
+        :type text: str
+        :param reason: Why the query is quarantined
+        :type reason: str
+        :param seconds: How long the query was parsed for
+        :type seconds: float
+        :rtype: None
+        """
+        key = quarantine_key(text)
+        self.reasons[key] = reason
+        record = {
+            "key": key,
+            "reason": reason,
+            "seconds": round(seconds, 3),
+            "length": len(text),
+            "text": abbreviate(text).decode("utf8", "replace"),
+        }
+        with open(self.path, "a") as quarantinefile:
+            quarantinefile.write(json.dumps(record) + "\n")
+
+
+def quarantine_key(text):
+    """Return the key of the given query text in a quarantine.
+
+    :param text: The UTF-8 encoded query text
+    :type text: str
+    :rtype: str
+    """
+    return md5(text).hexdigest()
+
+def abbreviate(text, length=200):
+    """Return the start of the given text on one line, for logging.
+
+    :param text: The text
+    :type text: str
+    :param length: The number of characters to keep
+    :type length: int
+    :rtype: str
+    """
+    shortened = " ".join(text[:length].split())
+    return shortened + "..." if len(text) > length else shortened
@@ -0,0 +1,389 @@
+import json
+import numpy
+import os
+import struct
+
+from collections import OrderedDict
+from hashlib import md5
+from logging import getLogger as get_logger
+from queryutils.parallel import merge_users
+from queryutils.query import Query
+from queryutils.user import User
+from tempfile import mkstemp
+
+logger = get_logger("queryutils")
+
+CACHE_FORMAT = 1
+CACHE_SUFFIX = ".qucache"
+MAGIC = "QUCACHE\n"
+ALIGNMENT = 8
+NONE = -1
+
+# The float attributes of each query, stored as NaN when they are None.
+FLOAT_ATTRIBUTES = ["time", "execution_time", "earliest_event", "latest_event", "range"]
+
+# The string attributes of each query, stored as indices into the string table.
+STRING_ATTRIBUTES = ["text", "search_type", "splunk_search_id", "saved_search_name"]
+
+# The bits of each query's flags.
+IS_INTERACTIVE = 1
+IS_REALTIME = 2
+IS_REALTIME_NONE = 4
+
+
+class Cache(object):
+    """A cache of the users and queries read from each of a source's files.
+
+    The first time a file is read, its users and queries are written to a
+    binary cache file, either next to it or in the given directory. The
+    cache holds a columnar array for each of the queries' numeric attributes
+    and flags, and a table of the strings (texts, users, and so on) that the
+    queries refer to by index. Later reads of the same file memory-map the
+    arrays instead of parsing the file again.
+
+    A cache file is only used if it was written for the same path, size,
+    modification time, and data version as the file being read; otherwise it
+    is replaced.
+    """
+
+    def __init__(self, version, directory=None):
+        """Create a Cache.
+
+        :param self: The object being created
+        :type self: queryutils.cache.Cache
+        :param version: The format the Splunk queries are in
+        :type version: str (one of the attributes of queryutils.Version)
+        :param directory: The directory in which to put the cache files, or None to put each next to its file
+        :type directory: str
+        :rtype: queryutils.cache.Cache
+        """
+        self.version = version
+        self.directory = directory
+
+    def cache_path(self, filename):
+        """Return the path of the cache file for the given file.
+
+        :param self: The current object
+        :type self: queryutils.cache.Cache
+        :param filename: The path to the data file
+        :type filename: str
+        :rtype: str
+        """
+        if self.directory is None:
+            return filename + CACHE_SUFFIX
+        name = md5(os.path.abspath(filename)).hexdigest()
+        return os.path.join(self.directory, name + CACHE_SUFFIX)
+
+    def fingerprint(self, filename):
+        """Return the key identifying the current contents of the given file.
+
+        :param self: The current object
+        :type self: queryutils.cache.Cache
+        :param filename: The path to the data file
+        :type filename: str
+        :rtype: dict
+        """
+        stat = os.stat(filename)
+        return {
+            "format": CACHE_FORMAT,
+            "path": os.path.abspath(filename),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "version": self.version,
+        }
+
+    def get_users_from_file(self, module, filename, users, fields=None):
+        """Populate the users dictionary with the users in the given file, from its cache if possible.
+
+        If the file has no valid cache, it is read with the given module's
+        `get_users_from_file`, and, unless only some fields were read, the
+        cache is written. The users are merged into the users dictionary as
+        they would have been had the file been read into it directly.
+
+        :param self: The current object
+        :type self: queryutils.cache.Cache
+        :param module: The module to read the file with (jsonparser or csvparser)
+        :type module: module
+        :param filename: The path to the data file
+        :type filename: str
+        :param users: The user dict into which to place the users
+        :type users: dict
+        :param fields: The fields to read, if not all of them
+        :type fields: list
+        :rtype: None
+        """
+        fingerprint = self.fingerprint(filename)
+        file_users = self.load(filename, fingerprint)
+        if file_users is None:
+            if fields is not None:
+                module.get_users_from_file(filename, users, fields=fields)
+                return
+            file_users = OrderedDict()
+            module.get_users_from_file(filename, file_users)
+            self.store(filename, fingerprint, file_users)
+        merge_users(users, file_users)
+
+    def load(self, filename, fingerprint):
+        """Return the users cached for the given file, or None if it has no valid cache.
+
+        :param self: The current object
+        :type self: queryutils.cache.Cache
+        :param filename: The path to the data file
+        :type filename: str
+        :param fingerprint: The current fingerprint of the data file
+        :type fingerprint: dict
+        :rtype: collections.OrderedDict
+        """
+        path = self.cache_path(filename)
+        if not os.path.isfile(path):
+            return None
+        try:
+            (header, arrays) = read_cache_file(path)
+        except (IOError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable cache %s: %s" % (path, e))
+            return None
+        if header["fingerprint"] != fingerprint:
+            logger.debug("Ignoring stale cache " + path)
+            return None
+        logger.debug("Reading cache " + path)
+        return users_from_arrays(arrays)
+
+    def store(self, filename, fingerprint, users):
+        """Write the cache for the given file, logging rather than raising if it cannot be written.
+
+        :param self: The current object
+        :type self: queryutils.cache.Cache
+        :param filename: The path to the data file
+        :type filename: str
+        :param fingerprint: The fingerprint of the data file when it was read
+        :type fingerprint: dict
+        :param users: The users read from the data file
+        :type users: dict
+        :rtype: None
+        """
+        path = self.cache_path(filename)
+        try:
+            write_cache_file(path, {"fingerprint": fingerprint}, arrays_from_users(users))
+        except (IOError, OSError) as e:
+            logger.warning("Could not write cache %s: %s" % (path, e))
+            return
+        logger.debug("Wrote cache " + path)
+
+
+def arrays_from_users(users):
+    """Return the columnar arrays representing the given users and their queries.
+
+    :param users: The user dict, keyed as by the parsers
+    :type users: dict
+    :rtype: collections.OrderedDict
+    """
+    strings = StringTable()
+    user_keys, user_names, user_cases, nqueries = [], [], [], []
+    columns = dict((attribute, []) for attribute in FLOAT_ATTRIBUTES + STRING_ATTRIBUTES)
+    flags = []
+    for (key, user) in users.iteritems():
+        user_keys.append(strings.index(key))
+        user_names.append(strings.index(user.name))
+        user_cases.append(strings.index(user.case_id))
+        nqueries.append(len(user.queries))
+        for query in user.queries:
+            for attribute in FLOAT_ATTRIBUTES:
+                value = getattr(query, attribute)
+                columns[attribute].append(numpy.nan if value is None else value)
+            for attribute in STRING_ATTRIBUTES:
+                columns[attribute].append(strings.index(getattr(query, attribute)))
+            flags.append((IS_INTERACTIVE if query.is_interactive else 0) |
+                (IS_REALTIME if query.is_realtime else 0) |
+                (IS_REALTIME_NONE if query.is_realtime is None else 0))
+    arrays = OrderedDict()
+    arrays["user_keys"] = numpy.array(user_keys, dtype=numpy.int32)
+    arrays["user_names"] = numpy.array(user_names, dtype=numpy.int32)
+    arrays["user_cases"] = numpy.array(user_cases, dtype=numpy.int32)
+    arrays["user_nqueries"] = numpy.array(nqueries, dtype=numpy.int64)
+    for attribute in FLOAT_ATTRIBUTES:
+        arrays[attribute] = numpy.array(columns[attribute], dtype=numpy.float64)
+    for attribute in STRING_ATTRIBUTES:
+        arrays[attribute] = numpy.array(columns[attribute], dtype=numpy.int32)
+    arrays["flags"] = numpy.array(flags, dtype=numpy.uint8)
+    (arrays["string_offsets"], arrays["string_data"]) = strings.arrays()
+    return arrays
+
+def users_from_arrays(arrays):
+    """Return the users and queries represented by the given columnar arrays.
+
+    The query columns are copied out of the arrays one user's rows at a
+    time, and each string is decoded the first time a query refers to it,
+    so memory-mapped arrays are only read as the users are built.
+
+    :param arrays: The arrays, as returned by arrays_from_users
+    :type arrays: dict
+    :rtype: collections.OrderedDict
+    """
+    strings = StringReader(arrays["string_offsets"], arrays["string_data"])
+    users = OrderedDict()
+    start = 0
+    for (key, name, case, nqueries) in zip(arrays["user_keys"].tolist(), arrays["user_names"].tolist(),
+            arrays["user_cases"].tolist(), arrays["user_nqueries"].tolist()):
+        end = start + nqueries
+        columns = {}
+        for attribute in FLOAT_ATTRIBUTES:
+            columns[attribute] = [None if value != value else value for value in arrays[attribute][start:end].tolist()]
+        for attribute in STRING_ATTRIBUTES:
+            columns[attribute] = [strings[i] for i in arrays[attribute][start:end].tolist()]
+        flags = arrays["flags"][start:end].tolist()
+        user = User(strings[name])
+        user.case_id = strings[case]
+        for i in xrange(nqueries):
+            query = Query(columns["text"][i], columns["time"][i])
+            for attribute in FLOAT_ATTRIBUTES[1:] + STRING_ATTRIBUTES[1:]:
+                setattr(query, attribute, columns[attribute][i])
+            query.is_interactive = bool(flags[i] & IS_INTERACTIVE)
+            query.is_realtime = None if flags[i] & IS_REALTIME_NONE else bool(flags[i] & IS_REALTIME)
+            query.user = user
+            user.queries.append(query)
+        start = end
+        users[strings[key]] = user
+    return users
+
+def write_cache_file(path, header, arrays):
+    """Write the given header and arrays to a cache file, replacing it atomically.
+
+    The file starts with MAGIC, where the arrays start, and the length of a
+    JSON header recording the dtype, shape, and offset of each array. The
+    arrays follow the header, each aligned to ALIGNMENT bytes.
+
+    :param path: The path to the cache file
+    :type path: str
+    :param header: The header to write along with the layout of the arrays
+    :type header: dict
+    :param arrays: The arrays, by name
+    :type arrays: dict
+    :rtype: None
+    """
+    layout = OrderedDict()
+    offset = 0
+    for (name, values) in arrays.iteritems():
+        layout[name] = [values.dtype.str, len(values), offset]
+        offset += _aligned(values.nbytes)
+    header = dict(header, arrays=layout)
+    encoded = json.dumps(header)
+    start = _aligned(len(MAGIC) + 16 + len(encoded))
+
+    (fd, tmp) = mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=CACHE_SUFFIX)
+    try:
+        with os.fdopen(fd, "wb") as cachefile:
+            cachefile.write(MAGIC)
+            cachefile.write(struct.pack("<QQ", start, len(encoded)))
+            cachefile.write(encoded)
+            for (name, values) in arrays.iteritems():
+                cachefile.seek(start + layout[name][2])
+                cachefile.write(values.tostring())
+            cachefile.truncate(start + offset)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+def read_cache_file(path):
+    """Return the header of a cache file and its arrays, memory-mapped.
+
+    :param path: The path to the cache file
+    :type path: str
+    :rtype: tuple
+    """
+    with open(path, "rb") as cachefile:
+        if cachefile.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a cache file")
+        (start, length) = struct.unpack("<QQ", cachefile.read(16))
+        header = json.loads(cachefile.read(length))
+    arrays = {}
+    for (name, (dtype, length, offset)) in header["arrays"].iteritems():
+        if length == 0:
+            arrays[str(name)] = numpy.zeros(0, dtype=dtype)
+            continue
+        arrays[str(name)] = numpy.memmap(path, dtype=dtype, mode="r", offset=start + offset, shape=(length,))
+    return (header, arrays)
+
+def _aligned(nbytes):
+    return (nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class StringTable(object):
+    """Assigns each distinct string an index into a table of UTF-8 encoded strings.
+    """
+
+    def __init__(self):
+        """Create an empty StringTable.
+
+        :param self: The object being created
+        :type self: queryutils.cache.StringTable
+        :rtype: queryutils.cache.StringTable
+        """
+        self.indices = {}
+        self.strings = []
+
+    def index(self, string):
+        """Return the index of the given string, adding it to the table if it is new.
+
+        :param self: The current object
+        :type self: queryutils.cache.StringTable
+        :param string: The string, or None
+        :type string: unicode
+        :rtype: int
+        """
+        if string is None:
+            return NONE
+        idx = self.indices.get(string, None)
+        if idx is None:
+            idx = len(self.strings)
+            self.indices[string] = idx
+            self.strings.append(string)
+        return idx
+
+    def arrays(self):
+        """Return the offsets of the strings in the table and their concatenated data.
+
+        :param self: The current object
+        :type self: queryutils.cache.StringTable
+        :rtype: tuple
+        """
+        encoded = [unicode(string).encode("utf-8") for string in self.strings]
+        lengths = numpy.array([len(string) for string in encoded], dtype=numpy.int64)
+        offsets = numpy.concatenate([[0], numpy.cumsum(lengths)]).astype(numpy.int64)
+        data = numpy.frombuffer("".join(encoded), dtype=numpy.uint8)
+        return (offsets, data)
+
+
+class StringReader(object):
+    """Decodes the strings of a string table written by StringTable as they are looked up.
+    """
+
+    def __init__(self, offsets, data):
+        """Create a StringReader.
+
+        :param self: The object being created
+        :type self: queryutils.cache.StringReader
+        :param offsets: Where each string starts in the data, plus the total length
+        :type offsets: numpy.ndarray
+        :param data: The UTF-8 encoded strings, concatenated
+        :type data: numpy.ndarray
+        :rtype: queryutils.cache.StringReader
+        """
+        self.offsets = offsets
+        self.data = data
+        self.decoded = { NONE: None }
+
+    def __getitem__(self, idx):
+        """Return the string with the given index, or None for NONE.
+
+        :param self: The current object
+        :type self: queryutils.cache.StringReader
+        :param idx: The index of the string
+        :type idx: int
+        :rtype: unicode
+        """
+        string = self.decoded.get(idx, NONE)
+        if string is NONE:
+            (start, end) = self.offsets[idx:idx+2].tolist()
+            string = self.decoded[idx] = self.data[start:end].tostring().decode("utf-8")
+        return string
@@ -0,0 +1,115 @@
+import json
+import os
+
+from logging import getLogger as get_logger
+from tempfile import mkstemp
+
+logger = get_logger("queryutils")
+
+
+class Checkpoint(object):
+    """Records how far into each of a source's files queries have been read.
+
+    The checkpoint maps the absolute path of each file that has been read to
+    the byte offset up to which its rows have been read, so a later read can
+    start where the last one stopped. It is kept in a JSON file, which is
+    only rewritten when `save` is called, so that it can be saved once the
+    rows read have been stored.
+    """
+
+    def __init__(self, path):
+        """Create a Checkpoint, loading it from the given file if it exists.
+
+        :param self: The object being created
+        :type self: queryutils.checkpoint.Checkpoint
+        :param path: The path to the checkpoint file
+        :type path: str
+        :rtype: queryutils.checkpoint.Checkpoint
+        """
+        self.path = path
+        self.offsets = {}
+        if os.path.isfile(path):
+            with open(path) as checkpointfile:
+                self.offsets = json.load(checkpointfile)["offsets"]
+
+    def offset(self, filename):
+        """Return the offset up to which the given file has been read.
+
+        :param self: The current object
+        :type self: queryutils.checkpoint.Checkpoint
+        :param filename: The path to the data file
+        :type filename: str
+        :rtype: int
+        """
+        return self.offsets.get(os.path.abspath(filename), 0)
+
+    def set_offset(self, filename, offset):
+        """Record the offset up to which the given file has been read.
+
+        :param self: The current object
+        :type self: queryutils.checkpoint.Checkpoint
+        :param filename: The path to the data file
+        :type filename: str
+        :param offset: The offset
+        :type offset: int
+        :rtype: None
+        """
+        self.offsets[os.path.abspath(filename)] = offset
+
+    def processed_files(self):
+        """Return the paths to the files that have been read.
+
+        :param self: The current object
+        :type self: queryutils.checkpoint.Checkpoint
+        :rtype: list
+        """
+        return sorted(self.offsets.keys())
+
+    def save(self):
+        """Write the checkpoint to its file, replacing it atomically.
+
+        :param self: The current object
+        :type self: queryutils.checkpoint.Checkpoint
+        :rtype: None
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        (fd, tmp) = mkstemp(dir=directory, suffix=".checkpoint")
+        try:
+            with os.fdopen(fd, "w") as checkpointfile:
+                json.dump({"offsets": self.offsets}, checkpointfile, indent=1, sort_keys=True)
+            os.rename(tmp, self.path)
+        except:
+            os.remove(tmp)
+            raise
+        logger.debug("Saved checkpoint " + self.path)
+
+
+def get_new_users_from_files(module, filenames, users, checkpoint):
+    """Populate the users dictionary with the queries added to the given files since the checkpoint.
+
+    Each file is read from its offset in the checkpoint with the given
+    module's `get_new_users_from_file`, and its offset is advanced to where
+    that stopped. Files are read in order of their paths. A file that is
+    now shorter than its offset is assumed to have been replaced and is
+    read again from the start.
+
+    :param module: The module to read the files with (jsonparser or csvparser)
+    :type module: module
+    :param filenames: The paths to the files to read
+    :type filenames: list
+    :param users: The user dict into which to place the users
+    :type users: dict
+    :param checkpoint: The checkpoint to read from and advance
+    :type checkpoint: queryutils.checkpoint.Checkpoint
+    :rtype: None
+    """
+    for filename in sorted(filenames):
+        offset = checkpoint.offset(filename)
+        size = os.path.getsize(filename)
+        if size == offset:
+            continue
+        if size < offset:
+            logger.warning("%s is shorter than when it was last read; reading it from the start." % filename)
+            offset = 0
+        logger.debug("Reading %s from offset %d" % (filename, offset))
+        checkpoint.set_offset(filename, module.get_new_users_from_file(filename, users, offset=offset))
@@ -0,0 +1,172 @@
+import bz2
+import errno
+import gzip
+import os
+import signal
+import struct
+
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+from logging import getLogger as get_logger
+from subprocess import Popen, PIPE
+from threading import Thread
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+logger = get_logger("queryutils")
+
+BUFFER_SIZE = 1048576
+COMPRESSION_RATIO = 5. # A guess at the compression ratio when the file doesn't record its size.
+
+# The command that decompresses each kind of file to its standard output,
+# and the in-process decompressor to use when the command isn't installed.
+DECOMPRESSORS = {
+    ".gz": (["pigz", "gzip"], gzip.GzipFile),
+    ".bz2": (["lbzip2", "pbzip2", "bzip2"], bz2.BZ2File),
+    ".xz": (["xz"], lzma.LZMAFile if lzma is not None else None),
+}
+
+
+def compression_suffix(filename):
+    """Return the suffix of the given file if it names a supported compression format.
+
+    :param filename: The path to the file
+    :type filename: str
+    :rtype: str or None
+    """
+    (_, suffix) = os.path.splitext(filename)
+    if suffix in DECOMPRESSORS:
+        return suffix
+    return None
+
+def strip_compression_suffix(filename):
+    """Return the given file name without its compression suffix, if it has one.
+
+    :param filename: The path to the file
+    :type filename: str
+    :rtype: str
+    """
+    suffix = compression_suffix(filename)
+    if suffix is None:
+        return filename
+    return filename[:-len(suffix)]
+
+def has_suffix(filename, suffix):
+    """Return True if the given file has the given suffix, compressed or not.
+
+    :param filename: The path to the file
+    :type filename: str
+    :param suffix: The suffix, e.g., .csv
+    :type suffix: str
+    :rtype: bool
+    """
+    return strip_compression_suffix(filename)[-len(suffix):] == suffix
+
+def estimated_size(filename):
+    """Return an estimate of the number of bytes in the given file once decompressed.
+
+    The size of a gzip file is read from its trailer, which records it
+    modulo 2**32. Other compressed files are assumed to have been compressed
+    by COMPRESSION_RATIO.
+
+    :param filename: The path to the file
+    :type filename: str
+    :rtype: float
+    """
+    size = os.path.getsize(filename)
+    suffix = compression_suffix(filename)
+    if suffix is None:
+        return float(size)
+    if suffix == ".gz" and size >= 4:
+        with open(filename, "rb") as datafile:
+            datafile.seek(-4, os.SEEK_END)
+            (isize,) = struct.unpack("<I", datafile.read(4))
+        # The trailer wraps for files over 4 GB, so trust it only if it's plausible.
+        if isize >= size:
+            return float(isize)
+    return size * COMPRESSION_RATIO
+
+@contextmanager
+def open_input(filename):
+    """Open the given file for reading, decompressing it as it is read if it is compressed.
+
+    Compressed files are decompressed by a separate process running the
+    format's command-line decompressor, or, if none is installed, by a
+    thread, so that decompression runs alongside the reader. Neither writes
+    the decompressed data to disk.
+
+    :param filename: The path to the file
+    :type filename: str
+    :rtype: file
+    """
+    suffix = compression_suffix(filename)
+    if suffix is None:
+        with open(filename, "rb") as datafile:
+            yield datafile
+        return
+    (commands, decompressor) = DECOMPRESSORS[suffix]
+    for command in commands:
+        executable = find_executable(command)
+        if executable is not None:
+            with _open_with_process(executable, filename) as datafile:
+                yield datafile
+            return
+    if decompressor is None:
+        raise IOError("No decompressor is available for %s" % filename)
+    with _open_with_thread(decompressor, filename) as datafile:
+        yield datafile
+
+@contextmanager
+def _open_with_process(executable, filename):
+    logger.debug("Decompressing %s with %s" % (filename, executable))
+    process = Popen([executable, "-dc", filename], stdout=PIPE, bufsize=BUFFER_SIZE,
+        preexec_fn=_restore_sigpipe)
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    # The decompressor is killed by SIGPIPE if the file is closed before it is read to the end.
+    if returncode not in [0, -signal.SIGPIPE]:
+        raise IOError("%s exited with status %d while decompressing %s" % (executable, returncode, filename))
+
+def _restore_sigpipe():
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+@contextmanager
+def _open_with_thread(decompressor, filename):
+    logger.debug("Decompressing %s in a thread" % filename)
+    (readfd, writefd) = os.pipe()
+    errors = []
+    def decompress():
+        # Closing the pipe before reading it to the end raises EPIPE here.
+        try:
+            with os.fdopen(writefd, "wb", BUFFER_SIZE) as pipe:
+                source = decompressor(filename, "rb")
+                try:
+                    while True:
+                        data = source.read(BUFFER_SIZE)
+                        if not data:
+                            break
+                        pipe.write(data)
+                finally:
+                    source.close()
+        except Exception as e:
+            if getattr(e, "errno", None) != errno.EPIPE:
+                errors.append(e)
+    thread = Thread(target=decompress)
+    thread.daemon = True
+    thread.start()
+    try:
+        with os.fdopen(readfd, "rb", BUFFER_SIZE) as datafile:
+            yield datafile
+    finally:
+        thread.join()
+    if errors:
+        raise IOError("Error decompressing %s: %s" % (filename, errors[0]))
@@ -1,162 +1,515 @@
 import csv
-import dateutil.parser
+import mmap
 import os
 import splparser.parser
+import sys
 
 from user import *
 from query import *
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from logging import getLogger as get_logger
 from os import path
+from queryutils.checkpoint import get_new_users_from_files
+from queryutils.compression import compression_suffix, estimated_size, has_suffix, open_input
+from queryutils.interning import StringPool
+from queryutils.parallel import get_users_from_files
+from queryutils.timestamps import TimestampDecoder
+from shutil import rmtree
 from splparser.exceptions import SPLSyntaxError, TerminatingSPLSyntaxError
+from tempfile import mkdtemp
+
+import cPickle as pickle
 
 
 BYTES_IN_MB = 1048576
 LIMIT = 2000*BYTES_IN_MB
+NPARTITIONS = 64
+USER_FIELDS = ["user", "case_id"]
 
 logger = get_logger("queryutils")
 
 
-def get_users_from_file(filename, users):
+class Ingestion(object):
+    """The ways of reading users from .csv files.
+
+    ALL reads every user before returning any. GROUPED returns each user as
+    soon as its rows end, which requires each user's rows to be contiguous.
+    PARTITIONED first partitions the rows on disk by user, which works for
+    rows in any order.
+    """
+    ALL = "all"
+    GROUPED = "grouped"
+    PARTITIONED = "partitioned"
+
+
+
+def get_users_from_file(filename, users, fields=None, strings=None):
     """Populate the users dictionary with users and their queris from the given file.
 
     :param filename: The .csv file containing user queries
     :type filename: str
     :param users: The user dict into which to place the users
     :type users: dict
+    :param fields: The columns to read, if not all of them (see read_rows)
+    :type fields: list
+    :param strings: The pool of strings to share with other files, if any
+    :type strings: queryutils.interning.StringPool
     :rtype: None
     """
     logger.debug("Reading from file:" + filename)
-    first = True
-    with open(filename) as datafile:
-        reader = csv.DictReader(datafile)
-        for row in reader:
-            logger.debug("Attempting to read row.")
-
-            # Get basic user information.
-            username = row.get('user', None)
-            if username is not None:
-                username = unicode(username.decode("utf-8"))
-
-            case = row.get('case_id', None)
-            if case is not None:
-                case = unicode(case.decode("utf-8"))
-
-            # Check if we've seen this user before.
-            user = None
-            userhash = None
-            if username is not None and case is not None:
-                userhash = ".".join([username, case])
-                user = users.get(userhash, None)
-            elif username is not None and case is None:
-                userhash = username
-                user = users.get(userhash, None)
-            else:
-                userhash = ""
-                user = users.get(userhash, None)
-            if user is None:
-                user = User(username)
-                users[userhash] = user
-            user.case_id = case
-
-            # Get basic query information.
-            timestamp = row.get('_time', None)
-            if timestamp is not None:
-                timestamp = float(dateutil.parser.parse(timestamp).strftime('%s.%f'))
-
-            querystring = row.get('search', None)
-            if querystring is not None:
-                querystring = unicode(querystring.decode("utf-8")).strip()
-
-            # Tie the query and the user together.
-            query = Query(querystring, timestamp)
-            user.queries.append(query)
-            query.user = user
-           
-            # Get additional query information and add it to the query.
-            runtime = row.get('runtime', None)
-            if runtime is None:
-                runtime = row.get('total_run_time', None)
-            if runtime is not None:
-                try:
-                    runtime = float(runtime.decode("utf-8"))
-                except:
-                    runtime = None
-            query.execution_time = runtime
-
-            search_et = row.get('search_et', None)
-            if search_et is not None:
-                try:
-                    search_et = float(search_et.decode("utf-8"))
-                except:
-                    search_et = None
-            query.earliest_event = search_et
-
-            search_lt = row.get('search_lt', None)
-            if search_lt is not None:
-                try:
-                    search_lt = float(search_lt.decode("utf-8"))
-                except:
-                    search_lt = None
-            query.latest_event = search_lt
-
-            range = row.get('range', None)
-            if range is not None:
-                try:
-                    range = float(range.decode("utf-8"))
-                except:
-                    range = None
-            query.range = range
-
-            is_realtime = row.get('is_realtime', None)
-            if is_realtime is not None and is_realtime == "false":
-                is_realtime = False
-            if is_realtime is not None and is_realtime == "true":
-                is_realtime = True
-            query.is_realtime = is_realtime
-
-            searchtype = row.get('searchtype', None)
-            if searchtype is None:
-                searchtype = row.get('search_type', None)
-            if searchtype is not None:
-                searchtype = unicode(searchtype.decode("utf-8"))
-            query.search_type = searchtype
-            if query.search_type == "adhoc":
-                query.is_interactive = True
-
-            splunk_id = row.get('search_id', None)
-            if splunk_id is not None:
-                splunk_id = unicode(splunk_id.decode("utf-8"))
-            query.splunk_search_id = splunk_id
-
-            savedsearch_name = row.get('savedsearch_name', None)
-            if savedsearch_name is not None:
-                savedsearch_name = unicode(savedsearch_name.decode("utf-8"))
-            query.saved_search_name = savedsearch_name
-
-            logger.debug("Successfully read query.")
-
-def get_users_from_directory(directory, users, limit=LIMIT):
+    decoder = TimestampDecoder()
+    if strings is None:
+        strings = StringPool()
+    for row in read_rows(filename, fields=fields):
+        add_row_to_users(row, users, decoder=decoder, strings=strings)
+
+def read_rows(filename, fields=None):
+    """Yield the rows of the given .csv file as dicts from column names to values.
+
+    If a list of fields is given, only those columns, plus the ones that
+    identify the user (USER_FIELDS), are put in the rows, and the file is
+    scanned with scan_rows instead of csv.DictReader. The other attributes of
+    the queries read from such rows are left as None.
+
+    :param filename: The .csv file
+    :type filename: str
+    :param fields: The columns to read, if not all of them
+    :type fields: list
+    :rtype: generator
+    """
+    if fields is not None:
+        fields = list(fields) + [f for f in USER_FIELDS if f not in fields]
+        for row in scan_rows(filename, fields):
+            yield row
+        return
+    with open_input(filename) as datafile:
+        for row in csv.DictReader(datafile):
+            yield row
+
+def scan_rows(filename, fields):
+    """Yield dicts of only the given columns of the rows of the given .csv file.
+
+    Uncompressed files are memory-mapped rather than read, and each row is
+    split with csv.reader, so no dict of the other columns is ever built.
+    Columns missing from the file, or from a short row, are left out.
+
+    :param filename: The .csv file
+    :type filename: str
+    :param fields: The columns to read
+    :type fields: list
+    :rtype: generator
+    """
+    with _open_lines(filename) as lines:
+        reader = csv.reader(lines)
+        header = next(reader, None)
+        if header is None:
+            return
+        projection = [(field, header.index(field)) for field in fields if field in header]
+        for values in reader:
+            nvalues = len(values)
+            yield { field: values[idx] for (field, idx) in projection if idx < nvalues }
+
+@contextmanager
+def _open_lines(filename):
+    """Open the given file as an iterator over its lines, memory-mapping it if possible.
+    """
+    if compression_suffix(filename) is not None or path.getsize(filename) == 0:
+        with open_input(filename) as datafile:
+            yield datafile
+        return
+    with open(filename, "rb") as datafile:
+        mapped = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield iter(mapped.readline, "")
+        finally:
+            mapped.close()
+
+def get_new_users_from_file(filename, users, offset=0):
+    """Populate the users dictionary with the queries in the rows of the given file after the given offset.
+
+    Only complete rows are read, so a row still being written when the file
+    is read is left for the next read. Compressed files cannot be read from
+    an offset, so they are read whole when the offset is 0, and otherwise
+    not read at all.
+
+    :param filename: The .csv file containing user queries
+    :type filename: str
+    :param users: The user dict into which to place the users
+    :type users: dict
+    :param offset: The byte offset up to which the file has already been read
+    :type offset: int
+    :rtype: int
+    :returns: The byte offset up to which the file has now been read
+    """
+    if compression_suffix(filename) is not None:
+        size = path.getsize(filename)
+        if offset > 0:
+            logger.warning("Not reading the changes to compressed file " + filename)
+            return size
+        get_users_from_file(filename, users)
+        return size
+    logger.debug("Reading from file:%s, offset:%d" % (filename, offset))
+    decoder = TimestampDecoder()
+    strings = StringPool()
+    with open(filename, "rb") as datafile:
+        header = datafile.readline()
+        if not header.endswith("\n"):
+            return 0
+        offset = max(offset, datafile.tell())
+        datafile.seek(offset)
+        lines = _CompleteLines(datafile, offset)
+        for row in csv.DictReader(lines, fieldnames=next(csv.reader([header]))):
+            if lines.exhausted: # The row was cut off by the end of the file.
+                break
+            add_row_to_users(row, users, decoder=decoder, strings=strings)
+            offset = lines.offset
+    return offset
+
+class _CompleteLines(object):
+    """Iterates over the lines of a file that end in a newline, counting their bytes.
+    """
+
+    def __init__(self, datafile, offset):
+        self.lines = iter(datafile)
+        self.offset = offset
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = next(self.lines, "")
+        if not line.endswith("\n"):
+            self.exhausted = True
+            raise StopIteration
+        self.offset += len(line)
+        return line
+
+def add_row_to_users(row, users, decoder=None, strings=None):
+    """Add the query in the given row to its user in the users dictionary.
+
+    :param row: The row read from a .csv file
+    :type row: dict
+    :param users: The user dict into which to place the user
+    :type users: dict
+    :param decoder: The timestamp decoder for the file the row is from
+    :type decoder: queryutils.timestamps.TimestampDecoder
+    :param strings: The pool of strings for the file the row is from
+    :type strings: queryutils.interning.StringPool
+    :rtype: queryutils.user.User
+    """
+    logger.debug("Attempting to read row.")
+    (userhash, username, case) = user_key_from_row(row, strings=strings)
+    user = users.get(userhash, None)
+    if user is None:
+        user = User(username)
+        users[userhash] = user
+    user.case_id = case
+
+    # Tie the query and the user together.
+    query = query_from_row(row, decoder=decoder, strings=strings)
+    user.queries.append(query)
+    query.user = user
+    logger.debug("Successfully read query.")
+    return user
+
+def user_key_from_row(row, strings=None):
+    """Return the key identifying the user of the given row, with the user's name and case.
+
+    :param row: The row read from a .csv file
+    :type row: dict
+    :param strings: The pool of strings for the file the row is from
+    :type strings: queryutils.interning.StringPool
+    :rtype: tuple
+    """
+    if strings is None:
+        strings = StringPool(max_size=0)
+
+    # Get basic user information.
+    username = strings.decode(row.get('user', None))
+    case = strings.decode(row.get('case_id', None))
+
+    if username is not None and case is not None:
+        userhash = ".".join([username, case])
+    elif username is not None and case is None:
+        userhash = username
+    else:
+        userhash = ""
+    return (userhash, username, case)
+
+def query_from_row(row, decoder=None, strings=None):
+    """Return the query in the given row, without its user.
+
+    The query's text and other repetitive strings are shared with those of
+    other queries through the given pool of strings. Search IDs are unique
+    to each query, so they are not.
+
+    :param row: The row read from a .csv file
+    :type row: dict
+    :param decoder: The timestamp decoder for the file the row is from
+    :type decoder: queryutils.timestamps.TimestampDecoder
+    :param strings: The pool of strings for the file the row is from
+    :type strings: queryutils.interning.StringPool
+    :rtype: queryutils.query.Query
+    """
+    if strings is None:
+        strings = StringPool(max_size=0)
+
+    # Get basic query information.
+    timestamp = row.get('_time', None)
+    if timestamp is not None:
+        if decoder is None:
+            decoder = TimestampDecoder()
+        timestamp = decoder.decode(timestamp)
+
+    querystring = row.get('search', None)
+    if querystring is not None:
+        querystring = strings.intern(unicode(querystring.decode("utf-8")).strip())
+
+    query = Query(querystring, timestamp)
+   
+    # Get additional query information and add it to the query.
+    runtime = row.get('runtime', None)
+    if runtime is None:
+        runtime = row.get('total_run_time', None)
+    if runtime is not None:
+        try:
+            runtime = float(runtime.decode("utf-8"))
+        except:
+            runtime = None
+    query.execution_time = runtime
+
+    search_et = row.get('search_et', None)
+    if search_et is not None:
+        try:
+            search_et = float(search_et.decode("utf-8"))
+        except:
+            search_et = None
+    query.earliest_event = search_et
+
+    search_lt = row.get('search_lt', None)
+    if search_lt is not None:
+        try:
+            search_lt = float(search_lt.decode("utf-8"))
+        except:
+            search_lt = None
+    query.latest_event = search_lt
+
+    range = row.get('range', None)
+    if range is not None:
+        try:
+            range = float(range.decode("utf-8"))
+        except:
+            range = None
+    query.range = range
+
+    is_realtime = row.get('is_realtime', None)
+    if is_realtime is not None and is_realtime == "false":
+        is_realtime = False
+    if is_realtime is not None and is_realtime == "true":
+        is_realtime = True
+    query.is_realtime = is_realtime
+
+    searchtype = row.get('searchtype', None)
+    if searchtype is None:
+        searchtype = row.get('search_type', None)
+    query.search_type = strings.decode(searchtype)
+    if query.search_type == "adhoc":
+        query.is_interactive = True
+
+    splunk_id = row.get('search_id', None)
+    if splunk_id is not None:
+        splunk_id = unicode(splunk_id.decode("utf-8"))
+    query.splunk_search_id = splunk_id
+
+    query.saved_search_name = strings.decode(row.get('savedsearch_name', None))
+
+    return query
+
+def iter_users_from_file(filename, fields=None):
+    """Yield the users and their queries from a .csv file whose rows are grouped by user.
+
+    Each user is yielded as soon as a row for a different user is read, so
+    only one user's queries are held in memory at a time. If the rows of a
+    user are not contiguous, that user is yielded once for each run of rows.
+
+    :param filename: The .csv file containing user queries
+    :type filename: str
+    :param fields: The columns to read, if not all of them (see read_rows)
+    :type fields: list
+    :rtype: generator
+    """
+    logger.debug("Streaming from file:" + filename)
+    for user in iter_grouped_users(read_rows(filename, fields=fields)):
+        yield user
+
+def iter_grouped_users(rows):
+    """Yield a user each time the user key of the given rows changes.
+
+    :param rows: The rows read from .csv files
+    :type rows: iterable
+    :rtype: generator
+    """
+    users = {}
+    seen = set()
+    decoder = TimestampDecoder()
+    strings = StringPool()
+    for row in rows:
+        userhash = user_key_from_row(row)[0]
+        if userhash not in users:
+            for user in users.itervalues():
+                yield user
+            users = {}
+            if userhash in seen:
+                logger.warning("Rows of user %s are not contiguous." % userhash)
+            seen.add(userhash)
+        add_row_to_users(row, users, decoder=decoder, strings=strings)
+    for user in users.itervalues():
+        yield user
+
+def iter_users_partitioned(filenames, npartitions=NPARTITIONS, tmpdir=None, fields=None):
+    """Yield the users and their queries from .csv files in any order, one partition at a time.
+
+    The rows are first written to `npartitions` temporary files by the hash
+    of their user key, and then each partition is read back and its users
+    are yielded, so only one partition's users are held in memory at a time.
+    Every user is yielded exactly once, with its queries in the order they
+    appear in the files.
+
+    :param filenames: The .csv files containing user queries
+    :type filenames: list
+    :param npartitions: The number of partitions to split the users into
+    :type npartitions: int
+    :param tmpdir: The directory in which to create the partitions
+    :type tmpdir: str
+    :param fields: The columns to read, if not all of them (see read_rows)
+    :type fields: list
+    :rtype: generator
+    """
+    partitiondir = mkdtemp(prefix="csvpartitions", dir=tmpdir)
+    try:
+        paths = [path.join(partitiondir, "%d.pickle" % i) for i in range(npartitions)]
+        partitions = [open(p, "wb") for p in paths]
+        try:
+            for filename in filenames:
+                logger.debug("Partitioning file:" + filename)
+                for row in read_rows(filename, fields=fields):
+                    userhash = user_key_from_row(row)[0]
+                    pickle.dump(row, partitions[hash(userhash) % npartitions], pickle.HIGHEST_PROTOCOL)
+        finally:
+            for partition in partitions:
+                partition.close()
+        for p in paths:
+            users = OrderedDict()
+            decoder = TimestampDecoder()
+            strings = StringPool()
+            with open(p, "rb") as partition:
+                while True:
+                    try:
+                        row = pickle.load(partition)
+                    except EOFError:
+                        break
+                    add_row_to_users(row, users, decoder=decoder, strings=strings)
+            os.remove(p)
+            for user in users.itervalues():
+                yield user
+    finally:
+        rmtree(partitiondir, ignore_errors=True)
+
+def iter_users(filepath, ingestion=Ingestion.GROUPED, limit=LIMIT, npartitions=NPARTITIONS, tmpdir=None,
+        fields=None):
+    """Yield the users and their queries from a .csv file or a directory of them.
+
+    :param filepath: The .csv file or directory of .csv files
+    :type filepath: str
+    :param ingestion: How to read the users (one of the attributes of queryutils.csvparser.Ingestion)
+    :type ingestion: str
+    :param limit: The approximate number of bytes to read in from a directory (for testing)
+    :type limit: int
+    :param npartitions: The number of partitions to split the users into, if partitioning
+    :type npartitions: int
+    :param tmpdir: The directory in which to create the partitions, if partitioning
+    :type tmpdir: str
+    :param fields: The columns to read, if not all of them (see read_rows)
+    :type fields: list
+    :rtype: generator
+    """
+    filenames = [filepath]
+    if path.isdir(filepath):
+        filenames = get_csv_files(filepath, limit=limit)
+    if ingestion == Ingestion.GROUPED:
+        for filename in filenames:
+            for user in iter_users_from_file(filename, fields=fields):
+                yield user
+    elif ingestion == Ingestion.PARTITIONED:
+        for user in iter_users_partitioned(filenames, npartitions=npartitions, tmpdir=tmpdir, fields=fields):
+            yield user
+    else:
+        users = {}
+        strings = StringPool()
+        for filename in filenames:
+            get_users_from_file(filename, users, fields=fields, strings=strings)
+        for user in users.itervalues():
+            yield user
+
+def get_users_from_directory(directory, users, limit=LIMIT, processes=None, fields=None,
+        cache=None):
     """Populate the users dict with users from the .csv files.
 
+    If a number of processes is given, the files are read in parallel.
+
     :param directory: The path to the directory containing the .csv files 
     :type directory: str
     :param users: The dict to contain the users read from the .csv files
     :type users: dict
     :param limit: The approximate number of bytes to read in (for testing)
     :type limit: int
+    :param processes: The number of processes to read the files with, if more than one
+    :type processes: int
+    :param fields: The columns to read, if not all of them (see read_rows)
+    :type fields: list
+    :param cache: The cache to read the files through, if any
+    :type cache: queryutils.cache.Cache
     :rtype: None
     """
     raw_data_files = get_csv_files(directory, limit=limit)
+    if processes is not None and processes > 1:
+        get_users_from_files(sys.modules[__name__], raw_data_files, users, processes=processes, fields=fields,
+            cache=cache)
+        return
+    strings = StringPool()
     for f in raw_data_files:
-        get_users_from_file(f, users)
+        if cache is not None:
+            cache.get_users_from_file(sys.modules[__name__], f, users, fields=fields)
+        else:
+            get_users_from_file(f, users, fields=fields, strings=strings)
+
+def get_new_users_from_directory(directory, users, checkpoint, limit=None):
+    """Populate the users dict with the queries added to the .csv files since the checkpoint.
+
+    :param directory: The path to the directory containing the .csv files
+    :type directory: str
+    :param users: The user dict into which to place the users
+    :type users: dict
+    :param checkpoint: The checkpoint to read from and advance
+    :type checkpoint: queryutils.checkpoint.Checkpoint
+    :param limit: The approximate number of bytes to read in (for testing), or None for all of them
+    :type limit: int
+    :rtype: None
+    """
+    get_new_users_from_files(sys.modules[__name__], get_csv_files(directory, limit=limit), users, checkpoint)
 
 def get_csv_files(dir, limit=LIMIT):
     """Return the paths to all the .csv files in the given directory.
 
+    Compressed .csv files (.csv.gz, .csv.bz2, and .csv.xz) are included, and
+    count toward the limit by their estimated uncompressed size.
+
     :param dir: The path to the given directory
     :type dir: str
-    :param limit: The approximate number of bytes to read in (for testing)
+    :param limit: The approximate number of bytes to read in (for testing), or None for all of them
     :type limit: int
     :rtype: list
     """
@@ -164,10 +517,10 @@ def get_csv_files(dir, limit=LIMIT):
     bytes_added = 0.
     for (dirpath, dirnames, filenames) in os.walk(dir):
         for filename in filenames:
-            if filename[-4:] == '.csv': 
+            if has_suffix(filename, '.csv'): 
                 full_filename = path.join(path.abspath(dir), filename)
                 csv_files.append(full_filename) 
-                bytes_added += path.getsize(full_filename)
-                if bytes_added > limit:
+                bytes_added += estimated_size(full_filename)
+                if limit is not None and bytes_added > limit:
                     return csv_files
     return csv_files
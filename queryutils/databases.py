@@ -2,21 +2,42 @@ from time import time
 
 start = time()
 
+from cStringIO import StringIO
 from logging import getLogger as get_logger
-from queryutils.source import DataSource
+from queryutils.source import DataSource, NEW_SESSION_THRESH_SECS
 from queryutils.user import User
 from queryutils.session import Session
-from queryutils.query import Query, QueryType
-from queryutils.parse import parse_query
+from queryutils.query import Query, QueryType, interarrival_arrays, interarrival_metrics
+from queryutils.parallel import CHUNK_SIZE, parse_queries
 from splparser.parsetree import ParseTreeNode
 
 import queryutils.sql
 
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 import sqlite3
 
+BULK_BATCH_SIZE = 10000
+FETCH_SIZE = 1000
+COPY_BATCH_SIZE = 50000
+METRICS_BATCH_SIZE = 10000
+COPY_COLUMNS = {
+    "users": ("id", "name", "case_id", "user_type"),
+    "queries": ("id", "text", "time", "is_interactive", "is_suspicious",
+        "execution_time", "earliest_event", "latest_event", "range",
+        "is_realtime", "search_type", "splunk_search_id", "saved_search_name",
+        "user_id", "session_id"),
+    "parsetrees": ("parsetree", "query_id"),
+}
+
+QUERY_COLUMNS = ["id", "text", "time", "is_interactive", "is_suspicious",
+    "search_type", "earliest_event", "latest_event", "range", "is_realtime",
+    "splunk_search_id", "execution_time", "saved_search_name", "user_id",
+    "session_id"]
+
 SUSPICIOUS_USER_NAMES = ["splunk-system-user"]
+
 SUSPICIOUS_QUERY_THRESHOLDS = {
     "interarrival_consistency_max": .9,
     "interarrival_clockness_max": .9,
@@ -31,7 +52,7 @@ class Database(DataSource):
     """Represents a Database that stores Splunk query data.
     """
 
-    def __init__(self, wildcard, dbtype):
+    def __init__(self, wildcard, dbtype, fetch_size=FETCH_SIZE):
         """Create a Database object.
 
         :param self: The object being created
@@ -40,11 +61,15 @@ class Database(DataSource):
         :type wildcard: str
         :param dbtype: The type of database (postgres or sqlite3)
         :type dbtype: str
+        :param fetch_size: The number of rows to fetch at a time when streaming results
+        :type fetch_size: int
         :rtype: queryutils.databases.Database
         """
         self.wildcard = wildcard
         self.connection = None
+        self.nconnections = 0
         self.dbtype = dbtype
+        self.fetch_size = fetch_size
         super(Database, self).__init__()
 
     def initialize_tables(self):
@@ -104,11 +129,10 @@ class Database(DataSource):
         :type queries: list
         :rtype: None
         """
-        self.connect()
-        for query in queries:
-            logger.debug("Executing \n%s" % query)
-            self.execute(query)
-        self.close()
+        with self.connected():
+            for query in queries:
+                logger.debug("Executing \n%s" % query)
+                self.execute(query)
 
     def load_users_and_queries_from_source(self, module, *args):
         """Load the user and query tables from a given source.
@@ -138,40 +162,264 @@ class Database(DataSource):
         :type src: queryutils.source.DataSource
         :rtype: None
         """
-        src.connect()
-        self.connect()
-        uid = qid = 1
-        for user in src.get_users_with_queries():
-            logger.debug("Loading user.")
-            self.insert_user(user, uid)
-            for query in user.queries:
-                logger.debug("Loading query.")
-                self.insert_query(query, qid, uid, None)
-                qid += 1
-            uid += 1
-        self.close()
-        src.close()
-
-    def load_parsed(self):
+        with src.connected(), self.connected():
+            uid = qid = 1
+            for user in src.get_users_with_queries():
+                logger.debug("Loading user.")
+                self.insert_user(user, uid)
+                for query in user.queries:
+                    logger.debug("Loading query.")
+                    self.insert_query(query, qid, uid, None)
+                    qid += 1
+                uid += 1
+
+    def bulk_load_users_and_queries(self, src, batch_size=BULK_BATCH_SIZE):
+        """Load the user and query tables from a given source in batches.
+
+        Unlike load_users_and_queries, which inserts and commits one row at a
+        time, this groups rows into batches of roughly `batch_size` rows,
+        writes each batch with one executemany call per table, and commits
+        once per batch. The load rate is logged after every batch.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param src: The source to load users and queries from
+        :type src: queryutils.source.DataSource
+        :param batch_size: The approximate number of rows to write per commit
+        :type batch_size: int
+        :rtype: int
+        """
+        with src.connected(), self.connected():
+            self.begin_fast_load()
+            users = []
+            queries = []
+            nrows = 0
+            uid = qid = 1
+            start = time()
+            try:
+                for user in src.get_users_with_queries():
+                    users.append(self._user_row(user, uid))
+                    for query in user.queries:
+                        queries.append(self._query_row(query, qid, uid, None))
+                        qid += 1
+                    uid += 1
+                    if len(users) + len(queries) >= batch_size:
+                        nrows += self._insert_batch(users, queries)
+                        self._log_load_rate(nrows, start)
+                        users = []
+                        queries = []
+                if len(users) + len(queries) > 0:
+                    nrows += self._insert_batch(users, queries)
+                self._log_load_rate(nrows, start)
+                self._sync_id_sequences(["users", "queries"])
+            finally:
+                self.end_fast_load()
+        return nrows
+
+    def append_users_and_queries(self, src, checkpoint, parsed=False, processes=None, chunk_size=CHUNK_SIZE,
+            batch_size=BULK_BATCH_SIZE):
+        """Add the users and queries added to a source since the checkpoint to the tables.
+
+        The source's new queries are read with get_new_users_with_queries
+        and given IDs after those already in the query table. Their users
+        are matched to the rows already in the user table by name and case,
+        and only users not already there are inserted. If `parsed` is True,
+        the new queries are also parsed and their parsetrees inserted, by a
+        pool of worker processes, `chunk_size` at a time, if a number of
+        processes is given (see queryutils.parallel.parse_queries). Rows
+        are inserted and committed in batches of roughly `batch_size` rows,
+        and the checkpoint is saved once all of them have been committed, so
+        rows are never skipped, though if the load is interrupted between
+        the last commit and the save, they will be inserted again.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param src: The source to load users and queries from
+        :type src: queryutils.files.Files
+        :param checkpoint: The checkpoint recording what has already been loaded
+        :type checkpoint: queryutils.checkpoint.Checkpoint
+        :param parsed: Whether or not to load parsetrees too
+        :type parsed: bool
+        :param processes: The number of processes to parse the queries with, if more than one
+        :type processes: int
+        :param chunk_size: The number of queries to send to a worker process at a time
+        :type chunk_size: int
+        :param batch_size: The approximate number of rows to write per commit
+        :type batch_size: int
+        :rtype: int
+        """
+        with src.connected(), self.connected():
+            uids = {}
+            for row in self.stream("SELECT id, name, case_id FROM users"):
+                uids[(row["name"], row["case_id"])] = row["id"]
+            users = []
+            queries = []
+            parsetrees = []
+            nrows = 0
+            start = time()
+
+            # The user and query rows are added to their batches as the queries
+            # are read, which may be a few chunks ahead of the parsed results.
+            def new_queries():
+                uid = self._max_id("users") + 1
+                qid = self._max_id("queries") + 1
+                for user in src.get_new_users_with_queries(checkpoint):
+                    key = (user.name, user.case_id)
+                    user_id = uids.get(key, None)
+                    if user_id is None:
+                        user_id = uids[key] = uid
+                        users.append(self._user_row(user, uid))
+                        uid += 1
+                    for query in user.queries:
+                        queries.append(self._query_row(query, qid, user_id, None))
+                        yield (qid, query.text)
+                        qid += 1
+
+            if parsed:
+                results = parse_queries(new_queries(), processes=processes, chunk_size=chunk_size)
+            else:
+                results = ((qid, None, None) for (qid, _) in new_queries())
+            for (qid, dumped, error) in results:
+                if dumped is not None:
+                    parsetrees.append((dumped, qid))
+                if len(users) + len(queries) + len(parsetrees) >= batch_size:
+                    nrows += self._insert_batch(users, queries, parsetrees)
+                    self._log_load_rate(nrows, start)
+                    del users[:]
+                    del queries[:]
+                    del parsetrees[:]
+            if len(users) + len(queries) + len(parsetrees) > 0:
+                nrows += self._insert_batch(users, queries, parsetrees)
+            self._log_load_rate(nrows, start)
+            self._sync_id_sequences(["users", "queries"])
+            checkpoint.save()
+        return nrows
+
+    def _max_id(self, table):
+        """Return the largest ID in the given table, or 0 if it is empty.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param table: The table
+        :type table: str
+        :rtype: int
+        """
+        row = self.execute("SELECT MAX(id) AS max_id FROM %s" % table).fetchone()
+        return row["max_id"] if row["max_id"] is not None else 0
+
+    def _sync_id_sequences(self, tables):
+        """Advance whatever generates the IDs of the given tables past the IDs loaded into them.
+
+        By default this does nothing, since SQLite picks new IDs after the
+        largest one in the table; subclasses whose IDs come from sequences
+        override it.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param tables: The tables rows were loaded into with explicit IDs
+        :type tables: list
+        :rtype: None
+        """
+        pass
+
+    def begin_fast_load(self):
+        """Prepare the database for a bulk load.
+
+        By default this does nothing; subclasses override it to trade
+        durability for speed while a load is in progress.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :rtype: None
+        """
+        pass
+
+    def end_fast_load(self):
+        """Undo the changes made by begin_fast_load once a bulk load finishes.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :rtype: None
+        """
+        pass
+
+    def _insert_batch(self, users, queries, parsetrees=[]):
+        """Insert a batch of user, query and parsetree rows and commit them together.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param users: The user rows to insert, as returned by _user_row
+        :type users: list
+        :param queries: The query rows to insert, as returned by _query_row
+        :type queries: list
+        :param parsetrees: The parsetree rows to insert, as (dumped parsetree, query ID) pairs
+        :type parsetrees: list
+        :rtype: int
+        """
+        if len(users) > 0:
+            self.executemany(self._insert_user_sql(), users)
+        if len(queries) > 0:
+            self.executemany(self._insert_query_sql(), queries)
+        if len(parsetrees) > 0:
+            self.executemany(self._insert_parsetree_sql(), parsetrees)
+        self.commit()
+        return len(users) + len(queries) + len(parsetrees)
+
+    def _log_load_rate(self, nrows, start):
+        """Log the number of rows loaded so far and the load rate.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param nrows: The number of rows loaded so far
+        :type nrows: int
+        :param start: The time at which the load started
+        :type start: float
+        :rtype: None
+        """
+        elapsed = time() - start
+        rate = nrows / elapsed if elapsed > 0. else 0.
+        logger.info("Loaded %d rows in %f seconds (%f rows/s)." % (nrows, elapsed, rate))
+
+    def load_parsed(self, processes=None, chunk_size=CHUNK_SIZE, batch_size=BULK_BATCH_SIZE):
         """Parse the queries and load them into the parsetree table.
 
         Each query is read from the query table, which is assumed to be
         populated, and then the result is loaded into the parsetree table.
+        The queries are parsed by a pool of worker processes, `chunk_size`
+        at a time, if a number of processes is given (see
+        queryutils.parallel.parse_queries), and the parsetrees are inserted
+        `batch_size` rows per transaction.
 
         :param self: The current object
         :type self: queryutils.databases.Database
-        :rtype: None
+        :param processes: The number of processes to parse the queries with, if more than one
+        :type processes: int
+        :param chunk_size: The number of queries to send to a worker process at a time
+        :type chunk_size: int
+        :param batch_size: The number of rows to insert per transaction
+        :type batch_size: int
+        :rtype: int
         """
-        self.connect()
-        cursor = self.execute("SELECT id, text FROM queries")
-        for row in cursor.fetchall():
-            d = { k:row[k] for k in row.keys() }
-            parsetree = parse_query(row["text"])
-            if parsetree is not None:
-                logger.debug("Loading parsetree.")
-                parsetree.query_id = row["id"]
-                self.insert_parsetree(parsetree)
-        self.close()
+        with self.connected():
+            self.begin_fast_load()
+            nrows = nfailed = 0
+            try:
+                queries = ((row["id"], row["text"]) for row in self.stream("SELECT id, text FROM queries"))
+                parsetrees = []
+                for (qid, dumped, error) in parse_queries(queries, processes=processes, chunk_size=chunk_size):
+                    if dumped is None:
+                        nfailed += 1
+                        continue
+                    parsetrees.append((dumped, qid))
+                    if len(parsetrees) >= batch_size:
+                        nrows += self._insert_batch([], [], parsetrees)
+                        parsetrees = []
+                if len(parsetrees) > 0:
+                    nrows += self._insert_batch([], [], parsetrees)
+            finally:
+                self.end_fast_load()
+        logger.info("Loaded %d parsetrees; %d queries failed to parse." % (nrows, nfailed))
+        return nrows
 
     def insert_user(self, user, uid):
         """Insert user data into the user table.
@@ -184,12 +432,33 @@ class Database(DataSource):
         :type uid: int
         :rtype: None
         """
-        self.execute("INSERT INTO users \
-                (id, name, case_id, user_type) \
-                VALUES (" + ",".join([self.wildcard]*4) + ")", 
-                (uid, user.name, user.case_id, user.user_type))
+        self.execute(self._insert_user_sql(), self._user_row(user, uid))
         self.commit()
 
+    def _insert_user_sql(self):
+        """Returns the parameterized statement that inserts one user row.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :rtype: str
+        """
+        return "INSERT INTO users \
+                (id, name, case_id, user_type) \
+                VALUES (" + ",".join([self.wildcard]*4) + ")"
+
+    def _user_row(self, user, uid):
+        """Returns the parameters for inserting the given user.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param user: The user to insert
+        :type user: queryutils.user.User
+        :param uid: The ID to assign to the inserted user
+        :type uid: int
+        :rtype: tuple
+        """
+        return (uid, user.name, user.case_id, user.user_type)
+
     def insert_query(self, query, qid, uid, sid):
         """Insert query data into the query table.
 
@@ -205,17 +474,42 @@ class Database(DataSource):
         :type sid: int or None
         :rtype: None
         """
-        self.execute("INSERT INTO queries \
+        self.execute(self._insert_query_sql(), self._query_row(query, qid, uid, sid))
+        self.commit()
+
+    def _insert_query_sql(self):
+        """Returns the parameterized statement that inserts one query row.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :rtype: str
+        """
+        return "INSERT INTO queries \
                 (id, text, time, is_interactive, is_suspicious, \
                 execution_time, earliest_event, latest_event, range, is_realtime, \
                 search_type, splunk_search_id, saved_search_name, \
                 user_id, session_id) \
-                VALUES ("+ ",".join([self.wildcard]*15) +")",
-                (qid, query.text, query.time, query.is_interactive, query.is_suspicious,
+                VALUES ("+ ",".join([self.wildcard]*15) +")"
+
+    def _query_row(self, query, qid, uid, sid):
+        """Returns the parameters for inserting the given query.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param query: The query to insert
+        :type query: queryutils.query.Query
+        :param qid: The ID to assign to the inserted query
+        :type qid: int
+        :param uid: The ID of the user the query belongs to
+        :type uid: int
+        :param sid: The ID of the session the query belongs to
+        :type sid: int or None
+        :rtype: tuple
+        """
+        return (qid, query.text, query.time, query.is_interactive, query.is_suspicious,
                 query.execution_time, query.earliest_event, query.latest_event,
                 query.range, query.is_realtime, query.search_type,
-                query.splunk_search_id, query.saved_search_name, uid, sid))
-        self.commit()
+                query.splunk_search_id, query.saved_search_name, uid, sid)
 
     def insert_parsetree(self, parsetree):
         """The parsed query to insert into the parsetree table.
@@ -226,23 +520,83 @@ class Database(DataSource):
         :type parsetree: splparser.parsetree.ParseTreeNode
         :rtype: None
         """
-        self.execute("INSERT INTO parsetrees \
-                (parsetree, query_id) \
-                VALUES (" + ", ".join([self.wildcard]*2) +")",
-                (parsetree.dumps(), parsetree.query_id))
+        self.execute(self._insert_parsetree_sql(), (parsetree.dumps(), parsetree.query_id))
         self.commit()
 
+    def _insert_parsetree_sql(self):
+        """Returns the parameterized statement that inserts one parsetree row.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :rtype: str
+        """
+        return "INSERT INTO parsetrees \
+                (parsetree, query_id) \
+                VALUES (" + ", ".join([self.wildcard]*2) +")"
+
+    def connect(self):
+        """Connect to the database, or reuse the connection already open.
+
+        Connections are reference-counted: every call to connect must be
+        matched by a call to close, and the connection is only released
+        once the last caller has closed it. This lets nested and concurrent
+        generators share one connection instead of closing it under each
+        other and reconnecting.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :rtype: connection
+        """
+        if self.connection is None:
+            self.connection = self._open_connection()
+        self.nconnections += 1
+        return self.connection
+
     def close(self):
         """Close the connection to the database.
+
+        The connection is only released once every call to connect has been
+        matched by a call to close.
         
         :param self: The current object
         :type self: queryutils.databases.Database
         :rtype: None
         """
-        if self.connection:
-            self.connection.close()
+        if self.nconnections > 0:
+            self.nconnections -= 1
+        if self.nconnections == 0 and self.connection is not None:
+            self._release_connection(self.connection)
             self.connection = None
 
+    def _ensure_connection(self):
+        """Open a connection if none is open, without taking a reference to it.
+
+        This is used by execute so that a one-off statement can be run
+        without an explicit connect. The connection it opens is not counted,
+        so it is released by the next close, including the close matching
+        any later connect; callers that run several statements, or read the
+        rows of one after running another, should hold a reference with
+        connect and close, or connected, instead.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :rtype: connection
+        """
+        if self.connection is None:
+            self.connection = self._open_connection()
+        return self.connection
+
+    def _release_connection(self, connection):
+        """Release the given connection.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param connection: The connection to release
+        :type connection: connection
+        :rtype: None
+        """
+        connection.close()
+
     def commit(self):
         """Commit the latest query.
 
@@ -253,6 +607,29 @@ class Database(DataSource):
         if self.connection:
             self.connection.commit()
 
+    def stream(self, query, *params):
+        """Execute the given query and yield the resulting rows as they are fetched.
+
+        Rows are fetched from the database `fetch_size` at a time rather than
+        all at once, so memory use does not grow with the size of the result.
+        The generator holds a reference to the connection until its rows are
+        exhausted or it is closed.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param query: The query to execute
+        :type query: str
+        :param params: The parameters to the query
+        :type params: tuple
+        :rtype: generator
+        """
+        self.connect()
+        try:
+            for row in self._fetch_rows(query, *params):
+                yield row
+        finally:
+            self.close()
+
     def get_users(self):
         """Get the users from the current database.
 
@@ -260,15 +637,12 @@ class Database(DataSource):
         :type self: queryutils.databases.Database
         :rtype: generator
         """
-        self.connect()
-        ucursor = self.execute("SELECT id, name, case_id, user_type FROM users")
-        for row in ucursor.fetchall():
+        for row in self.stream("SELECT id, name, case_id, user_type FROM users"):
             d = { k:row[k] for k in row.keys() }
             logger.debug("Fetched user: " + row["name"])
             user = User(row["name"])
-            user.__dict__.update(d)
+            user.update(d)
             yield user
-        self.close()
     
     def get_users_with_queries(self, parsed=False):
         """Get the users from the current database with queries.
@@ -279,29 +653,62 @@ class Database(DataSource):
         :type parsed: bool
         :rtype: generator
         """
-        self.connect()
-        for user in self.get_users():
-            for query in self.get_query_from_user(user.id, parsed=parsed):
-                query.user = user
-                user.queries.append(query)
-            user.interactive_queries = [q for q in user.queries if q.is_interactive]
-            user.noninteractive_queries = [q for q in user.queries if not q.is_interactive]
-            yield user
-        self.close()
+        select = "SELECT users.id AS uid, users.name AS user_name, \
+                users.case_id AS user_case_id, users.user_type AS user_user_type, " + \
+                self._query_columns_string("queries")
+        tables = "FROM users LEFT JOIN queries ON queries.user_id = users.id"
+        if parsed:
+            select += ", parsetrees.parsetree AS parsetree"
+            tables += " LEFT JOIN parsetrees ON parsetrees.query_id = queries.id"
+        order = "ORDER BY users.id, queries.time, queries.id"
+        columns = QUERY_COLUMNS + ["parsetree"] if parsed else QUERY_COLUMNS
+        user = None
+        for row in self.stream(" ".join([select, tables, order])):
+            if user is None or user.id != row["uid"]:
+                if user is not None:
+                    yield self._split_interactive_queries(user)
+                user = User(row["user_name"])
+                user.id = row["uid"]
+                user.case_id = row["user_case_id"]
+                user.user_type = row["user_user_type"]
+            if row["id"] is None or (parsed and row["parsetree"] is None):
+                continue
+            query = self._form_query_from_data(row, parsed, columns=columns)
+            query.user = user
+            user.queries.append(query)
+        if user is not None:
+            yield self._split_interactive_queries(user)
+
+    def _split_interactive_queries(self, user):
+        """Sort the user's queries into interactive and noninteractive lists.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param user: The user whose queries to sort
+        :type user: queryutils.user.User
+        :rtype: queryutils.user.User
+        """
+        user.interactive_queries = [q for q in user.queries if q.is_interactive]
+        user.noninteractive_queries = [q for q in user.queries if not q.is_interactive]
+        return user
 
-    def _query_columns_string(self):
+    def _query_columns_string(self, table=None):
         """Returns the list of columns of the query table as a string.
 
+        If a table is given, each column is qualified with it, so that the
+        columns are unambiguous when the query table is joined with others.
+
         :param self: The current object
         :type self: queryutils.databases.Database
+        :param table: The name to qualify the columns with, if any
+        :type table: str
         :rtype: str
         """
-        return ", ".join(["id", "text", "time", "is_interactive", 
-            "is_suspicious", "search_type", "earliest_event", "latest_event", 
-            "range", "is_realtime", "splunk_search_id", "execution_time", 
-            "saved_search_name", "user_id", "session_id"]) 
+        if table is None:
+            return ", ".join(QUERY_COLUMNS)
+        return ", ".join(["%s.%s AS %s" % (table, c, c) for c in QUERY_COLUMNS])
 
-    def _form_query_from_data(self, row, parsed):
+    def _form_query_from_data(self, row, parsed, columns=None):
         """Create a query from a row from the query table.
 
         :param self: The current object
@@ -310,11 +717,15 @@ class Database(DataSource):
         :type row: dict
         :param parsed: Whether or not the row contains parsetree data 
         :type parsed: bool
+        :param columns: The columns of the row to copy onto the query (defaults to all of them)
+        :type columns: list
         :rtype: queryutils.query.Query
         """
-        d = { k:row[k] for k in row.keys() }
+        if columns is None:
+            columns = row.keys()
+        d = { k:row[k] for k in columns }
         q = Query(row["text"], row["time"])
-        q.__dict__.update(d)
+        q.update(d)
         if parsed:
             q.parsetree = ParseTreeNode.loads(row["parsetree"])
         return q
@@ -330,13 +741,12 @@ class Database(DataSource):
         :type parsed: bool
         :rtype: generator
         """
-        self.connect()
-        queries_select = self._query_columns_string()
+        queries_select = self._query_columns_string("queries")
         parsetree_select = ", parsetree"
         select_stmt = "SELECT " + queries_select
         select_stmt = [select_stmt + parsetree_select] if parsed else [select_stmt]
         from_stmt = ["FROM queries, parsetrees"] if parsed else ["FROM queries"]
-        parsetree_where = "id=parsetrees.query_id"
+        parsetree_where = "queries.id=parsetrees.query_id"
         interactive_where = "is_interactive=%s" % self.wildcard
         where_stmt = []
         if parsed or querytype != QueryType.ALL:
@@ -349,16 +759,26 @@ class Database(DataSource):
             where_stmt.append(interactive_where)
         stmt = " ".join(select_stmt + from_stmt + where_stmt)
         if querytype == QueryType.ALL:
-            cursor = self.execute(stmt)
+            rows = self.stream(stmt)
         elif querytype == QueryType.INTERACTIVE:
-            cursor = self.execute(stmt, (True,))
+            rows = self.stream(stmt, (True,))
         elif querytype == QueryType.SCHEDULED:
-            cursor = self.execute(stmt, (False,))
+            rows = self.stream(stmt, (False,))
         else:
             raise RuntimeError("Invalid querytype: %s" % querytype)
-        for row in cursor.fetchall():
+        for row in rows:
             yield self._form_query_from_data(row, parsed)
-        self.close()
+
+    def get_interactive_queries(self, parsed=False):
+        """A generator over all the interactive queries from the database.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param parsed: Whether or not to return the parsetree for the query too
+        :type parsed: bool
+        :rtype: generator
+        """
+        return self.get_queries(querytype=QueryType.INTERACTIVE, parsed=parsed)
 
     def get_query_in_session(self, sid, parsed=False, bad=False):
         """A generator that returns all the queries from the given session.
@@ -369,48 +789,32 @@ class Database(DataSource):
         :type sid: int
         :param parsed: Whether to return the parsed version of the queries
         :type parsed: bool
-        :param bad: Whether to return "bad" (mislabeled as interactive) queries 
+        :param bad: Whether the session is one of the "bad" sessions (of queries mislabeled as interactive)
         :type bad: bool
         :rtype: generator
         """
-        self.connect()
-        session_col = ""
-        table = "queries"
-        where = ""
-        tree_col = ""
-        if bad:
-            session_col = ", bad_session_id"
+        column = "bad_session_id" if bad else "session_id"
         if parsed:
-            table = "queries, parsetrees"
-            where = "id = parsetrees.query_id AND"
-            tree_col = ", parsetree"
-        sql = "SELECT " + self._query_columns_string() + "%s \
-                    FROM %s WHERE %s session_id=%s" 
-        sql = sql % (session_col, tree_col, table, where, self.wildcard)
-        qcursor = self.execute(sql, (sid,))
-        for row in qcursor.fetchall():
+            sql = "SELECT " + self._query_columns_string("queries") + ", parsetree \
+                    FROM queries, parsetrees \
+                    WHERE queries.id = parsetrees.query_id AND queries.%s = %s" % (column, self.wildcard)
+        else:
+            sql = "SELECT " + self._query_columns_string() + " \
+                    FROM queries WHERE %s = %s" % (column, self.wildcard)
+        for row in self.stream(sql, (sid,)):
             yield self._form_query_from_data(row, parsed)
-        self.close()
 
     def get_query_from_user(self, uid, parsed=False):
-        self.connect()
-        if parsed: # TODO: Replace with "SELECT *..."?
-            qcursor = self.execute("SELECT id, text, time, is_interactive, is_suspicious, search_type, \
-                            earliest_event, latest_event, range, is_realtime, \
-                            splunk_search_id, execution_time, saved_search_name, \
-                            user_id, session_id, parsetree \
+        if parsed:
+            rows = self.stream("SELECT " + self._query_columns_string("queries") + ", parsetree \
                             FROM queries, parsetrees \
-                            WHERE id = parsetrees.query_id AND user_id = " + self.wildcard, (uid,))
+                            WHERE queries.id = parsetrees.query_id AND user_id = " + self.wildcard, (uid,))
         else:
-            qcursor = self.execute("SELECT id, text, time, is_interactive, is_suspicious, search_type, \
-                            earliest_event, latest_event, range, is_realtime, \
-                            splunk_search_id, execution_time, saved_search_name, \
-                            user_id, session_id \
+            rows = self.stream("SELECT " + self._query_columns_string() + " \
                             FROM queries \
                             WHERE user_id = " + self.wildcard, (uid,))
-        for row in qcursor.fetchall():
+        for row in rows:
             yield self._form_query_from_data(row, parsed)
-        self.close()
 
     def get_interactive_queries_with_text(self, text, parsed=False):
         """Get all interactive queries that match the given text.
@@ -423,20 +827,18 @@ class Database(DataSource):
         :type parsed: bool
         :rtype: generator
         """
-        self.connect()
-        qcursor = self.execute("SELECT id, text, time, is_interactive, is_suspicious, search_type, \
+        rows = self.stream("SELECT id, text, time, is_interactive, is_suspicious, search_type, \
                         earliest_event, latest_event, range, is_realtime, \
                         splunk_search_id, execution_time, saved_search_name, \
                         user_id, session_id \
                         FROM queries \
                         WHERE is_interactive=%s AND text=%s" % (self.wildcard, self.wildcard), (True, text))
         iter = 0
-        for row in qcursor.fetchall():
+        for row in rows:
             yield self._form_query_from_data(row, parsed)
             if iter % 10 == 0:
                 logger.debug("Returned %d queries with text '%s.'" % (iter,text))
             iter += 1
-        self.close()
 
     def get_parsetrees(self):
         """Return the parsed queries from the parsetree table. 
@@ -445,21 +847,22 @@ class Database(DataSource):
         :type self: queryutils.databases.Database
         :rtype: generator
         """
-        self.connect()
-        cursor = self.execute("SELECT parsetree, query_id FROM parsetrees")
-        for row in cursor.fetchall():
+        for row in self.stream("SELECT parsetree, query_id FROM parsetrees"):
             try:
                 p = ParseTreeNode.loads(row["parsetree"])
                 p.query_id = row["query_id"]
                 yield p
-            except ValueError as e:
-                print e
-                print parsetree
-        self.close()
+            except ValueError:
+                logger.exception("Failed to load parsetree of query: %s" % row["query_id"])
     
     def get_sessions(self, parsed=False, bad=False):
         """Return all the sessions
 
+        The sessions are read in one scan of the query table ordered by
+        session and time, and each session is yielded as soon as its last
+        query has been read. Only sessions with more than one query are
+        returned.
+
         :param self: The current object
         :type self: queryutils.databases.Database
         :param parsed: Whether to return the parsed version of the queries
@@ -468,23 +871,44 @@ class Database(DataSource):
         :type bad: bool
         :rtype: generator
         """
-        self.connect()
-        sessions = {}
-        for user in self.get_users():
-            for session in self.get_session_from_user(user.id, bad=bad):
-                sessions[session.id] = session
+        table = "sessions"
+        column = "session_id"
+        if bad:
+            table = "bad_sessions"
+            column = "bad_session_id"
+        select = "SELECT " + self._query_columns_string("queries") + ", \
+                queries.%s AS sid, %s.session_type AS session_type, \
+                users.name AS user_name, users.case_id AS user_case_id, \
+                users.user_type AS user_user_type" % (column, table)
+        tables = "FROM queries JOIN users ON users.id = queries.user_id \
+                LEFT JOIN %s ON %s.id = queries.%s" % (table, table, column)
+        if parsed:
+            select += ", parsetrees.parsetree AS parsetree"
+            tables += " JOIN parsetrees ON parsetrees.query_id = queries.id"
+        where = "WHERE queries.%s IS NOT NULL" % column
+        order = "ORDER BY queries.%s, queries.time, queries.id" % column
+        columns = QUERY_COLUMNS + ["parsetree"] if parsed else QUERY_COLUMNS
+        user = None
+        session = None
+        for row in self.stream(" ".join([select, tables, where, order])):
+            if session is None or session.id != row["sid"]:
+                if session is not None and len(session.queries) > 1:
+                    yield session
+                if user is None or user.id != row["user_id"]:
+                    user = User(row["user_name"])
+                    user.id = row["user_id"]
+                    user.case_id = row["user_case_id"]
+                    user.user_type = row["user_user_type"]
+                session = Session(row["sid"], row["user_id"])
+                session.session_type = row["session_type"]
                 user.sessions[session.id] = session
-                for query in self.get_query_in_session(session.id, parsed=parsed, bad=bad):
-                    query.session = session
-                    query.user = user
-                    if session is not None:
-                        session.queries.append(query)
-                    user.queries.append(query)
-        for session in sessions.itervalues():
-            session.queries = sorted(session.queries, key=lambda x: x.time)
-            if len(session.queries) > 1:
-                yield session
-        self.close()
+            query = self._form_query_from_data(row, parsed, columns=columns)
+            query.session = session
+            query.user = user
+            session.queries.append(query)
+            user.queries.append(query)
+        if session is not None and len(session.queries) > 1:
+            yield session
 
     def get_session_from_user(self, uid, bad=False):
         """Generator that returns the sessions from the user with the given ID. 
@@ -497,19 +921,16 @@ class Database(DataSource):
         :type bad: bool
         :rtype: generator
         """
-        self.connect()
         table = "sessions"
         if bad:
             table = "bad_sessions"
         sql = "SELECT id, user_id, session_type FROM %s \
                 WHERE user_id=%s" % (table, self.wildcard)
-        scursor = self.execute(sql, (uid,))
-        for row in scursor.fetchall():
+        for row in self.stream(sql, (uid,)):
             d = { k:row[k] for k in row.keys() }
             session = Session(row["id"], row["user_id"])
-            session.__dict__.update(d)
+            session.update(d)
             yield session
-        self.close()
 
     def mark_suspicious_users(self):
         """Mark the users that are probably machine or system users.
@@ -521,39 +942,109 @@ class Database(DataSource):
         :rtype: None
         """
         sql = "UPDATE users SET user_type=%s WHERE id=%s" % (self.wildcard, self.wildcard)
-        self.connect()
-        for user in self.get_users():
-            if user.name in SUSPICIOUS_USER_NAMES:
-                self.execute(sql, ("suspicious", user.id))
-                self.commit()
-        self.close()
+        with self.connected():
+            for user in self.get_users():
+                if user.name in SUSPICIOUS_USER_NAMES:
+                    self.execute(sql, ("suspicious", user.id))
+                    self.commit()
+
+    def mark_suspicious_queries(self, thresholds=SUSPICIOUS_QUERY_THRESHOLDS, use_query_groups=False,
+            batch_size=METRICS_BATCH_SIZE):
+        """Mark the queries that are probably not issued by people.
+
+        Queries mentioning "typeahead" are always marked. If `use_query_groups`
+        is True, queries whose copies by the same user arrive too regularly, or
+        which are issued by too many distinct users, are marked too. The
+        interarrival metrics for these are computed `batch_size` query groups
+        at a time with queryutils.query.interarrival_metrics.
 
-    def mark_suspicious_queries(self, thresholds=SUSPICIOUS_QUERY_THRESHOLDS):
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param thresholds: The maximum allowed values of the query group metrics
+        :type thresholds: dict
+        :param use_query_groups: Whether to also mark queries by their query group metrics
+        :type use_query_groups: bool
+        :param batch_size: The number of query groups to compute the metrics of at a time
+        :type batch_size: int
+        :rtype: None
+        """
         sql = "UPDATE queries SET is_suspicious=true WHERE id=%s" % self.wildcard
-        self.connect()
-        #for query_group in self.get_query_groups():
-        #    high_consistency = query_group.interarrival_consistency() > thresholds["interarrival_consistency_max"]
-        #    high_clockness = query_group.interarrival_clockness() > thresholds["interarrival_clockness_max"]
-        #    high_user_count = query_group.number_of_distinct_users() > thresholds["distinct_users_max"]
-        #    if high_consistency or high_clockness or high_user_count:
-        #        self.execute(sql, (query_group.query.id,))
-        #        self.commit()
-        for query in self.get_queries():
-            if query.text.find("typeahead") > -1:
-                logger.debug("Marking suspicious: %s" % query.text)
-                self.execute(sql, (query.id,))
-                self.commit()
-            else:
-                logger.debug("Not marking: %s" % query.text)
-        self.close()
+        with self.connected():
+            if use_query_groups:
+                batch = []
+                for query_group in self.get_query_groups():
+                    batch.append(query_group)
+                    if len(batch) >= batch_size:
+                        self._mark_suspicious_query_groups(sql, batch, thresholds)
+                        batch = []
+                if batch:
+                    self._mark_suspicious_query_groups(sql, batch, thresholds)
+            for query in self.get_queries():
+                if query.text.find("typeahead") > -1:
+                    logger.debug("Marking suspicious: %s" % query.text)
+                    self.execute(sql, (query.id,))
+                    self.commit()
+                else:
+                    logger.debug("Not marking: %s" % query.text)
+
+    def _mark_suspicious_query_groups(self, sql, query_groups, thresholds):
+        """Mark the queries of the given groups whose metrics exceed the thresholds.
 
-    def sessionize_queries(self, remove_suspicious=False):
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param sql: The statement marking a query suspicious
+        :type sql: str
+        :param query_groups: The query groups to check
+        :type query_groups: list
+        :param thresholds: The maximum allowed values of the query group metrics
+        :type thresholds: dict
+        :rtype: None
+        """
+        # Groups of the same text share their copies, so the metrics only
+        # need computing once per text and user, and the user count once per text.
+        representatives = {}
+        user_counts = {}
+        for query_group in query_groups:
+            key = (id(query_group.copies), query_group.query.user_id)
+            representatives.setdefault(key, query_group)
+            if id(query_group.copies) not in user_counts:
+                user_counts[id(query_group.copies)] = query_group.number_of_distinct_users()
+        keys = representatives.keys()
+        intervals, offsets = interarrival_arrays([representatives[k] for k in keys])
+        _, consistency, clockness = interarrival_metrics(intervals, offsets)
+        rows = { k: idx for (idx, k) in enumerate(keys) }
+        suspicious = []
+        for query_group in query_groups:
+            idx = rows[(id(query_group.copies), query_group.query.user_id)]
+            high_consistency = consistency[idx] > thresholds["interarrival_consistency_max"]
+            high_clockness = clockness[idx] > thresholds["interarrival_clockness_max"]
+            high_user_count = user_counts[id(query_group.copies)] > thresholds["distinct_users_max"]
+            if high_consistency or high_clockness or high_user_count:
+                suspicious.append((query_group.query.id,))
+        logger.debug("Marking %d of %d query groups suspicious." % (len(suspicious), len(query_groups)))
+        if suspicious:
+            self.executemany(sql, suspicious)
+            self.commit()
+
+    def sessionize_queries(self, threshold=NEW_SESSION_THRESH_SECS, remove_suspicious=False, in_database=False):
         """Form sessions from queries and update the session and query tables.
 
+        If `in_database` is True, the sessions are formed by the database
+        itself with window functions over each user's queries ordered by time,
+        instead of pulling every user and query into Python and writing each
+        session and query back one at a time. Any sessions already formed are
+        replaced. Both modes number sessions from zero in order of user and
+        then time, and start a new session whenever the time since a user's
+        previous query exceeds the threshold.
+
         :param self: The current object
         :type self: queryutils.databases.Database
+        :param threshold: The number of seconds between queries that starts a new session
+        :type threshold: float
         :param remove_suspicious: Don't include suspicious queries in sessions
         :type remove_suspicious: bool
+        :param in_database: Whether to form the sessions inside the database
+        :type in_database: bool
         :rtype: None
         """
         table = "sessions"
@@ -561,51 +1052,182 @@ class Database(DataSource):
         if not remove_suspicious:
             table = "bad_sessions"
             column = "bad_session_id"
+        if in_database:
+            self._sessionize_queries_in_database(table, column, threshold, remove_suspicious)
+            return
         insert_sql = "INSERT INTO %s (id, user_id) VALUES (%s, %s)" % (table, self.wildcard, self.wildcard)
         update_sql = "UPDATE queries SET %s=%s WHERE id=%s" % (column, self.wildcard, self.wildcard)
-        self.connect()
-        sid = 0
-        for user in self.get_users_with_queries():
-            self.extract_sessions_from_user(user, remove_suspicious=remove_suspicious)
-            for (_, session) in user.sessions.iteritems():
-                self.execute(insert_sql, (sid, user.id))
-                logger.debug("Inserted session %s" % sid)
-                self.commit()
-                for query in session.queries:
-                    self.execute(update_sql, (sid, query.id))
+        with self.connected():
+            sid = 0
+            for user in self.get_users_with_queries():
+                self.extract_sessions_from_user(user, remove_suspicious=remove_suspicious, threshold=threshold)
+                for (_, session) in user.sessions.iteritems():
+                    self.execute(insert_sql, (sid, user.id))
+                    logger.debug("Inserted session %s" % sid)
                     self.commit()
-                sid += 1
-        self.close()
+                    for query in session.queries:
+                        self.execute(update_sql, (sid, query.id))
+                        self.commit()
+                    sid += 1
+
+    def _sessionize_queries_in_database(self, table, column, threshold, remove_suspicious):
+        """Form sessions with window functions and update the given session table and query column.
+
+        :param self: The current object
+        :type self: queryutils.databases.Database
+        :param table: The session table to fill
+        :type table: str
+        :param column: The query column to set to each query's session
+        :type column: str
+        :param threshold: The number of seconds between queries that starts a new session
+        :type threshold: float
+        :param remove_suspicious: Don't include suspicious queries in sessions
+        :type remove_suspicious: bool
+        :rtype: None
+        """
+        values = {
+            "table": table,
+            "column": column,
+            "threshold": float(threshold),
+            "filter": queryutils.sql.SESSIONIZE_REMOVE_SUSPICIOUS if remove_suspicious else ""
+        }
+        with self.connected():
+            for query in queryutils.sql.SESSIONIZE_QUERIES:
+                query = query % values
+                logger.debug("Executing \n%s" % query)
+                self.execute(query)
+            self.commit()
+
+class CopyBuffers(object):
+    """Holds rows waiting to be copied into Postgres, one buffer per table.
+
+    Rows are encoded in the COPY text format: columns are separated by tabs,
+    NULL is written as \\N, and backslashes, tabs, newlines and carriage
+    returns inside values are escaped with a backslash.
+    """
+
+    def __init__(self):
+        """Create an empty set of buffers.
+
+        :param self: The object being created
+        :type self: queryutils.databases.CopyBuffers
+        :rtype: queryutils.databases.CopyBuffers
+        """
+        self.clear()
+
+    def clear(self):
+        """Empty the buffers.
+
+        :param self: The current object
+        :type self: queryutils.databases.CopyBuffers
+        :rtype: None
+        """
+        self.buffers = { table: StringIO() for table in COPY_COLUMNS }
+        self.nrows = 0
+
+    def write(self, table, row):
+        """Encode the given row and append it to the buffer for the table.
+
+        :param self: The current object
+        :type self: queryutils.databases.CopyBuffers
+        :param table: The table the row belongs to
+        :type table: str
+        :param row: The column values, in the order given by COPY_COLUMNS
+        :type row: tuple
+        :rtype: None
+        """
+        self.buffers[table].write("\t".join([copy_value(v) for v in row]) + "\n")
+        self.nrows += 1
+
+
+def copy_value(value):
+    """Encode a single value in the Postgres COPY text format.
+
+    :param value: The value to encode
+    :type value: None, bool, int, float, str or unicode
+    :rtype: str
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return value.replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n").replace("\r", "\\r")
+
 
 class PostgresDB(Database):
     """Representes a Postgres database that stores query data.
     """
 
-    def __init__(self, database, user, password):
+    def __init__(self, database, user, password, fetch_size=FETCH_SIZE, pool_size=None):
         """Create a PostgresDB object.
 
+        If a pool size is given, connections are taken from and returned to
+        a pool of at most that many connections instead of being opened and
+        closed each time.
+
         :param self: The object being created
         :type self: queryutils.databases.PostgresDB
         :param path: The path to the data to load
         :type path: str
+        :param fetch_size: The number of rows to fetch at a time when streaming results
+        :type fetch_size: int
+        :param pool_size: The maximum number of pooled connections, if any
+        :type pool_size: int
         :rtype: queryutils.databases.PostgresDB
         """
         self.database = database
         self.user = user
         self.password = password
-        super(PostgresDB, self).__init__("%s", "postgres")
+        self.ncursors = 0
+        self.pool_size = pool_size
+        self.pool = None
+        super(PostgresDB, self).__init__("%s", "postgres", fetch_size=fetch_size)
 
-    def connect(self):
-        """Connect to the database object.
+    def _open_connection(self):
+        """Open a new connection to the database, or take one from the pool.
 
-        :param self: The object being created
+        :param self: The current object
+        :type self: queryutils.databases.PostgresDB
+        :rtype: psycopg2._psycopg.connection
+        """
+        if self.pool_size is None:
+            return psycopg2.connect(database=self.database, user=self.user, password=self.password)
+        if self.pool is None:
+            self.pool = ThreadedConnectionPool(1, self.pool_size,
+                database=self.database, user=self.user, password=self.password)
+        return self.pool.getconn()
+
+    def _release_connection(self, connection):
+        """Close the given connection, or return it to the pool.
+
+        :param self: The current object
         :type self: queryutils.databases.PostgresDB
+        :param connection: The connection to release
+        :type connection: psycopg2._psycopg.connection
         :rtype: None
         """
-        if self.connection is not None:
-            return self.connection
-        self.connection = psycopg2.connect(database=self.database, user=self.user, password=self.password)
-        return self.connection
+        if self.pool is None:
+            connection.close()
+        else:
+            self.pool.putconn(connection)
+
+    def close_pool(self):
+        """Close all of the pooled connections.
+
+        :param self: The current object
+        :type self: queryutils.databases.PostgresDB
+        :rtype: None
+        """
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
 
     def execute(self, query, *params):
         """Execute the given query against the current database.
@@ -618,41 +1240,181 @@ class PostgresDB(Database):
         :type params: tuple
         :rtype: psycopg2._psycopg.cursor
         """
-        if self.connection is None:
-            self.connect()
+        self._ensure_connection()
         cursor = self.connection.cursor(cursor_factory=RealDictCursor)
         cursor.execute(query, *params)
         return cursor
 
+    def executemany(self, query, params):
+        """Execute the given query once for each set of parameters.
+
+        :param self: The object being created
+        :type self: queryutils.databases.PostgresDB
+        :param query: The query to execute
+        :type query: str
+        :param params: The parameters to the query, one tuple per execution
+        :type params: list
+        :rtype: psycopg2._psycopg.cursor
+        """
+        self._ensure_connection()
+        cursor = self.connection.cursor(cursor_factory=RealDictCursor)
+        cursor.executemany(query, params)
+        return cursor
+
+    def _fetch_rows(self, query, *params):
+        """Execute the given query with a server-side cursor and yield its rows.
+
+        The cursor is named, so Postgres keeps the result set on the server
+        and sends it `fetch_size` rows at a time. It is declared WITH HOLD so
+        that it survives commits made while its rows are being consumed.
+
+        :param self: The current object
+        :type self: queryutils.databases.PostgresDB
+        :param query: The query to execute
+        :type query: str
+        :param params: The parameters to the query
+        :type params: tuple
+        :rtype: generator
+        """
+        self.ncursors += 1
+        name = "queryutils_cursor_%d" % self.ncursors
+        cursor = self.connection.cursor(name, cursor_factory=RealDictCursor, withhold=True)
+        cursor.itersize = self.fetch_size
+        try:
+            cursor.execute(query, *params)
+            for row in cursor:
+                yield row
+        finally:
+            if not cursor.closed:
+                cursor.close()
+
+    def copy_users_and_queries(self, src, parsed=False, processes=None, chunk_size=CHUNK_SIZE,
+            batch_size=COPY_BATCH_SIZE):
+        """Load the user, query and parsetree tables from a source using COPY.
+
+        Rows are written in Postgres' COPY text format to in-memory buffers
+        that are streamed to the server with COPY ... FROM STDIN once roughly
+        `batch_size` rows have accumulated, and committed once per batch.
+        If `parsed` is True, each query is also parsed (or its existing
+        parsetree used, if the source provides one) and loaded into the
+        parsetree table; the queries are parsed by a pool of worker
+        processes, `chunk_size` at a time, if a number of processes is given
+        (see queryutils.parallel.parse_queries). The ID sequences are advanced past the loaded IDs
+        once the load finishes.
+
+        :param self: The current object
+        :type self: queryutils.databases.PostgresDB
+        :param src: The source to load users and queries from
+        :type src: queryutils.source.DataSource
+        :param parsed: Whether or not to load parsetrees too
+        :type parsed: bool
+        :param processes: The number of processes to parse the queries with, if more than one
+        :type processes: int
+        :param chunk_size: The number of queries to send to a worker process at a time
+        :type chunk_size: int
+        :param batch_size: The approximate number of rows to copy per commit
+        :type batch_size: int
+        :rtype: int
+        """
+        with src.connected(), self.connected():
+            buffers = CopyBuffers()
+            start = time()
+
+            # The user and query rows are buffered, and the buffers copied, as the
+            # queries are read, which may be a few chunks ahead of the parsed
+            # results. Only the queries without a parsetree are yielded to parse.
+            copied = []
+            def unparsed_queries():
+                uid = qid = 1
+                for user in src.get_users_with_queries():
+                    buffers.write("users", self._user_row(user, uid))
+                    for query in user.queries:
+                        buffers.write("queries", self._query_row(query, qid, uid, None))
+                        if parsed and query.parsetree is not None:
+                            buffers.write("parsetrees", (query.parsetree.dumps(), qid))
+                        elif parsed:
+                            yield (qid, query.text)
+                        qid += 1
+                    uid += 1
+                    if buffers.nrows >= batch_size:
+                        copied.append(self._copy_buffers(buffers))
+                        self._log_load_rate(sum(copied), start)
+                        buffers.clear()
+
+            if parsed:
+                results = parse_queries(unparsed_queries(), processes=processes, chunk_size=chunk_size)
+            else:
+                results = unparsed_queries()
+            for (qid, dumped, error) in results:
+                if dumped is not None:
+                    buffers.write("parsetrees", (dumped, qid))
+            nrows = sum(copied)
+            nrows += self._copy_buffers(buffers)
+            self._log_load_rate(nrows, start)
+            self._sync_id_sequences(["users", "queries", "parsetrees"])
+        return nrows
+
+    def _sync_id_sequences(self, tables):
+        """Set the ID sequences of the given tables to the largest ID in each.
+
+        :param self: The current object
+        :type self: queryutils.databases.PostgresDB
+        :param tables: The tables rows were loaded into with explicit IDs
+        :type tables: list
+        :rtype: None
+        """
+        for table in tables:
+            self.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), \
+                (SELECT MAX(id) FROM %s))" % (table, table))
+        self.commit()
+
+    def _copy_buffers(self, buffers):
+        """Copy the buffered rows into their tables and commit them together.
+
+        :param self: The current object
+        :type self: queryutils.databases.PostgresDB
+        :param buffers: The buffered rows to copy
+        :type buffers: queryutils.databases.CopyBuffers
+        :rtype: int
+        """
+        cursor = self.connection.cursor()
+        for table in ["users", "queries", "parsetrees"]:
+            data = buffers.buffers[table]
+            if data.tell() > 0:
+                data.seek(0)
+                cursor.copy_from(data, table, sep="\t", null="\\N", columns=COPY_COLUMNS[table])
+        self.commit()
+        return buffers.nrows
+
 
 class SQLite3DB(Database):
     """Representes a SQLite database that stores query data.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, fetch_size=FETCH_SIZE):
         """Create a SQLite3DB object.
 
         :param self: The object being created
         :type self: queryutils.databases.SQLite3DB
         :param path: The path to the data to load
         :type path: str
+        :param fetch_size: The number of rows to fetch at a time when streaming results
+        :type fetch_size: int
         :rtype: queryutils.databases.SQLite3DB
         """
         self.path = path
-        super(SQLite3DB, self).__init__("?", "sqlite3")
+        super(SQLite3DB, self).__init__("?", "sqlite3", fetch_size=fetch_size)
 
-    def connect(self):
-        """Connect to the database object.
+    def _open_connection(self):
+        """Open a new connection to the database.
 
-        :param self: The object being created
+        :param self: The current object
         :type self: queryutils.databases.SQLite3DB
-        :rtype: None
+        :rtype: sqlite3.Connection
         """
-        if self.connection is not None:
-            return self.connection
-        self.connection = sqlite3.connect(self.path)
-        self.connection.row_factory = sqlite3.Row
-        return self.connection
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        return connection
 
     def execute(self, query, *params):
         """Execute the given query against the current database.
@@ -665,8 +1427,84 @@ class SQLite3DB(Database):
         :type params: tuple
         :rtype: sqlite3.Connection
         """
-        if not self.connection:
-            self.connect()
+        self._ensure_connection()
         cursor = self.connection.cursor()
         cursor.execute(query, *params)
         return cursor
+
+    def executemany(self, query, params):
+        """Execute the given query once for each set of parameters.
+
+        :param self: The object being created
+        :type self: queryutils.databases.SQLite3DB
+        :param query: The query to execute
+        :type query: str 
+        :param params: The parameters to the query, one tuple per execution
+        :type params: list
+        :rtype: sqlite3.Cursor
+        """
+        self._ensure_connection()
+        cursor = self.connection.cursor()
+        cursor.executemany(query, params)
+        return cursor
+
+    def _fetch_rows(self, query, *params):
+        """Execute the given query and yield its rows `fetch_size` at a time.
+
+        :param self: The current object
+        :type self: queryutils.databases.SQLite3DB
+        :param query: The query to execute
+        :type query: str
+        :param params: The parameters to the query
+        :type params: tuple
+        :rtype: generator
+        """
+        cursor = self.execute(query, *params)
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield row
+
+    def begin_fast_load(self):
+        """Prepare the database for a bulk load.
+
+        This switches the connection to WAL journaling, relaxed syncing, a
+        large page cache and in-memory temporary storage, and drops the
+        secondary indices so they are rebuilt once at the end of the load
+        instead of being updated on every insert.
+
+        :param self: The current object
+        :type self: queryutils.databases.SQLite3DB
+        :rtype: None
+        """
+        self.connect()
+        try:
+            self.commit()
+            for pragma in queryutils.sql.SQLITE3_FAST_LOAD_PRAGMAS:
+                self.execute(pragma)
+            for (index, _, _) in queryutils.sql.SECONDARY_INDICES:
+                self.execute("DROP INDEX IF EXISTS %s" % index)
+            self.commit()
+        except:
+            self.close()
+            raise
+
+    def end_fast_load(self):
+        """Rebuild the secondary indices and restore the default settings.
+
+        :param self: The current object
+        :type self: queryutils.databases.SQLite3DB
+        :rtype: None
+        """
+        try:
+            self.commit()
+            for (index, table, column) in queryutils.sql.SECONDARY_INDICES:
+                logger.debug("Building index %s." % index)
+                self.execute("CREATE INDEX IF NOT EXISTS %s ON %s(%s)" % (index, table, column))
+            self.commit()
+            for pragma in queryutils.sql.SQLITE3_SAFE_PRAGMAS:
+                self.execute(pragma)
+        finally:
+            self.close()
@@ -1,7 +1,11 @@
 from logging import getLogger as get_logger
 from os.path import isfile, isdir
+from queryutils.cache import Cache
+from queryutils.checkpoint import get_new_users_from_files
 from queryutils.session import Session
+from queryutils.parallel import CHUNK_SIZE, parse_queries
 from queryutils.parse import parse_query
+from splparser.parsetree import ParseTreeNode
 from queryutils.versions import Version
 from queryutils.source import DataSource
 
@@ -13,7 +17,7 @@ class Files(DataSource):
     """Represents a source storing Splunk queries.
     """
 
-    def __init__(self, path, module, version):
+    def __init__(self, path, module, version, processes=None, cache=False, cache_dir=None):
         """Create a File object for accessing Splunk queries.
 
         This should never be called directly. Instead, call the subclasses
@@ -27,11 +31,19 @@ class Files(DataSource):
         :type module: module
         :param version: The format the Splunk queries are in
         :type version: str (one of the attributes of queryutils.Version)
+        :param processes: The number of processes to read a directory of files with, if more than one
+        :type processes: int
+        :param cache: Whether to cache the queries read from each file (see queryutils.cache.Cache)
+        :type cache: bool
+        :param cache_dir: The directory in which to put the caches, or None to put each next to its file
+        :type cache_dir: str
         :rtype: Files 
         """
         self.path = path
         self.module = module
         self.version = version
+        self.processes = processes
+        self.cache = Cache(version, directory=cache_dir) if cache else None
         super(Files, self).__init__()
 
     def connect(self):
@@ -52,31 +64,69 @@ class Files(DataSource):
         for user in self.get_users_with_queries():
             yield user
 
-    def get_queries(self):
+    def get_queries(self, fields=None):
         """Return a generator that yields queries from the current source.
+
+        If a list of fields is given, only those columns are decoded from
+        .csv files (see queryutils.csvparser.read_rows), and the rest of each
+        query's attributes are None.
         
         :param self: The current object
         :type self: File
+        :param fields: The columns to read, if not all of them
+        :type fields: list
         :rtype: generator
         """
         count = 0
-        for user in self.get_users_with_queries():
+        for user in self.get_users_with_queries(fields=fields):
             for query in user.queries:
                 query.query_id = count
                 yield query
                 count += 1
 
-    def get_parsetrees(self):
+    def get_interactive_queries(self, parsed=False):
+        """Return a generator that yields interactive queries from the current source.
+
+        Since the files have no user IDs, each query's `user_id` is set to the
+        name of its user.
+
+        :param self: The current object
+        :type self: File
+        :param parsed: Whether to return only the queries that parse, with their parsetrees
+        :type parsed: bool
+        :rtype: generator
+        """
+        count = 0
+        for user in self.get_users_with_queries():
+            self.remove_noninteractive_queries_by_search_type(user, version=self.version)
+            for query in user.interactive_queries:
+                query.id = query.query_id = count
+                query.user_id = user.name
+                count += 1
+                if parsed:
+                    query.parsetree = parse_query(query.text)
+                    if query.parsetree is None:
+                        continue
+                yield query
+
+    def get_parsetrees(self, chunk_size=CHUNK_SIZE):
         """Return a generator that yields parsetrees from the current source.
 
+        If the source was created with a number of processes, the queries
+        are parsed by a pool of that many worker processes, `chunk_size` at
+        a time (see queryutils.parallel.parse_queries).
+
         :param self: The current object
         :type self: File
+        :param chunk_size: The number of queries to send to a worker process at a time
+        :type chunk_size: int
         :rtype: generator
         """
-        for query in self.get_queries():
-            parsetree = parse_query(query)
-            if parsetree:
-                parsetree.query_id = query.query_id
+        queries = ((query.query_id, query.text) for query in self.get_queries())
+        for (qid, dumped, error) in parse_queries(queries, processes=self.processes, chunk_size=chunk_size):
+            if dumped is not None:
+                parsetree = ParseTreeNode.loads(dumped)
+                parsetree.query_id = qid
                 yield parsetree
 
     def get_sessions(self):
@@ -98,7 +148,7 @@ class Files(DataSource):
         # TODO: Delete me.
         return [] # TODO: Remove this portion of the code -- bad way to detect this.
 
-    def get_users_with_queries(self):
+    def get_users_with_queries(self, fields=None):
         """Return a generator that yields users from the current source.
         Returns the queries along with the users.
 
@@ -106,18 +156,45 @@ class Files(DataSource):
 
         :param self: The current object
         :type self: File
+        :param fields: The columns to read, if not all of them (see get_queries)
+        :type fields: list
+        :rtype: generator
+        """
+        users = {}
+        if isfile(self.path) and self.cache is not None:
+            self.cache.get_users_from_file(self.module, self.path, users, fields=fields)
+        elif isfile(self.path):
+            self.module.get_users_from_file(self.path, users, fields=fields)
+        elif isdir(self.path):
+            self.module.get_users_from_directory(self.path, users, processes=self.processes, fields=fields,
+                cache=self.cache)
+        else: # TODO: Raise error.
+            print "Non-existent path:", self.path
+            exit()
+        for user in users.values():
+            yield user
+
+    def get_new_users_with_queries(self, checkpoint):
+        """Return a generator that yields the users with queries added since the checkpoint.
+
+        Each user is returned with only its new queries. The checkpoint is
+        advanced past the queries read, but not saved; save it once they
+        have been stored. See queryutils.checkpoint.get_new_users_from_files.
+
+        :param self: The current object
+        :type self: File
+        :param checkpoint: The checkpoint to read from and advance
+        :type checkpoint: queryutils.checkpoint.Checkpoint
         :rtype: generator
         """
-        get_users = None
         users = {}
         if isfile(self.path):
-            get_users = self.module.get_users_from_file
-        if isdir(self.path):
-            get_users = self.module.get_users_from_directory
-        if get_users is None: # TODO: Raise error.
+            get_new_users_from_files(self.module, [self.path], users, checkpoint)
+        elif isdir(self.path):
+            self.module.get_new_users_from_directory(self.path, users, checkpoint)
+        else: # TODO: Raise error.
             print "Non-existent path:", self.path
             exit()
-        get_users(self.path, users)
         for user in users.values():
             yield user
 
@@ -175,7 +252,7 @@ class JSONFiles(Files):
     """Represents a source storing Splunk queries in JSON format.
     """
 
-    def __init__(self, path, version):
+    def __init__(self, path, version, processes=None, cache=False, cache_dir=None):
         """Create a JSONFiles object.
 
         :param self: The object being created
@@ -184,26 +261,75 @@ class JSONFiles(Files):
         :type path: str
         :param version: The format the Splunk queries are in
         :type version: str (one of the attributes of queryutils.Version)
+        :param processes: The number of processes to read a directory of files with, if more than one
+        :type processes: int
+        :param cache: Whether to cache the queries read from each file (see queryutils.cache.Cache)
+        :type cache: bool
+        :param cache_dir: The directory in which to put the caches, or None to put each next to its file
+        :type cache_dir: str
         :rtype: JSONFiles 
         """
         import jsonparser
-        super(JSONFiles, self).__init__(path, jsonparser, version)
+        super(JSONFiles, self).__init__(path, jsonparser, version, processes=processes, cache=cache,
+            cache_dir=cache_dir)
 
 
 class CSVFiles(Files):
     """Represents a source storing Splunk queries in CSV format.
     """
     
-    def __init__(self, path, version):
+    def __init__(self, path, version, ingestion=None, tmpdir=None, processes=None, cache=False, cache_dir=None):
         """Create a CSVFiles object.
 
+        By default, every user is read before any is returned. To hold only
+        one user (or one partition of users) in memory at a time, pass
+        queryutils.csvparser.Ingestion.GROUPED if each user's rows are
+        contiguous, or Ingestion.PARTITIONED otherwise. Files are only cached
+        when every user is read at once.
+
         :param self: The object being created
         :type self: File
         :param path: The path to the given file object
         :type path: str
         :param version: The format the Splunk queries are in
         :type version: str (one of the attributes of queryutils.Version)
+        :param ingestion: How to read the users (one of the attributes of queryutils.csvparser.Ingestion)
+        :type ingestion: str
+        :param tmpdir: The directory in which to partition the users, if partitioning
+        :type tmpdir: str
+        :param processes: The number of processes to read a directory of files with, if more than one
+        :type processes: int
+        :param cache: Whether to cache the queries read from each file (see queryutils.cache.Cache)
+        :type cache: bool
+        :param cache_dir: The directory in which to put the caches, or None to put each next to its file
+        :type cache_dir: str
         :rtype: CSVFiles 
         """
         import csvparser
-        super(CSVFiles, self).__init__(path, csvparser, version)
+        if ingestion is None:
+            ingestion = csvparser.Ingestion.ALL
+        self.ingestion = ingestion
+        self.tmpdir = tmpdir
+        super(CSVFiles, self).__init__(path, csvparser, version, processes=processes, cache=cache,
+            cache_dir=cache_dir)
+
+    def get_users_with_queries(self, fields=None):
+        """Return a generator that yields users from the current source.
+        Returns the queries along with the users.
+
+        :param self: The current object
+        :type self: CSVFiles
+        :param fields: The columns to read, if not all of them (see get_queries)
+        :type fields: list
+        :rtype: generator
+        """
+        if self.ingestion == self.module.Ingestion.ALL:
+            for user in super(CSVFiles, self).get_users_with_queries(fields=fields):
+                yield user
+            return
+        if not isfile(self.path) and not isdir(self.path): # TODO: Raise error.
+            print "Non-existent path:", self.path
+            exit()
+        for user in self.module.iter_users(self.path, ingestion=self.ingestion, tmpdir=self.tmpdir,
+                fields=fields):
+            yield user
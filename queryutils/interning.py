@@ -0,0 +1,67 @@
+from logging import getLogger as get_logger
+
+logger = get_logger("queryutils")
+
+MAX_SIZE = 100000
+
+
+class StringPool(object):
+    """Makes equal strings read by the parsers share one object.
+
+    Query texts, user names and search types repeat heavily (scheduled
+    searches and dashboards run the same query over and over), so returning
+    the string already in the pool for each one read keeps only one copy of
+    each in memory. So that the pool cannot grow without bound when users
+    are streamed, it is emptied once it holds `max_size` strings; strings
+    returned before then are still shared, but later ones are not shared
+    with them.
+    """
+
+    def __init__(self, max_size=MAX_SIZE):
+        """Create an empty StringPool.
+
+        :param self: The object being created
+        :type self: queryutils.interning.StringPool
+        :param max_size: The number of strings at which to empty the pool, or 0 to not share strings
+        :type max_size: int
+        :rtype: queryutils.interning.StringPool
+        """
+        self.max_size = max_size
+        self.strings = {}
+        self.nhits = 0
+        self.nmisses = 0
+
+    def intern(self, string):
+        """Return the string in the pool equal to the given one, adding it if there is none.
+
+        :param self: The current object
+        :type self: queryutils.interning.StringPool
+        :param string: The string, or None
+        :type string: unicode
+        :rtype: unicode
+        """
+        if string is None or self.max_size == 0:
+            return string
+        shared = self.strings.get(string, None)
+        if shared is not None:
+            self.nhits += 1
+            return shared
+        self.nmisses += 1
+        if len(self.strings) >= self.max_size:
+            logger.debug("Emptying string pool of %d strings." % len(self.strings))
+            self.strings.clear()
+        self.strings[string] = string
+        return string
+
+    def decode(self, raw):
+        """Return the given UTF-8 encoded string decoded, from the pool.
+
+        :param self: The current object
+        :type self: queryutils.interning.StringPool
+        :param raw: The encoded string, or None
+        :type raw: str
+        :rtype: unicode
+        """
+        if raw is None:
+            return None
+        return self.intern(unicode(raw.decode("utf-8")))
@@ -1,18 +1,30 @@
-import dateutil.parser
 import json
 import os
 import splparser.parser
+import sys
 
 from user import *
 from query import *
 
 from itertools import chain
+from logging import getLogger as get_logger
+from queryutils.checkpoint import get_new_users_from_files
+from queryutils.compression import estimated_size, has_suffix, open_input
+from queryutils.interning import StringPool
+from queryutils.parallel import get_users_from_files
+from queryutils.timestamps import TimestampDecoder
 from splparser.exceptions import SPLSyntaxError, TerminatingSPLSyntaxError
 
 BYTES_IN_MB = 1048576
+LIMIT = 50*BYTES_IN_MB
+CHUNK_SIZE = BYTES_IN_MB
+JSON_WHITESPACE = " \t\n\r"
+JSON_DELIMITERS = JSON_WHITESPACE + ",]}"
 
-def get_users_from_file(filename):
-    """Return a generator over user objects and their queries from the given file.
+logger = get_logger("queryutils")
+
+def get_users_from_file(filename, users, fields=None, strings=None):
+    """Populate the users dictionary with users and their queries from the given file.
 
     It is assumed that the file will contain a list of results in JSON format.
     Each result is a dictionary with an assumed set of keys.
@@ -20,49 +32,112 @@ def get_users_from_file(filename):
 
     :param filename: The path to the .json file containing the queries
     :type filename: str
-    :rtype: generator
+    :param users: The user dict into which to place the users
+    :type users: dict
+    :param fields: Ignored, since each result is decoded in full; accepted for compatibility with csvparser
+    :type fields: list
+    :param strings: The pool of strings to share with other files, if any
+    :type strings: queryutils.interning.StringPool
+    :rtype: None
     """
-    queries = []
-    users = {}
+    decoder = TimestampDecoder()
+    if strings is None:
+        strings = StringPool()
     for result in splunk_result_iter([filename]):
         if 'user' in result and '_time' in result and 'search' in result:
-            username = result['user']
-            timestamp = float(dateutil.parser.parse(result['_time']).strftime('%s.%f'))
-            query_string = unicode(result['search'].strip())
-            user = User(username)
-            searchtype = result['searchtype']
+            username = strings.intern(result['user'])
+            timestamp = decoder.decode(result['_time'])
+            query_string = strings.intern(unicode(result['search'].strip()))
+            user = users.get(username, None)
+            if user is None:
+                user = User(username)
+                users[username] = user
+            searchtype = strings.intern(result['searchtype'])
             query = Query(query_string, timestamp)
             query.user = user
             query.search_type = searchtype
-            if not username in users:
-                users[username] = user
-            users[username].queries.append(query)
-    # TODO: FIXME: This might cause incorrectness if a user's queries span files. 
-    # For the data we have, this is not an issue, since cases never span files.
-    for user in users.values():
-        yield user
+            user.queries.append(query)
 
-def get_users_from_directory(limit=50*BYTES_IN_MB):
-    """Return a generator over user objects and their queries from the given directory.
+def get_users_from_directory(directory, users, limit=LIMIT, processes=None, fields=None,
+        cache=None):
+    """Populate the users dictionary with users and their queries from the given directory.
 
     The directory is assumed to contain a list of .json files, each of which 
     is assumed to adhere to the format expected by get_users_from_file.
+    If a number of processes is given, the files are read in parallel.
 
+    :param directory: The path to the directory containing the .json files
+    :type directory: str
+    :param users: The user dict into which to place the users
+    :type users: dict
     :param limit: The approximate number of bytes to read in (for testing)
     :type limit: int
-    :rtype: generator
+    :param processes: The number of processes to read the files with, if more than one
+    :type processes: int
+    :param fields: Ignored; accepted for compatibility with csvparser
+    :type fields: list
+    :param cache: The cache to read the files through, if any
+    :type cache: queryutils.cache.Cache
+    :rtype: None
     """
-    raw_data_files = get_json_files(limit=limit)
+    raw_data_files = get_json_files(directory, limit=limit)
+    if processes is not None and processes > 1:
+        get_users_from_files(sys.modules[__name__], raw_data_files, users, processes=processes, fields=fields,
+            cache=cache)
+        return
+    strings = StringPool()
     for f in raw_data_files:
-        for user in get_users_from_file(f):
-            yield user
+        if cache is not None:
+            cache.get_users_from_file(sys.modules[__name__], f, users, fields=fields)
+        else:
+            get_users_from_file(f, users, fields=fields, strings=strings)
+
+def get_new_users_from_file(filename, users, offset=0):
+    """Populate the users dictionary with the queries in the given file, if it hasn't been read.
+
+    A list of results cannot be read from an offset, so the file is read
+    whole when the offset is 0, and otherwise not read at all.
+
+    :param filename: The path to the .json file containing the queries
+    :type filename: str
+    :param users: The user dict into which to place the users
+    :type users: dict
+    :param offset: The byte offset up to which the file has already been read
+    :type offset: int
+    :rtype: int
+    :returns: The byte offset up to which the file has now been read
+    """
+    size = os.path.getsize(filename)
+    if offset > 0:
+        logger.warning("Not reading the changes to .json file " + filename)
+        return size
+    get_users_from_file(filename, users)
+    return size
+
+def get_new_users_from_directory(directory, users, checkpoint, limit=None):
+    """Populate the users dictionary with the queries in the .json files not read before the checkpoint.
+
+    :param directory: The path to the directory containing the .json files
+    :type directory: str
+    :param users: The user dict into which to place the users
+    :type users: dict
+    :param checkpoint: The checkpoint to read from and advance
+    :type checkpoint: queryutils.checkpoint.Checkpoint
+    :param limit: The approximate number of bytes to read in (for testing), or None for all of them
+    :type limit: int
+    :rtype: None
+    """
+    get_new_users_from_files(sys.modules[__name__], get_json_files(directory, limit=limit), users, checkpoint)
 
 def get_json_files(dir, limit=1000*BYTES_IN_MB):
     """Return a list of the full paths to each of the .json files in a directory.
 
+    Compressed .json files (.json.gz, .json.bz2, and .json.xz) are included,
+    and count toward the limit by their estimated uncompressed size.
+
     :param dir: The path to the directory to check
     :type dir: str
-    :param limit: The approximate number of bytes to read in (for testing)
+    :param limit: The approximate number of bytes to read in (for testing), or None for all of them
     :type limit: int
     :rtype: list
     """
@@ -70,11 +145,11 @@ def get_json_files(dir, limit=1000*BYTES_IN_MB):
     bytes_added = 0.
     for (dirpath, dirnames, filenames) in os.walk(dir):
         for filename in filenames:
-            if filename[-5:] == '.json': 
+            if has_suffix(filename, '.json'): 
                 full_filename = os.path.abspath(dir) + '/' + filename
                 json_files.append(full_filename) 
-                bytes_added += os.path.getsize(full_filename)
-                if bytes_added > limit:
+                bytes_added += estimated_size(full_filename)
+                if limit is not None and bytes_added > limit:
                     return json_files
     return json_files
 
@@ -108,11 +183,15 @@ def put_json_files(iterable, prefix, encoder=json.JSONEncoder, limit=10*BYTES_IN
 def load_data_from_json(jsonfile):
     """Load the data contained in a .json file and return the corresponding Python object.
 
+    This reads the whole file into memory; to read the results in a file
+    one at a time, use iter_json_results instead.
+
     :param jsonfile: The path to the .json file
     :type jsonfile: str
     :rtype: list or dict
     """
-    jsondata = open(jsonfile).read()
+    with open_input(jsonfile) as datafile:
+        jsondata = datafile.read()
     data = json.loads(jsondata)
     return data
 
@@ -125,10 +204,123 @@ def load_and_combine_data_from_json(jsonfiles):
     """
     combined_data = []
     for jsonfile in jsonfiles:
-        data = load_data_from_json(jsonfile)
-        combined_data.extend(data)
+        combined_data.extend(iter_json_results(jsonfile))
     return combined_data
 
+def iter_json_results(jsonfile, chunk_size=CHUNK_SIZE):
+    """Yield the results in a .json file one at a time, without reading the whole file.
+
+    The file may contain a JSON array of results, or newline-delimited
+    results (or any other whitespace-separated sequence of JSON values).
+
+    :param jsonfile: The path to the .json file
+    :type jsonfile: str
+    :param chunk_size: The number of bytes to read from the file at a time
+    :type chunk_size: int
+    :rtype: generator
+    """
+    with open_input(jsonfile) as datafile:
+        for value in iter_json_values(datafile, chunk_size=chunk_size):
+            yield value
+
+def iter_json_values(datafile, chunk_size=CHUNK_SIZE):
+    """Yield the values of a JSON array, or of a sequence of JSON values, from a file object.
+
+    The file is read `chunk_size` bytes at a time, and each value is decoded
+    as soon as it has been read in full, so only the value being decoded and
+    the unread part of the current chunk are held in memory.
+
+    :param datafile: The file to read
+    :type datafile: file
+    :param chunk_size: The number of bytes to read at a time
+    :type chunk_size: int
+    :rtype: generator
+    """
+    decoder = json.JSONDecoder()
+    reader = _JSONChunkReader(datafile, chunk_size)
+    if not reader.skip_whitespace():
+        return
+    if reader.peek() != "[":
+        while reader.skip_whitespace():
+            yield reader.decode(decoder)
+        return
+    reader.advance(1)
+    if reader.skip_whitespace() and reader.peek() == "]":
+        return
+    while True:
+        if not reader.skip_whitespace():
+            raise ValueError("Unterminated JSON array in %s" % reader.name)
+        yield reader.decode(decoder)
+        if not reader.skip_whitespace():
+            raise ValueError("Unterminated JSON array in %s" % reader.name)
+        separator = reader.peek()
+        reader.advance(1)
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError("Expected ',' or ']' in %s" % reader.name)
+
+class _JSONChunkReader(object):
+    """Holds the unread part of a JSON file that is read a chunk at a time.
+    """
+
+    def __init__(self, datafile, chunk_size):
+        self.datafile = datafile
+        self.name = getattr(datafile, "name", "<stream>")
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        """Append the next chunk of the file to the buffer, and return False at the end of the file.
+        """
+        if self.eof:
+            return False
+        chunk = self.datafile.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self):
+        """Skip past whitespace, and return False if the end of the file is reached.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in JSON_WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return True
+            if not self.read():
+                return False
+
+    def peek(self):
+        return self.buffer[self.pos]
+
+    def advance(self, n):
+        self.pos += n
+
+    def decode(self, decoder):
+        """Decode the next value, reading more of the file until the value is complete.
+
+        A number is only accepted once the character after it has been read,
+        since it could continue in the next chunk.
+        """
+        while True:
+            try:
+                (value, end) = decoder.raw_decode(self.buffer, self.pos)
+                complete = end < len(self.buffer) and \
+                    (not isinstance(value, (int, long, float)) or self.buffer[end] in JSON_DELIMITERS)
+                if complete or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read()
+
 def print_searches(splunk_results):
     """Print all the searches contained in a set of files containing Splunk results.
 
@@ -169,8 +361,7 @@ def splunk_result_iter(jsonfiles):
     :rtype: generator
     """
     for jsonfile in jsonfiles:
-        data = load_data_from_json(jsonfile)
-        for splunk_result in data:
+        for splunk_result in iter_json_results(jsonfile):
             yield splunk_result
 
 def splunk_result_record_iter(jsonfiles):
@@ -181,8 +372,7 @@ def splunk_result_record_iter(jsonfiles):
     :rtype: generator
     """
     for jsonfile in jsonfiles:
-        data = load_data_from_json(jsonfile)
-        for splunk_result in data:
+        for splunk_result in iter_json_results(jsonfile):
             record_iter = splunk_result.iteritems()
             for (key, value) in record_iter:
                 yield (key, value)
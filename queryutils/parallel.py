@@ -0,0 +1,180 @@
+from collections import OrderedDict, deque
+from importlib import import_module
+from itertools import islice
+from logging import getLogger as get_logger
+from multiprocessing import Pool, cpu_count
+from queryutils import parse
+from queryutils.parsecache import PARSETREE
+
+logger = get_logger("queryutils")
+
+CHUNK_SIZE = 100
+CHUNKS_PER_PROCESS = 2 # chunks queued per worker, so workers don't wait on the reader
+
+
+def get_users_from_files(module, filenames, users, processes=None, fields=None, cache=None):
+    """Populate the users dictionary with the users in the given files, reading the files in parallel.
+
+    Each file is read into its own user dictionary by a pool of worker
+    processes, using the given module's `get_users_from_file`. The per-file
+    dictionaries are then merged in the order of the files, so the users and
+    their queries end up in the same order as reading the files one after
+    another into one dictionary, and a user whose queries span files is
+    only returned once.
+
+    :param module: The module to read the files with (jsonparser or csvparser)
+    :type module: module
+    :param filenames: The paths to the files to read
+    :type filenames: list
+    :param users: The user dict into which to place the users
+    :type users: dict
+    :param processes: The number of worker processes (defaults to the number of CPUs)
+    :type processes: int
+    :param fields: The fields to read, if not all of them
+    :type fields: list
+    :param cache: The cache to read the files through, if any
+    :type cache: queryutils.cache.Cache
+    :rtype: None
+    """
+    tasks = [(module.__name__, filename, fields, cache) for filename in filenames]
+    pool = Pool(processes=processes)
+    try:
+        for (filename, file_users) in zip(filenames, pool.imap(_get_users_from_file, tasks)):
+            logger.debug("Merging users from file:" + filename)
+            merge_users(users, file_users)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def merge_users(users, other_users):
+    """Merge the users in one user dictionary into another.
+
+    The queries of a user in both are appended to the user already in
+    `users`, and otherwise the user is added to `users`. As when reading
+    rows one at a time, the case of the user read last is kept.
+
+    :param users: The user dict into which to merge the users
+    :type users: dict
+    :param other_users: The user dict to merge
+    :type other_users: dict
+    :rtype: None
+    """
+    for (key, other) in other_users.iteritems():
+        user = users.get(key, None)
+        if user is None:
+            users[key] = other
+            continue
+        for query in other.queries:
+            query.user = user
+        user.queries.extend(other.queries)
+        user.case_id = other.case_id
+
+def _get_users_from_file((module_name, filename, fields, cache)):
+    users = OrderedDict()
+    module = import_module(module_name)
+    if cache is not None:
+        cache.get_users_from_file(module, filename, users, fields=fields)
+    else:
+        module.get_users_from_file(filename, users, fields=fields)
+    return users
+
+def parse_queries(queries, processes=None, chunk_size=CHUNK_SIZE):
+    """Yield the serialized parsetree of each of the given queries, parsing them in parallel.
+
+    The queries are sent in chunks of `chunk_size` to a pool of worker
+    processes, which return each parsetree serialized with
+    `ParseTreeNode.dumps`, as that is much cheaper to send back than the
+    tree itself. Only a few chunks per worker are read ahead of the
+    results, so the queries can be streamed from a database or files. The
+    results are yielded in the order of the queries, as `(query ID, dumped
+    parsetree, error)` triples: for a query that fails to parse, the dumped
+    parsetree is None and the error describes the failure; otherwise the
+    error is None.
+
+    Query texts in `queryutils.parse.parse_cache` are not sent to the
+    workers, and the parsetrees the workers return are added to it.
+
+    :param queries: The (query ID, query text) pairs to parse
+    :type queries: iterable
+    :param processes: The number of worker processes, or None or 1 to parse in this process
+    :type processes: int
+    :param chunk_size: The number of queries to send to a worker at a time
+    :type chunk_size: int
+    :rtype: generator
+    """
+    chunks = _chunks(queries, chunk_size)
+    if processes is None or processes <= 1:
+        for chunk in chunks:
+            (cached, texts) = _lookup_chunk(chunk)
+            for result in _parsed_chunk(cached, _parse_texts(texts)):
+                yield result
+        return
+    pool = Pool(processes=processes)
+    pending = deque()
+    try:
+        for chunk in chunks:
+            (cached, texts) = _lookup_chunk(chunk)
+            pending.append((cached, pool.apply_async(_parse_texts, (texts,))))
+            if len(pending) >= processes * CHUNKS_PER_PROCESS:
+                (cached, parsed) = pending.popleft()
+                for result in _parsed_chunk(cached, parsed.get()):
+                    yield result
+        while pending:
+            (cached, parsed) = pending.popleft()
+            for result in _parsed_chunk(cached, parsed.get()):
+                yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+def _lookup_chunk(chunk):
+    """Look the queries in the chunk up in the parse cache.
+
+    Return a (query ID, encoded text, found, dumped parsetree) tuple for
+    each query, and the (query ID, encoded text) pairs left to parse.
+    """
+    cached = []
+    for (qid, text) in chunk:
+        text = parse.encode_query(text)
+        if parse.parse_cache.enabled:
+            (found, dumped) = parse.parse_cache.lookup(PARSETREE, text)
+        else:
+            (found, dumped) = (False, None)
+        cached.append((qid, text, found, dumped))
+    texts = [(qid, text) for (qid, text, found, _) in cached if not found]
+    return (cached, texts)
+
+def _parsed_chunk(cached, parsed):
+    """Merge the results parsed for a chunk with those found in the parse cache, in order.
+    """
+    parsed = iter(parsed)
+    results = []
+    for (qid, text, found, dumped) in cached:
+        if found:
+            error = None if dumped is not None else "Failed to parse query (cached)."
+        else:
+            (_, dumped, error) = next(parsed)
+            if parse.parse_cache.enabled:
+                parse.parse_cache.store(PARSETREE, text, dumped)
+        results.append((qid, dumped, error))
+    return results
+
+def _parse_texts(texts):
+    results = []
+    for (qid, text) in texts:
+        (parsetree, error) = parse.try_parse(text)
+        results.append((qid, parsetree.dumps() if parsetree is not None else None, error))
+    return results
@@ -1,28 +1,89 @@
 from splparser import parse as splparse
-from splparser.lexers.toplevellexer import tokenize as spltokenize
+import array as arrays
+from splparser.lexers.toplevellexer import SPLToken, tokenize as spltokenize, tokens as spltokentypes
+from splparser.parsetree import ParseTreeNode
 from .query import *
+from .budget import MAX_LENGTH, MAX_SECONDS, ParseBudget, Quarantine, abbreviate
+from .parsecache import ParseCache, PARSETREE, TOKENS
 from logging import getLogger as get_logger
 
+import json
+import re
+
 logger = get_logger("queryutils")
 
+# The token types, in the order of their codes in a TokenizedQuery.
+TOKEN_TYPES = sorted(spltokentypes) + ["EXTERNAL_COMMAND"]
+TOKEN_CODES = dict((type, code) for (code, type) in enumerate(TOKEN_TYPES))
+
+ARGS = TOKEN_CODES["ARGS"]
+EVAL = TOKEN_CODES["EVAL"]
+EXTERNAL_COMMAND = TOKEN_CODES["EXTERNAL_COMMAND"]
+LBRACKET = TOKEN_CODES["LBRACKET"]
+MACRO = TOKEN_CODES["MACRO"]
+PIPE = TOKEN_CODES["PIPE"]
+RBRACKET = TOKEN_CODES["RBRACKET"]
+NONCOMMANDS = frozenset([ARGS, PIPE, LBRACKET, RBRACKET])
+
+# The characters that can change where a stage ends, by the lexer's rules.
+STAGE_SPECIAL_CHARS = re.compile(r"""[|\[\]"'`\\]""")
+QUOTES = "\"'`"
+ESCAPE = "\\"
+
+# The cache of parsetrees and tokens used by parse_query and tokenize_query.
+parse_cache = ParseCache()
+
+def configure_parse_cache(max_size=None, path=None):
+    """Replace the cache used by parse_query and tokenize_query.
+
+    :param max_size: The number of results to keep in memory (defaults to queryutils.parsecache.MAX_SIZE)
+    :type max_size: int
+    :param path: The path to a SQLite database to also keep results in, if any
+    :type path: str
+    :rtype: queryutils.parsecache.ParseCache
+    """
+    global parse_cache
+    parse_cache.close()
+    if max_size is None:
+        parse_cache = ParseCache(path=path)
+    else:
+        parse_cache = ParseCache(max_size=max_size, path=path)
+    return parse_cache
+
+# The time and size budget for parsing each query, if any.
+parse_budget = None
+
+def configure_parse_budget(seconds=MAX_SECONDS, max_length=MAX_LENGTH, quarantine=None):
+    """Limit the time and size of each query parsed by parse_query, or remove the limit.
+
+    See queryutils.budget.ParseBudget. The queries over the budget are
+    logged on one line each, rather than with a traceback, and are added to
+    the quarantine file, if one is given, so they are skipped in later runs.
+
+    :param seconds: The wall-clock time allowed to parse each query, or None for no limit
+    :type seconds: float
+    :param max_length: The length in bytes of the longest query to parse, or None for no limit
+    :type max_length: int
+    :param quarantine: The path to the quarantine file, if any
+    :type quarantine: str
+    :rtype: queryutils.budget.ParseBudget
+    """
+    global parse_budget
+    if seconds is None and max_length is None and quarantine is None:
+        parse_budget = None
+    else:
+        parse_budget = ParseBudget(seconds=seconds, max_length=max_length,
+            quarantine=Quarantine(quarantine) if quarantine is not None else None)
+    return parse_budget
+
 def lookup_commands(querystring):
     """Extract the list of commands from the query.
 
-    :param querystring: The query to extract commands from
-    :type querystring: str
+    :param querystring: The query to extract commands from, or the query already tokenized
+    :type querystring: str or queryutils.parse.TokenizedQuery
     :rtype: list
     """
-    commands = []
-    tokens = tokenize_query(querystring)
-    for token in tokens:
-        val = token.value.strip().lower()
-        if token.type == "EXTERNAL_COMMAND":
-            commands.append(val)
-        elif token.type == "MACRO":
-            commands.append(val)
-        elif token.type not in ["ARGS", "PIPE", "LBRACKET", "RBRACKET"]:
-            commands.append(val)
-    return commands
+    return tokenized(querystring).commands
 
 def extract_schema(query):
     """Return the schema for the query.
@@ -63,45 +124,267 @@ def split_query_into_stages(query):
     query stages. This is trickier than just calling split('|') because the
     pipe character is a valid argument to commands if quoted.
 
+    :param query: The query to split, or the query already tokenized
+    :type query: str or queryutils.parse.TokenizedQuery
+    :rtype: list
+    """
+    return tokenized(query).stages
+
+def split_query_into_raw_stages(query):
+    """Split the query into stages, keeping the original text of each stage.
+
+    The stages are the same as those returned by split_query_into_stages,
+    but each is the slice of the query text it spans rather than its tokens
+    joined by single spaces, so the original spacing is kept.
+
     :param query: The query to split
-    :type query: str
+    :type query: str or queryutils.query.Query
     :rtype: list
     """
-    stages = []
-    current_stage = []
-    subsearch = []
+    text = encode_query(query)
+    return [text[start:end] for (start, end) in find_stage_offsets(text)]
 
-    for token in tokenize_query(query):
+def find_stage_offsets(query):
+    """Return the offsets in the query text at which each of its stages starts and ends.
 
-        if token.type == "LBRACKET":
-            subsearch.append(token)
-            current_stage.append(token.value)
-            continue
-        
-        if token.type == "RBRACKET":
-            current_stage.append(token.value)
-            subsearch.pop(-1)
-            if len(subsearch) == 0:
-                stages.append(" ".join(current_stage))
-                current_stage = []
-            continue
+    This finds the same stages as split_query_into_stages without running
+    the lexer: it scans the text once for pipes outside of quotes and
+    subsearch brackets, following the lexer's rules for quotes and
+    backslash escapes. If the query has an unterminated quote or an
+    unmatched closing bracket, on which the lexer's behavior is easiest to
+    get wrong, the query is tokenized and the offsets are taken from the
+    tokens instead.
 
-        if len(subsearch) > 0:
-            current_stage.append(token.value)
-            continue 
+    :param query: The query to split
+    :type query: str or queryutils.query.Query
+    :rtype: list
+    """
+    text = encode_query(query)
+    offsets = _scan_stage_offsets(text)
+    if offsets is None:
+        logger.debug("Falling back to the lexer to split query: " + text)
+        return TokenizedQuery(text).stage_offsets
+    return offsets
 
-        if token.type == "PIPE":
-            if len(current_stage) > 0:
-                stages.append(" ".join(current_stage))
-            current_stage = [token.value]
+def _scan_stage_offsets(text):
+    """Return the (start, end) offsets of the stages in the text, or None if the text is ambiguous.
+    """
+    offsets = []
+    start = 0
+    depth = 0
+    quote = None
+    skip = -1
+    for match in STAGE_SPECIAL_CHARS.finditer(text):
+        idx = match.start()
+        if idx == skip:
             continue
-            
-        current_stage.append(token.value)
-   
-    if len(current_stage) > 0:
-        stages.append(" ".join(current_stage))
+        char = text[idx]
+        if char == ESCAPE:
+            skip = idx + 1
+        elif quote is not None:
+            if char == quote:
+                quote = None
+        elif char in QUOTES:
+            quote = char
+        elif char == "[":
+            depth += 1
+        elif char == "]":
+            if depth == 0:
+                return None
+            depth -= 1
+            if depth == 0:
+                _append_stage(offsets, text, start, idx + 1)
+                start = idx + 1
+        elif depth == 0:
+            _append_stage(offsets, text, start, idx)
+            start = idx
+    if quote is not None:
+        return None
+    _append_stage(offsets, text, start, len(text))
+    return offsets
+
+def _append_stage(offsets, text, start, end):
+    stage = text[start:end]
+    stripped = stage.lstrip()
+    if stripped:
+        start += len(stage) - len(stripped)
+        offsets.append((start, start + len(stripped.rstrip())))
+
+def tokenized(query):
+    """Return the given query tokenized, unless it already is.
+
+    :param query: The query or query string, or the query already tokenized
+    :type query: str or queryutils.query.Query or queryutils.parse.TokenizedQuery
+    :rtype: queryutils.parse.TokenizedQuery
+    """
+    if isinstance(query, TokenizedQuery):
+        return query
+    return TokenizedQuery(query)
+
+
+class TokenizedQuery(object):
+    """A query tokenized once, for all the analyses that work on its tokens.
+
+    The tokens are not kept as objects. Instead, each token is stored as
+    the code of its type (its index in TOKEN_TYPES) and the offsets at
+    which it starts and ends in the UTF-8 encoded query text, which is
+    possible because the lexer's tokens are always substrings of the text.
+    The commands, stages, categories and eval segments of the query are
+    computed from these the first time they are asked for, and kept.
+    """
+
+    __slots__ = ["text", "types", "starts", "ends", "_commands", "_stages", "_categories", "_evals"]
+
+    def __init__(self, query):
+        """Tokenize the given query.
+
+        If the query fails to tokenize, it has no tokens.
 
-    return stages
+        :param self: The object being created
+        :type self: queryutils.parse.TokenizedQuery
+        :param query: The query or query string to tokenize
+        :type query: str or queryutils.query.Query
+        :rtype: queryutils.parse.TokenizedQuery
+        """
+        self.text = encode_query(query)
+        self.types = arrays.array("B")
+        self.starts = arrays.array("l")
+        self.ends = arrays.array("l")
+        self._commands = self._stages = self._categories = self._evals = None
+        end = 0
+        for token in tokenize_query(self.text) or []:
+            start = self.text.find(token.value, end)
+            end = start + len(token.value)
+            self.types.append(token_code(token.type))
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __len__(self):
+        return len(self.types)
+
+    def type(self, idx):
+        """Return the type of the token at the given index.
+
+        :param self: The current object
+        :type self: queryutils.parse.TokenizedQuery
+        :param idx: The index of the token
+        :type idx: int
+        :rtype: str
+        """
+        return TOKEN_TYPES[self.types[idx]]
+
+    def value(self, idx):
+        """Return the text of the token at the given index.
+
+        :param self: The current object
+        :type self: queryutils.parse.TokenizedQuery
+        :param idx: The index of the token
+        :type idx: int
+        :rtype: str
+        """
+        return self.text[self.starts[idx]:self.ends[idx]]
+
+    def tokens(self):
+        """Return the tokens as the lexer's token objects, as tokenize_query does.
+
+        :param self: The current object
+        :type self: queryutils.parse.TokenizedQuery
+        :rtype: list
+        """
+        return [SPLToken(self.type(idx), self.value(idx)) for idx in range(len(self))]
+
+    @property
+    def commands(self):
+        """The commands of the query, lowercased, as returned by lookup_commands.
+        """
+        if self._commands is None:
+            self._commands = [self.value(idx).strip().lower() for (idx, code) in enumerate(self.types)
+                                if code not in NONCOMMANDS]
+        return self._commands
+
+    @property
+    def stages(self):
+        """The stages of the query, as returned by split_query_into_stages.
+        """
+        if self._stages is None:
+            self._stages = [" ".join(self.value(idx) for idx in range(first, last))
+                                for (first, last) in self._stage_ranges()]
+        return self._stages
+
+    @property
+    def stage_offsets(self):
+        """The offsets in the text at which each stage of the query starts and ends.
+        """
+        return [(self.starts[first], self.ends[last - 1]) for (first, last) in self._stage_ranges()]
+
+    @property
+    def categories(self):
+        """The categories of the commands of the query, as returned by splunktypes.lookup_categories.
+        """
+        if self._categories is None:
+            from queryutils.splunktypes import lookup_categories
+            self._categories = lookup_categories(self)
+        return self._categories
+
+    @property
+    def evals(self):
+        """The segments of the query from each eval command up to the next pipe.
+
+        The tokens of each segment are separated by single spaces.
+        """
+        if self._evals is None:
+            self._evals = self._split_evals()
+        return self._evals
+
+    def _stage_ranges(self):
+        """Return the (first, last + 1) indices of the tokens of each stage.
+        """
+        ranges = []
+        first = 0
+        depth = 0
+        for (idx, code) in enumerate(self.types):
+            if code == LBRACKET:
+                depth += 1
+            elif code == RBRACKET:
+                depth = max(depth - 1, 0)
+                if depth == 0:
+                    ranges.append((first, idx + 1))
+                    first = idx + 1
+            elif depth == 0 and code == PIPE:
+                if idx > first:
+                    ranges.append((first, idx))
+                first = idx
+        if len(self) > first:
+            ranges.append((first, len(self)))
+        return ranges
+
+    def _split_evals(self):
+        evals = []
+        current_eval = []
+        for (idx, code) in enumerate(self.types):
+            if code == PIPE:
+                if len(current_eval) > 0:
+                    evals.append(" ".join(current_eval))
+                current_eval = []
+            elif len(current_eval) > 0 or code == EVAL:
+                current_eval.append(self.value(idx))
+        if len(current_eval) > 0:
+            evals.append(" ".join(current_eval))
+        return evals
+
+
+def token_code(type):
+    """Return the code of the given token type, giving it a new code if it has none.
+
+    :param type: The token type
+    :type type: str
+    :rtype: int
+    """
+    code = TOKEN_CODES.get(type, None)
+    if code is None:
+        code = TOKEN_CODES[type] = len(TOKEN_TYPES)
+        TOKEN_TYPES.append(type)
+    return code
 
 def parse_query(query):
     """Parse the given query if possible.
@@ -110,22 +393,54 @@ def parse_query(query):
     handles unicode issues and logs errors and returns None in the case of
     an error rather than raising an exception.
 
+    Results are cached in `parse_cache`, so a query text that has been
+    parsed before is not parsed again; a new copy of its parsetree is
+    returned instead. If a parse budget has been set with
+    configure_parse_budget, queries over it are not parsed.
+
     :param query: The query to parse
     :type query: str
     :rtype: splparser.parsetree.ParseTreeNode
     """
-    text = ""
-    if isinstance(query, Query):
-        q = str(query.text.encode("utf8")) if type(query.text) == unicode else str(query.text.decode("utf8").encode("utf8"))
-    else:
-        q = str(query.encode("utf8")) if type(query) == unicode else str(query.decode("utf8").encode("utf8"))
-    try:
-        parsetree = splparse(q)
-    except:
-        logger.exception("Failed to parse query: " + q)
-        return None
+    q = encode_query(query)
+    if not parse_cache.enabled:
+        return try_parse(q)[0]
+    (found, dumped) = parse_cache.lookup(PARSETREE, q)
+    if found:
+        return ParseTreeNode.loads(dumped) if dumped is not None else None
+    (parsetree, error) = try_parse(q)
+    parse_cache.store(PARSETREE, q, parsetree.dumps() if parsetree is not None else None)
     return parsetree
 
+def try_parse(text):
+    """Parse the given query text, within `parse_budget` if one is set.
+
+    Return the parsetree and None, or None and a description of why the
+    query could not be parsed. Failures are logged, with a traceback
+    unless there is a parse budget.
+
+    :param text: The UTF-8 encoded query text
+    :type text: str
+    :rtype: tuple
+    """
+    try:
+        if parse_budget is None:
+            parsetree = splparse(text)
+        else:
+            (parsetree, reason) = parse_budget.parse(text, splparse)
+            if reason is not None:
+                return (None, "Query over parse budget: " + reason)
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+        if parse_budget is None:
+            logger.exception("Failed to parse query: " + text)
+        else:
+            logger.error("Failed to parse query (%s): %s" % (abbreviate(error), abbreviate(text)))
+        return (None, error)
+    if parsetree is None:
+        return (None, "Query has no parsetree.")
+    return (parsetree, None)
+
 def parse_queries(queries):
     """TODO: Delete me.
     """
@@ -139,18 +454,41 @@ def tokenize_query(query):
     unicode issues and logs errors and returns None in the case of an
     error rather than raising an exception.
 
+    Results are cached in `parse_cache` like those of parse_query.
+
     :param query: The query to tokenize
     :type query: str
     :rtype: list
     """
-    text = ""
-    if isinstance(query, Query):
-        q = str(query.text.encode("utf8")) if type(query.text) == unicode else str(query.text.decode("utf8").encode("utf8"))
+    q = encode_query(query)
+    if not parse_cache.enabled:
+        return _tokenize(q)
+    (found, encoded) = parse_cache.lookup(TOKENS, q)
+    if found:
+        if encoded is None:
+            return None
+        return [SPLToken(str(type), value.encode("utf8")) for (type, value) in json.loads(encoded)]
+    tokens = _tokenize(q)
+    if tokens is None:
+        parse_cache.store(TOKENS, q, None)
     else:
-        q = str(query.encode("utf8")) if type(query) == unicode else str(query.decode("utf8").encode("utf8"))
+        parse_cache.store(TOKENS, q, json.dumps([(token.type, token.value.decode("utf8")) for token in tokens]))
+    return tokens
+
+def _tokenize(text):
     try:
-        tokens = spltokenize(q) 
+        return spltokenize(text)
     except:
-        logger.exception("Failed to tokenize query: " + q)
+        logger.exception("Failed to tokenize query: " + text)
         return None
-    return tokens
+
+def encode_query(query):
+    """Return the text of the given query or query string as a UTF-8 encoded str.
+
+    :param query: The query or query string
+    :type query: queryutils.query.Query or str
+    :rtype: str
+    """
+    if isinstance(query, Query):
+        return str(query.text.encode("utf8")) if type(query.text) == unicode else str(query.text.decode("utf8").encode("utf8"))
+    return str(query.encode("utf8")) if type(query) == unicode else str(query.decode("utf8").encode("utf8"))
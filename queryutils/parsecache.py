@@ -0,0 +1,211 @@
+import atexit
+import sqlite3
+
+from collections import OrderedDict
+from hashlib import md5
+from logging import getLogger as get_logger
+
+logger = get_logger("queryutils")
+
+MAX_SIZE = 10000
+COMMIT_SIZE = 1000 # results written to the disk tier per transaction
+TIMEOUT = 30. # seconds to wait for another process's write to the disk tier
+
+_MISSING = object()
+
+PARSETREE = "parsetree"
+TOKENS = "tokens"
+
+CREATE_TABLE = "CREATE TABLE IF NOT EXISTS parses ( \
+        key BLOB PRIMARY KEY, \
+        value TEXT)"
+
+
+class ParseCache(object):
+    """A cache of the results of parsing or tokenizing query texts.
+
+    Results are kept, in serialized form, in an in-memory LRU cache of up
+    to `max_size` entries, and, if a path is given, in a SQLite database
+    that persists across runs and can be shared by processes. Each result
+    is keyed by its kind (PARSETREE or TOKENS) and a hash of the query
+    text. Failures are cached as None, so a query that doesn't parse is not
+    parsed again either. Since results are kept serialized, each hit gives
+    the caller a new parsetree it is free to modify, and loading one is
+    cheaper than deep-copying a tree.
+
+    Results are written to the disk tier `commit_size` at a time, rather
+    than committed one by one, and the rest when the cache is flushed or
+    closed, which happens at the latest when the interpreter exits.
+
+    The numbers of lookups answered from memory (`nhits`), from disk
+    (`ndisk_hits`), and by neither (`nmisses`) are counted.
+    """
+
+    def __init__(self, max_size=MAX_SIZE, path=None, commit_size=COMMIT_SIZE):
+        """Create an empty ParseCache.
+
+        :param self: The object being created
+        :type self: queryutils.parsecache.ParseCache
+        :param max_size: The number of results to keep in memory, or 0 to keep none
+        :type max_size: int
+        :param path: The path to the SQLite database to also keep results in, if any
+        :type path: str
+        :param commit_size: The number of results to write to the database per transaction
+        :type commit_size: int
+        :rtype: queryutils.parsecache.ParseCache
+        """
+        self.max_size = max_size
+        self.path = path
+        self.commit_size = commit_size
+        self.entries = OrderedDict()
+        self.pending = OrderedDict()
+        self.connection = None
+        self.closes_at_exit = False
+        self.nhits = 0
+        self.ndisk_hits = 0
+        self.nmisses = 0
+
+    def lookup(self, kind, text):
+        """Return whether a result of the given kind is cached for the given text, and the result.
+
+        :param self: The current object
+        :type self: queryutils.parsecache.ParseCache
+        :param kind: The kind of result (PARSETREE or TOKENS)
+        :type kind: str
+        :param text: The UTF-8 encoded query text
+        :type text: str
+        :rtype: tuple
+        """
+        key = cache_key(kind, text)
+        value = self.entries.pop(key, _MISSING)
+        if value is not _MISSING:
+            self.entries[key] = value
+            self.nhits += 1
+            return (True, value)
+        if self.path is not None:
+            value = self.pending.get(key, _MISSING)
+            if value is not _MISSING:
+                self.nhits += 1
+                return (True, value)
+            row = self._disk().execute("SELECT value FROM parses WHERE key = ?", (buffer(key),)).fetchone()
+            if row is not None:
+                self.ndisk_hits += 1
+                self._remember(key, row[0])
+                return (True, row[0])
+        self.nmisses += 1
+        return (False, None)
+
+    def store(self, kind, text, value):
+        """Cache a result of the given kind for the given text.
+
+        :param self: The current object
+        :type self: queryutils.parsecache.ParseCache
+        :param kind: The kind of result (PARSETREE or TOKENS)
+        :type kind: str
+        :param text: The UTF-8 encoded query text
+        :type text: str
+        :param value: The serialized result, or None if the text failed to parse
+        :type value: str
+        :rtype: None
+        """
+        key = cache_key(kind, text)
+        self._remember(key, value)
+        if self.path is not None:
+            self.pending[key] = value
+            if len(self.pending) >= self.commit_size:
+                self.flush()
+
+    @property
+    def enabled(self):
+        """Whether the cache keeps any results at all.
+        """
+        return self.max_size > 0 or self.path is not None
+
+    def flush(self):
+        """Write the results not yet written to the disk tier, if there is one.
+
+        :param self: The current object
+        :type self: queryutils.parsecache.ParseCache
+        :rtype: None
+        """
+        if len(self.pending) == 0:
+            return
+        disk = self._disk()
+        disk.executemany("INSERT OR REPLACE INTO parses (key, value) VALUES (?, ?)",
+            [(buffer(key), value) for (key, value) in self.pending.iteritems()])
+        disk.commit()
+        self.pending.clear()
+
+    def _remember(self, key, value):
+        if self.max_size == 0:
+            return
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _disk(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=TIMEOUT)
+            self.connection.text_factory = str
+            self.connection.execute(CREATE_TABLE)
+            self.connection.commit()
+            if not self.closes_at_exit:
+                atexit.register(self.close)
+                self.closes_at_exit = True
+        return self.connection
+
+    def clear(self):
+        """Empty the in-memory cache and reset the counters, leaving the disk tier as is.
+
+        :param self: The current object
+        :type self: queryutils.parsecache.ParseCache
+        :rtype: None
+        """
+        self.entries.clear()
+        self.nhits = self.ndisk_hits = self.nmisses = 0
+
+    def close(self):
+        """Write the pending results to the disk tier and close the connection to it, if it is open.
+
+        :param self: The current object
+        :type self: queryutils.parsecache.ParseCache
+        :rtype: None
+        """
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __getstate__(self):
+        # Worker processes get their own connection to the disk tier.
+        state = dict(self.__dict__)
+        state["connection"] = None
+        state["closes_at_exit"] = False
+        state["pending"] = OrderedDict()
+        return state
+
+    def stats(self):
+        """Return the counts of lookups answered from memory, from disk, and by neither.
+
+        :param self: The current object
+        :type self: queryutils.parsecache.ParseCache
+        :rtype: dict
+        """
+        return {
+            "hits": self.nhits,
+            "disk_hits": self.ndisk_hits,
+            "misses": self.nmisses,
+            "size": len(self.entries),
+        }
+
+
+def cache_key(kind, text):
+    """Return the key of the result of the given kind for the given query text.
+
+    :param kind: The kind of result (PARSETREE or TOKENS)
+    :type kind: str
+    :param text: The UTF-8 encoded query text
+    :type text: str
+    :rtype: str
+    """
+    return md5(kind + "\0" + text).digest()
@@ -1,8 +1,10 @@
 from json import JSONEncoder
-from numpy import ceil, floor, histogram, log, mean
+from queryutils.records import Record
+from numpy import arange, array, bincount, ceil, concatenate, cumsum, diff, errstate, floor, \
+    histogram, linspace, log, mean, minimum, mod, nan, repeat, sort, unique, zeros
 
 EPSILON = 1e-4
-ENTROPY_NBUCKETS = 1e4
+ENTROPY_NBUCKETS = 10000
 MAX_INTERVAL = 1e6 # TODO: This shouldn't be hard-coded.
 NCHARS = 100
 SECONDS = 30.
@@ -16,6 +18,96 @@ def wrap_text(text):
     wrapped.append(current)
     return "\n\t\t\t\t\t".join(wrapped)
 
+def interarrival_arrays(query_groups):
+    """Concatenate the interarrival intervals of the given query groups.
+
+    The intervals of group `i` are `intervals[offsets[i]:offsets[i+1]]`, and
+    are also stored on the group as `interarrivals`.
+
+    :param query_groups: The query groups
+    :type query_groups: list
+    :rtype: tuple
+    """
+    arrays = []
+    for query_group in query_groups:
+        times = sort(array([q.time for q in query_group.copies_this_user()], dtype=float))
+        query_group.interarrivals = diff(times)
+        arrays.append(query_group.interarrivals)
+    lengths = array([len(a) for a in arrays], dtype=int)
+    offsets = concatenate([[0], cumsum(lengths)]).astype(int)
+    intervals = concatenate(arrays) if arrays else zeros(0)
+    return intervals, offsets
+
+def interarrival_metrics(intervals, offsets):
+    """Compute the interarrival entropy, consistency, and clockness of many groups at once.
+
+    This returns the same values as the corresponding QueryGroup methods,
+    but for all of the groups in a handful of array operations. The entropy
+    is computed from only the nonempty histogram buckets of each group, so
+    no dense ENTROPY_NBUCKETS histogram is built.
+
+    :param intervals: The interarrival intervals of all the groups, concatenated
+    :type intervals: numpy.ndarray
+    :param offsets: Where the intervals of each group start, plus the total length
+    :type offsets: numpy.ndarray
+    :rtype: tuple
+    """
+    intervals = array(intervals, dtype=float)
+    offsets = array(offsets, dtype=int)
+    ngroups = len(offsets) - 1
+    lengths = diff(offsets)
+    groups = repeat(arange(ngroups), lengths)
+    with_errstate = errstate(divide="ignore", invalid="ignore")
+
+    # Consistency: the fraction of intervals within 10% of the group's mean.
+    sums = _group_sums(groups, intervals, ngroups)
+    with with_errstate:
+        avgs = sums / lengths
+        scaled = intervals / avgs[groups]
+        close = (scaled < 1.1) & (scaled > .9)
+        consistency = _group_sums(groups, close, ngroups) / lengths
+    consistency[lengths <= 1] = 1.
+
+    # Clockness: how close the intervals are to multiples of SECONDS.
+    remainders = mod(intervals, SECONDS)
+    clocked = minimum(remainders, SECONDS - remainders) / SECONDS
+    with with_errstate:
+        clockness = 1. - _group_sums(groups, clocked, ngroups) / lengths
+    clockness[lengths == 0] = -1.
+
+    # Entropy: from the counts of only the buckets each group falls into.
+    nbuckets = ENTROPY_NBUCKETS
+    in_range = (intervals >= 0.) & (intervals <= MAX_INTERVAL)
+    values = intervals[in_range]
+    buckets = _histogram_buckets(values, nbuckets, MAX_INTERVAL)
+    keys, counts = unique(groups[in_range] * nbuckets + buckets, return_counts=True)
+    key_groups = keys // nbuckets
+    ninrange = bincount(groups[in_range], minlength=ngroups)
+    with with_errstate:
+        p = counts / (ninrange[key_groups] * (MAX_INTERVAL / nbuckets))
+        entropy = -1 * _group_sums(key_groups, p*log(p+EPSILON), ngroups)
+    entropy[(ninrange == 0) & (lengths > 1)] = nan
+    entropy[lengths <= 1] = 0.
+    return entropy, consistency, clockness
+
+def _group_sums(groups, weights, ngroups):
+    """Return the sum of the weights in each group, as floats even when there are no weights.
+    """
+    return bincount(groups, weights=weights, minlength=ngroups).astype(float)
+
+def _histogram_buckets(values, nbuckets, maximum):
+    """Return the bucket of each value in a histogram of equal buckets over [0, maximum].
+
+    This follows numpy.histogram exactly, including its handling of values
+    that fall on the edges of buckets.
+    """
+    edges = linspace(0., maximum, nbuckets + 1)
+    buckets = (values * (nbuckets / maximum)).astype(int)
+    buckets[buckets == nbuckets] -= 1
+    buckets[values < edges[buckets]] -= 1
+    buckets[(values >= edges[buckets + 1]) & (buckets != nbuckets - 1)] += 1
+    return buckets
+
 class QueryGroup(object):
 
     def __init__(self, query):
@@ -99,10 +191,18 @@ class QueryGroup(object):
             self.interarrival_clockness(),
             wrap_text(str(self.interarrivals)))
 
-class Query(object):
+class Query(Record):
     """A class representing a Splunk query and associated information.
+
+    Queries store their attributes in slots, so only the attributes listed
+    in `__slots__` can be set (see queryutils.records.Record).
     """
 
+    __slots__ = ["text", "time", "user", "is_interactive", "is_suspicious", "parsetree",
+        "execution_time", "earliest_event", "latest_event", "range", "is_realtime",
+        "search_type", "splunk_search_id", "saved_search_name", "session",
+        "id", "query_id", "user_id", "session_id", "delta", "parseable"]
+
     def __init__(self, text, time):
         """Create a Query object.
 
@@ -149,7 +249,7 @@ class QueryType(object):
 class QueryEncoder(JSONEncoder):
 
     def encode(self, obj):
-        query_dict = obj.__dict__
+        query_dict = obj.attributes()
         query_dict['user'] = obj.user.name
         query_dict['is_interactive'] = obj.is_interactive
         if not obj.session is None:
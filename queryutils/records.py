@@ -0,0 +1,63 @@
+class Record(object):
+    """A base class for objects that store their attributes in slots rather than a dict.
+
+    Subclasses list every attribute their instances can have in
+    `__slots__`, which saves the per-instance dict that would otherwise
+    hold them. Since there is no `__dict__` to read or update, use
+    `attributes` and `update` instead.
+    """
+
+    __slots__ = []
+
+    def attributes(self):
+        """Return a dict of the attributes of the current object that have been set.
+
+        :param self: The current object
+        :type self: queryutils.records.Record
+        :rtype: dict
+        """
+        attributes = {}
+        for name in slot_names(type(self)):
+            try:
+                attributes[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return attributes
+
+    def update(self, attributes):
+        """Set the attributes of the current object from the given dict.
+
+        :param self: The current object
+        :type self: queryutils.records.Record
+        :param attributes: The values of the attributes, by name
+        :type attributes: dict
+        :rtype: None
+        """
+        for (name, value) in attributes.iteritems():
+            setattr(self, name, value)
+
+    def __getstate__(self):
+        return self.attributes()
+
+    def __setstate__(self, state):
+        self.update(state)
+
+
+_SLOT_NAMES = {}
+
+def slot_names(cls):
+    """Return the names of the slots of the given class and its bases.
+
+    :param cls: The class
+    :type cls: type
+    :rtype: list
+    """
+    names = _SLOT_NAMES.get(cls, None)
+    if names is None:
+        names = []
+        for base in reversed(cls.__mro__):
+            for name in base.__dict__.get("__slots__", []):
+                if name not in names:
+                    names.append(name)
+        _SLOT_NAMES[cls] = names
+    return names
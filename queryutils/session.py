@@ -1,6 +1,14 @@
 from json import JSONEncoder
+from queryutils.records import Record
 
-class Session(object):
+class Session(Record):
+    """Represents a session of queries by a user.
+
+    Sessions store their attributes in slots, so only the attributes listed
+    in `__slots__` can be set (see queryutils.records.Record).
+    """
+
+    __slots__ = ["id", "user", "queries", "session_type", "user_id", "duration"]
 
     def __init__(self, id, user):
         self.id = int(id)
@@ -1,11 +1,39 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from hashlib import md5
 from logging import getLogger as get_logger
-from queryutils.query import QueryGroup
+from os import path, remove
+from queryutils.query import Query, QueryGroup
 from queryutils.session import Session
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import cPickle as pickle
 
 logger = get_logger("queryutils")
 
 NEW_SESSION_THRESH_SECS = 30. * 60.
+QUERY_GROUP_PARTITIONS = 64
+
+class QueryGroupKey(object):
+    TEXT = "text"
+    HASH = "hash"
+
+def text_hash(text):
+    """Return a digest of the given query text.
+
+    :param text: The query text
+    :type text: str
+    :rtype: str
+    """
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return md5(text).digest()
+
+QUERY_GROUP_KEYS = {
+    QueryGroupKey.TEXT: lambda text: text,
+    QueryGroupKey.HASH: text_hash
+}
 
 class DataSource(object):
     """Represents a source of Splunk queries, users, and other data.
@@ -27,6 +55,26 @@ class DataSource(object):
         """
         raise NotImplementedError()
 
+    @contextmanager
+    def connected(self):
+        """Return a context manager that holds a connection open for its block.
+
+        For example::
+
+            with db.connected():
+                for user in db.get_users():
+                    ...
+
+        :param self: The current object
+        :type self: queryutils.source.DataSource
+        :rtype: contextmanager
+        """
+        connection = self.connect()
+        try:
+            yield connection
+        finally:
+            self.close()
+
     def commit(self):
         """Commits a database transaction.
         """
@@ -68,7 +116,7 @@ class DataSource(object):
         """
         raise NotImplementedError()
     
-    def extract_sessions_from_user(self, user, remove_suspicious=True):
+    def extract_sessions_from_user(self, user, remove_suspicious=True, threshold=NEW_SESSION_THRESH_SECS):
         """Extract sessions from the given users' queries.
 
         :param self: The current source object
@@ -77,6 +125,8 @@ class DataSource(object):
         :type user: queryutils.User
         :param remove_suspicious: Whether or not to remove queries labeled suspicious
         :type remove_suspicious: bool
+        :param threshold: The number of seconds between queries that starts a new session
+        :type threshold: float
         :rtype: None
         """
         if len(user.interactive_queries) == 0: return
@@ -93,7 +143,7 @@ class DataSource(object):
             if prev_time < 0.:
                 prev_time = curr_time
             query.delta = curr_time - prev_time
-            if query.delta > NEW_SESSION_THRESH_SECS:
+            if query.delta > threshold:
                 self._update_session_duration(user.sessions[session_id])
                 session_id += 1
                 session = Session(session_id, user)
@@ -108,35 +158,128 @@ class DataSource(object):
         last_query = session.queries[-1]
         session.duration = last_query.time - first_query.time
 
-    def get_query_groups(self, multiple=True):
-        # TODO: Delete me?
-        #users = { user.id: user for users in self.get_users() }
+    def get_query_groups(self, multiple=True, key=QueryGroupKey.TEXT, spill_dir=None,
+            npartitions=QUERY_GROUP_PARTITIONS):
+        """Returns a generator over the QueryGroups of the interactive queries.
+
+        Each interactive query is returned in a QueryGroup whose copies are all
+        the interactive queries with the same text, including itself. The
+        groups are formed in a single pass over the queries, keyed either by
+        the text itself or by a hash of it, which keeps the memory held by the
+        keys small when the texts are long.
+
+        If `spill_dir` is given, the queries are first partitioned by key into
+        `npartitions` files in a temporary directory under `spill_dir`, and
+        then grouped one partition at a time, so that only one partition needs
+        to fit in memory.
+
+        :param self: The current source object
+        :type self: queryutils.DataSource
+        :param multiple: Only return groups of queries with more than one copy
+        :type multiple: bool
+        :param key: What to group the queries by (one of the attributes of queryutils.source.QueryGroupKey)
+        :type key: str
+        :param spill_dir: The directory to partition the queries into, if any
+        :type spill_dir: str
+        :param npartitions: The number of partitions to use when spilling to disk
+        :type npartitions: int
+        :rtype: generator
+        """
+        keyfn = QUERY_GROUP_KEYS[key]
+        queries = self.get_interactive_queries()
+        if spill_dir is None:
+            groups = self._group_queries(queries, keyfn)
+        else:
+            groups = self._group_queries_on_disk(queries, keyfn, spill_dir, npartitions)
         iter = 0
-        for query in self.get_interactive_queries():
-            #query.user = users[query.user_id]
-            query_group = QueryGroup(query)
-            query_group.id = query.id
-            query_group.copies = [q for q in self.get_interactive_queries_with_text(query.text)]
-            if len(query_group.copies) <= 1 and multiple:
+        for copies in groups:
+            if len(copies) <= 1 and multiple:
                 logger.debug("Query has no copies.")
                 continue
-            yield query_group
-            if iter % 10 == 0:
-                logger.debug("Returned %d query groups." % iter)
-            iter += 1
-            #if iter > 2000: break
-            #for copy in query.copies:
-            #    copy.user = users[copy.user_id]
-            
-        #groups = defaultdict(list)
-        #for user in self.get_users_with_queries():
-        #    for query in user.queries:
-        #        groups[query.text].append(query)
-        #for (text, group) in groups.iteritems():
-        #    for query in group:
-        #        qg = QueryGroup(query)
-        #        qg.copies = group
-        #        yield qg
+            for query in copies:
+                query_group = QueryGroup(query)
+                query_group.id = query.id
+                query_group.copies = copies
+                yield query_group
+                if iter % 10 == 0:
+                    logger.debug("Returned %d query groups." % iter)
+                iter += 1
+
+    def _group_queries(self, queries, keyfn):
+        """Group the given queries in memory by the given key.
+
+        :param self: The current source object
+        :type self: queryutils.DataSource
+        :param queries: The queries to group
+        :type queries: iterable
+        :param keyfn: The function returning the key of a query's text
+        :type keyfn: function
+        :rtype: list
+        """
+        groups = OrderedDict()
+        for query in queries:
+            groups.setdefault(keyfn(query.text), []).append(query)
+        return groups.values()
+
+    def _group_queries_on_disk(self, queries, keyfn, spill_dir, npartitions):
+        """Group the given queries by the given key, one on-disk partition at a time.
+
+        The queries are written to the partitions without their users and
+        sessions, so the queries in the groups returned have neither.
+
+        :param self: The current source object
+        :type self: queryutils.DataSource
+        :param queries: The queries to group
+        :type queries: iterable
+        :param keyfn: The function returning the key of a query's text
+        :type keyfn: function
+        :param spill_dir: The directory to create the partitions in
+        :type spill_dir: str
+        :param npartitions: The number of partitions
+        :type npartitions: int
+        :rtype: generator
+        """
+        tmpdir = mkdtemp(prefix="querygroups", dir=spill_dir)
+        try:
+            paths = [path.join(tmpdir, "%d.pickle" % i) for i in range(npartitions)]
+            partitions = [open(p, "wb") for p in paths]
+            try:
+                for query in queries:
+                    k = keyfn(query.text)
+                    state = query.attributes()
+                    state["user"] = None
+                    state["session"] = None
+                    pickle.dump(state, partitions[hash(k) % npartitions], pickle.HIGHEST_PROTOCOL)
+            finally:
+                for partition in partitions:
+                    partition.close()
+            for p in paths:
+                with open(p, "rb") as partition:
+                    states = []
+                    while True:
+                        try:
+                            states.append(pickle.load(partition))
+                        except EOFError:
+                            break
+                remove(p)
+                for copies in self._group_queries(self._queries_from_states(states), keyfn):
+                    yield copies
+        finally:
+            rmtree(tmpdir, ignore_errors=True)
+
+    def _queries_from_states(self, states):
+        """Recreate the queries written to a partition.
+
+        :param self: The current source object
+        :type self: queryutils.DataSource
+        :param states: The attributes of each query
+        :type states: list
+        :rtype: generator
+        """
+        for state in states:
+            query = Query(state["text"], state["time"])
+            query.update(state)
+            yield query
 
     def extract_command_stage(self, parsetree, commands):
         """Extract the subtrees of the given parsetree that have one of the given commands.
@@ -1,5 +1,5 @@
 from splparser.parsetree import ParseTreeNode
-from parse import tokenize_query
+from parse import EXTERNAL_COMMAND, MACRO, NONCOMMANDS, tokenized
 from logging import getLogger as get_logger
 
 logger = get_logger("queryutils")
@@ -112,32 +112,33 @@ category = {
 def lookup_categories(querystring):
     """Lookup the category for each command in the query and return them in a list in order.
     
-    :param querystring: The query whose commands will be looked up
-    :type querystring: str
+    :param querystring: The query whose commands will be looked up, or the query already tokenized
+    :type querystring: str or queryutils.parse.TokenizedQuery
     :rtype: list
     """
-    tokens = tokenize_query(querystring)
+    tokens = tokenized(querystring)
     categories = []
-    for idx, token in enumerate(tokens):
-        if token.type == "EXTERNAL_COMMAND":
-            categories.append(category.get(token.value, "Miscellaneous"))
-        elif token.type == "MACRO":
+    for idx, code in enumerate(tokens.types):
+        value = tokens.value(idx)
+        if code == EXTERNAL_COMMAND:
+            categories.append(category.get(value, "Miscellaneous"))
+        elif code == MACRO:
             categories.append("Macro")
-        elif token.type not in ["ARGS", "PIPE", "LBRACKET", "RBRACKET"]:
-            command = token.value.lower()
+        elif code not in NONCOMMANDS:
+            command = value.lower()
             # Note: This is an imperfect way to detect this.
             # See below for an example.
-            if token.value == "addtotals":
+            if value == "addtotals":
                 if len(tokens) == idx+1:
                     command = "addtotals row"
-                elif tokens[idx+1].value.lower()[:3] == "row":
+                elif tokens.value(idx+1).lower()[:3] == "row":
                     command = "addtotals row"
                 else:
                     command = "addtotals col"
             try:
                 categories.append(lookup_category(command))
             except KeyError as e:
-                logger.error("Unknown command type: %s" % token.value)
+                logger.error("Unknown command type: %s" % value)
     return categories
 
 
@@ -119,3 +119,49 @@ INIT_PARSETREES = {
         );"""
     ]
 }
+
+SECONDARY_INDICES = [
+    ("sessions_user_id", "sessions", "user_id"),
+    ("parsetrees_query_id", "parsetrees", "query_id"),
+    ("queries_session_id", "queries", "session_id"),
+    ("queries_user_id", "queries", "user_id"),
+]
+
+SQLITE3_FAST_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA cache_size=-262144;", # in KiB, i.e., 256 MB
+    "PRAGMA temp_store=MEMORY;"
+]
+
+SQLITE3_SAFE_PRAGMAS = [
+    "PRAGMA journal_mode=DELETE;",
+    "PRAGMA synchronous=FULL;",
+    "PRAGMA cache_size=-2000;",
+    "PRAGMA temp_store=DEFAULT;"
+]
+
+SESSIONIZE_QUERIES = [
+    "DROP TABLE IF EXISTS session_assignments;",
+    """CREATE TEMPORARY TABLE session_assignments AS
+        SELECT id, user_id,
+            SUM(is_start) OVER (ORDER BY user_id, time, id ROWS UNBOUNDED PRECEDING) - 1 AS session_id
+        FROM (
+            SELECT id, user_id, time,
+                CASE WHEN time - LAG(time) OVER (PARTITION BY user_id ORDER BY time, id) <= %(threshold)r
+                    THEN 0 ELSE 1 END AS is_start
+            FROM queries
+            WHERE user_id IS NOT NULL AND time IS NOT NULL AND is_interactive %(filter)s
+        ) AS starts;""",
+    "CREATE INDEX session_assignments_id ON session_assignments (id);",
+    "UPDATE queries SET %(column)s = NULL WHERE %(column)s IS NOT NULL;",
+    "DELETE FROM %(table)s;",
+    """INSERT INTO %(table)s (id, user_id)
+        SELECT session_id, MIN(user_id) FROM session_assignments GROUP BY session_id;""",
+    """UPDATE queries SET %(column)s = (
+            SELECT session_id FROM session_assignments WHERE session_assignments.id = queries.id)
+        WHERE id IN (SELECT id FROM session_assignments);""",
+    "DROP TABLE session_assignments;"
+]
+
+SESSIONIZE_REMOVE_SUSPICIOUS = "AND (is_suspicious IS NULL OR NOT is_suspicious)"
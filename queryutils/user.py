@@ -1,9 +1,16 @@
 from json import JSONEncoder
+from queryutils.records import Record
 
-class User(object):
+class User(Record):
     """Represents a user object.
+
+    Users store their attributes in slots, so only the attributes listed in
+    `__slots__` can be set (see queryutils.records.Record).
     """
 
+    __slots__ = ["name", "sessions", "queries", "noninteractive_queries", "interactive_queries",
+        "case_id", "user_type", "id", "suspicious"]
+
     def __init__(self, name):
         """Create a User object.
 
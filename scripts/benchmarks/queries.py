@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import sys
+
+from os import path
+from queryutils import csvparser, jsonparser
+from queryutils.compression import has_suffix
+from queryutils.session import Session
+from queryutils.user import User
+
+DATA = path.join(path.dirname(path.realpath(__file__)), "..", "..", "test", "data")
+FILES = [path.join(DATA, "format2012.json"), path.join(DATA, "format2014.csv")]
+
+class DictRecord(object):
+    """A stand-in for a Query, User or Session with the same attributes in a per-instance dict.
+    """
+    pass
+
+def main(filenames):
+    for filename in filenames:
+        module = jsonparser if has_suffix(filename, ".json") else csvparser
+        users = {}
+        module.get_users_from_file(filename, users)
+        queries = [query for user in users.itervalues() for query in user.queries]
+        for query in queries:
+            query.delta = 0. # As set when the user's queries are sessionized.
+        print filename, "(%d queries)" % len(queries)
+        report("Query", queries)
+        report("User", users.values())
+        report("Session", [Session(1, user) for user in users.itervalues()])
+
+def report(name, records):
+    if not records:
+        return
+    slotted = sum(sys.getsizeof(record) for record in records)
+    unslotted = sum(record_size(as_dict_record(record)) for record in records)
+    print "\t%s with a dict:\t%.0f bytes each" % (name, float(unslotted) / len(records))
+    print "\t%s with slots:\t%.0f bytes each (%.1f%% saved)" % \
+        (name, float(slotted) / len(records), 100. * (unslotted - slotted) / unslotted)
+
+def as_dict_record(record):
+    copy = DictRecord()
+    copy.__dict__.update(record.attributes())
+    return copy
+
+def record_size(record):
+    """Return the number of bytes taken by the given object and its dict, but not the attributes' values.
+    """
+    return sys.getsizeof(record) + sys.getsizeof(record.__dict__)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser("Report the bytes taken by each query, user and session object.")
+    parser.add_argument("files", nargs="*", default=FILES,
+                        help="the .csv or .json files to read (defaults to the test data)")
+    args = parser.parse_args()
+    main(args.files)
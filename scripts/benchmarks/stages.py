@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+from os import path
+from queryutils import csvparser, jsonparser
+from queryutils.compression import has_suffix
+from queryutils.parse import configure_parse_cache, find_stage_offsets, split_query_into_stages, \
+    TokenizedQuery
+from time import time
+
+DATA = path.join(path.dirname(path.realpath(__file__)), "..", "..", "test", "data")
+FILES = [path.join(DATA, "format2012.json"), path.join(DATA, "format2014.csv")]
+REPEAT = 200
+
+def main(filenames, repeat=REPEAT):
+    # Tokenize every time, rather than look the tokens up in the parse cache.
+    configure_parse_cache(max_size=0)
+    for filename in filenames:
+        texts = read_texts(filename)
+        print filename, "(%d queries)" % len(texts)
+        texts = texts * repeat
+        old = benchmark(texts, split_query_into_stages)
+        new = benchmark(texts, find_stage_offsets)
+        print "\tsplit_query_into_stages:\t%.0f queries/s" % old
+        print "\tfind_stage_offsets:\t\t%.0f queries/s (%.1fx)" % (new, new / old)
+        mismatches = [text for text in set(texts) if find_stage_offsets(text) != TokenizedQuery(text).stage_offsets]
+        print "\tMismatches with the lexer:\t%d" % len(mismatches)
+
+def read_texts(filename):
+    module = jsonparser if has_suffix(filename, ".json") else csvparser
+    users = {}
+    module.get_users_from_file(filename, users)
+    return [query.text for user in users.itervalues() for query in user.queries]
+
+def benchmark(texts, split):
+    start = time()
+    for text in texts:
+        split(text)
+    return len(texts) / (time() - start)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser("Compare the speed of splitting queries into stages with and without the lexer.")
+    parser.add_argument("files", nargs="*", default=FILES,
+                        help="the .csv or .json files to read (defaults to the test data)")
+    parser.add_argument("-n", "--repeat", type=int, default=REPEAT,
+                        help="the number of times to split each query")
+    args = parser.parse_args()
+    main(args.files, repeat=args.repeat)
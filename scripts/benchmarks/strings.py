@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import sys
+
+from os import path
+from queryutils import csvparser, jsonparser
+from queryutils.compression import has_suffix
+from queryutils.interning import StringPool
+
+DATA = path.join(path.dirname(path.realpath(__file__)), "..", "..", "test", "data")
+FILES = [path.join(DATA, "format2012.json"), path.join(DATA, "format2014.csv")]
+QUERY_STRINGS = ["text", "search_type", "splunk_search_id", "saved_search_name"]
+
+def main(filenames):
+    for filename in filenames:
+        module = jsonparser if has_suffix(filename, ".json") else csvparser
+        unshared = read_users(module, filename, StringPool(max_size=0))
+        strings = StringPool()
+        shared = read_users(module, filename, strings)
+        nqueries = sum(len(user.queries) for user in shared)
+        old = strings_size(unshared)
+        new = strings_size(shared)
+        print filename, "(%d users, %d queries)" % (len(shared), nqueries)
+        print "\tWithout interning:\t%d bytes of strings" % old
+        print "\tWith interning:\t\t%d bytes of strings (%.1f%% saved, %d of %d strings shared)" % \
+            (new, 100. * (old - new) / old if old > 0 else 0., strings.nhits, strings.nhits + strings.nmisses)
+
+def read_users(module, filename, strings):
+    users = {}
+    module.get_users_from_file(filename, users, strings=strings)
+    return users.values()
+
+def strings_size(users):
+    """Return the number of bytes taken by the distinct string objects the users refer to.
+    """
+    seen = set()
+    nbytes = 0
+    for user in users:
+        values = [user.name, user.case_id]
+        for query in user.queries:
+            values.extend(getattr(query, attribute) for attribute in QUERY_STRINGS)
+        for value in values:
+            if value is not None and id(value) not in seen:
+                seen.add(id(value))
+                nbytes += sys.getsizeof(value)
+    return nbytes
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser("Report the memory saved by sharing the strings read from query logs.")
+    parser.add_argument("files", nargs="*", default=FILES,
+                        help="the .csv or .json files to read (defaults to the test data)")
+    args = parser.parse_args()
+    main(args.files)
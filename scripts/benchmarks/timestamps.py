@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import csv
+import dateutil.parser
+import json
+
+from os import path
+from queryutils.timestamps import TimestampDecoder, decode_with_dateutil
+from time import time
+
+DATA = path.join(path.dirname(path.realpath(__file__)), "..", "..", "test", "data")
+FILES = ["format2012.json", "format2013.csv", "format2014.csv"]
+REPEAT = 2000
+
+def main(repeat=REPEAT):
+    for filename in FILES:
+        timestamps = read_timestamps(path.join(DATA, filename)) * repeat
+        print filename, "(%d timestamps)" % len(timestamps)
+        old = benchmark(timestamps, decode_with_strftime)
+        decoder = TimestampDecoder()
+        new = benchmark(timestamps, decoder.decode)
+        print "\tdateutil + strftime:\t%.0f rows/s" % old
+        print "\tTimestampDecoder:\t%.0f rows/s (%.1fx, %d fell back to dateutil)" % \
+            (new, new / old, decoder.nfallbacks)
+        mismatches = [t for t in set(timestamps) if is_timestamp(t) and \
+            TimestampDecoder().decode(t) != decode_with_dateutil(t)]
+        print "\tMismatches with dateutil:\t%d" % len(mismatches)
+
+def read_timestamps(filename):
+    if filename.endswith(".json"):
+        return [result["_time"] for result in json.load(open(filename)) if "_time" in result]
+    with open(filename) as datafile:
+        return [row["_time"] for row in csv.DictReader(datafile) if is_timestamp(row["_time"])]
+
+def is_timestamp(timestamp):
+    return timestamp[:1].isdigit()
+
+def decode_with_strftime(timestamp):
+    return float(dateutil.parser.parse(timestamp).strftime('%s.%f'))
+
+def benchmark(timestamps, decode):
+    start = time()
+    for timestamp in timestamps:
+        decode(timestamp)
+    return len(timestamps) / (time() - start)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser("Compare the speed of decoding the timestamps in the test data.")
+    parser.add_argument("-n", "--repeat", type=int, default=REPEAT,
+                        help="the number of times to decode each timestamp")
+    args = parser.parse_args()
+    main(repeat=args.repeat)
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
-from queryutils.databases import PostgresDB, SQLite3DB
+from queryutils.checkpoint import Checkpoint
+from queryutils.databases import BULK_BATCH_SIZE, PostgresDB, SQLite3DB
 from queryutils.files import CSVFiles, JSONFiles
-from queryutils.parse import parse_query
+from queryutils.parallel import CHUNK_SIZE
+from queryutils.parse import configure_parse_budget, configure_parse_cache
+
+import queryutils.parse
 
 SOURCES = {
     "csvfiles": (CSVFiles, ["srcpath", "version"]),
@@ -20,85 +24,80 @@ SESSION_THRESHOLD = 30.*60. # in seconds
 
 def main(src, dst, args, parse=False, 
         sessionthresh=SESSION_THRESHOLD,
-        resessionize=False):
+        sessionize=False,
+        batchsize=BULK_BATCH_SIZE,
+        copy=False,
+        in_database=False,
+        checkpoint=None,
+        parsecache=None,
+        processes=None,
+        chunksize=CHUNK_SIZE,
+        timelimit=None,
+        maxlength=None,
+        quarantine=None):
+    if parsecache is not None:
+        configure_parse_cache(path=parsecache)
+    configure_parse_budget(seconds=timelimit, max_length=maxlength, quarantine=quarantine)
     dst_class = DESTINATIONS[dst][0]
     dst_args = lookup(args, DESTINATIONS[dst][1])
     destination = dst_class(*dst_args)
+    if copy:
+        src_class = SOURCES[src][0]
+        src_args = lookup(args, SOURCES[src][1])
+        source = src_class(*src_args)
+        nrows = destination.copy_users_and_queries(source, parsed=parse, processes=processes,
+            chunk_size=chunksize, batch_size=batchsize)
+        print "Copied %d rows." % nrows
+        return
+    if checkpoint is not None:
+        src_class = SOURCES[src][0]
+        src_args = lookup(args, SOURCES[src][1])
+        source = src_class(*src_args)
+        load_new(source, destination, checkpoint, parse=parse, processes=processes,
+            chunksize=chunksize, batchsize=batchsize)
+        return
     if parse:
-        load_parsed(destination)
+        load_parsed(destination, processes=processes, chunksize=chunksize, batchsize=batchsize)
+        print_parse_cache_stats()
         return
-    if resessionize:
-        resessionize(destination, sessionthresh)
+    if sessionize:
+        resessionize(destination, sessionthresh, in_database=in_database)
         return
     src_class = SOURCES[src][0]
     src_args = lookup(args, SOURCES[src][1])
     source = src_class(*src_args)
-    load_base(source, destination)
+    load_base(source, destination, batchsize=batchsize)
     #load_sessions(destination, sessionthresh)
 
 def lookup(map, keys):
     return [map[k] for k in keys]
 
-def load_parsed(db):
-    db.connect()
-    cursor = db.execute("SELECT id, text FROM queries")
-    for row in cursor.fetchall():
-        d = { k:row[k] for k in row.keys() }
-        parsetree = parse_query(row["text"])
-        if parsetree is not None:
-            parsetree.query_id = row["id"]
-            insert_parsetree(db, parsetree)
-    db.close()
-
-def insert_parsetree(dst, parsetree):
-    dst.execute("INSERT INTO parsetrees \
-            (parsetree, query_id) \
-            VALUES (" + ", ".join([dst.wildcard]*2) +")",
-            (parsetree.dumps(), parsetree.query_id))
-    dst.commit()
+def load_parsed(db, processes=None, chunksize=CHUNK_SIZE, batchsize=BULK_BATCH_SIZE):
+    nrows = db.load_parsed(processes=processes, chunk_size=chunksize, batch_size=batchsize)
+    print "Loaded %d parsetrees." % nrows
 
-def resessionize(dst, threshold):
-    dst.sessionize_queries(threshold)
+def print_parse_cache_stats():
+    stats = queryutils.parse.parse_cache.stats()
+    print "Parsed %(misses)d query texts, and found %(hits)d in the parse cache " \
+        "and %(disk_hits)d on disk." % stats
 
-def load_base(src, dst):
-    src.connect()
-    dst.connect()
-    uid = qid = 1
-    for user in src.get_users_with_queries():
-        print "Loading user."
-        insert_user(dst, user, uid)
-        for query in user.queries:
-            print "Loading query."
-            insert_query(dst, query, qid, uid, None)
-            qid += 1
-        uid += 1
-    dst.close()
-    src.close()
+def resessionize(dst, threshold, in_database=False):
+    dst.sessionize_queries(threshold=threshold, remove_suspicious=True, in_database=in_database)
 
-def insert_user(dst, user, uid):
-    dst.execute("INSERT INTO users \
-            (id, name, case_id, user_type) \
-            VALUES (" + ",".join([dst.wildcard]*4) + ")", 
-            (uid, user.name, user.case_id, user.user_type))
-    dst.commit()
+def load_base(src, dst, batchsize=BULK_BATCH_SIZE):
+    nrows = dst.bulk_load_users_and_queries(src, batch_size=batchsize)
+    print "Loaded %d rows." % nrows
 
-def insert_query(dst, query, qid, uid, sid):
-    dst.execute("INSERT INTO queries \
-            (id, text, time, is_interactive, is_suspicious, \
-            execution_time, earliest_event, latest_event, range, is_realtime, \
-            search_type, splunk_search_id, saved_search_name, \
-            user_id, session_id) \
-            VALUES ("+ ",".join([dst.wildcard]*15) +")",
-            (qid, query.text, query.time, query.is_interactive, query.is_suspicious,
-            query.execution_time, query.earliest_event, query.latest_event,
-            query.range, query.is_realtime, query.search_type,
-            query.splunk_search_id, query.saved_search_name, uid, sid))
-    dst.commit()
+def load_new(src, dst, checkpoint, parse=False, processes=None, chunksize=CHUNK_SIZE,
+        batchsize=BULK_BATCH_SIZE):
+    nrows = dst.append_users_and_queries(src, Checkpoint(checkpoint), parsed=parse, processes=processes,
+        chunk_size=chunksize, batch_size=batchsize)
+    print "Appended %d rows." % nrows
 
 def load_sessions(dst, sessionthresh):
     #dst.mark_suspicious_users()
     #dst.mark_suspicious_queries()
-    dst.sessionize_queries(sessionthresh, remove_suspicious=True)
+    dst.sessionize_queries(threshold=sessionthresh, remove_suspicious=True)
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
@@ -108,8 +107,40 @@ if __name__ == "__main__":
                             requires that base data already be loaded")
     parser.add_argument("-r", "--resessionize", action="store_true",
                         help="re-sessionize the query data with the given threshold")
-    parser.add_argument("-e", "--threshold",
+    parser.add_argument("-e", "--threshold", type=float, default=SESSION_THRESHOLD,
                         help="the session cutoff threshold in number of seconds")
+    parser.add_argument("-i", "--in-database", action="store_true",
+                        help="with -r, form the sessions inside the database \
+                            with window functions")
+    parser.add_argument("-c", "--copy", action="store_true",
+                        help="load the base data with COPY (postgresdb only) -- \
+                            with -t, also parse the queries and load the parsetrees")
+    parser.add_argument("-k", "--checkpoint",
+                        help="load only the data added to the source (csvfiles or \
+                            jsonfiles) since the last load with this checkpoint \
+                            file, and update it -- with -t, also parse the new \
+                            queries and load their parsetrees")
+    parser.add_argument("-x", "--parsecache",
+                        help="the path to a SQLite database in which to cache \
+                            parsetrees across loads")
+    parser.add_argument("-j", "--processes", type=int,
+                        help="with -t, the number of processes to parse the \
+                            queries with")
+    parser.add_argument("-z", "--chunksize", type=int, default=CHUNK_SIZE,
+                        help="with -t and -j, the number of queries to send to \
+                            a process at a time")
+    parser.add_argument("-l", "--timelimit", type=float,
+                        help="with -t, the number of seconds to spend parsing \
+                            any one query")
+    parser.add_argument("-m", "--maxlength", type=int,
+                        help="with -t, the length in bytes of the longest \
+                            query to parse")
+    parser.add_argument("-o", "--quarantine",
+                        help="with -t, the path to a file in which to record \
+                            the queries over the time or length limit, so \
+                            they are skipped by later loads")
+    parser.add_argument("-n", "--batchsize", type=int, default=BULK_BATCH_SIZE,
+                        help="the number of rows to insert per transaction")
     parser.add_argument("-s", "--source",
                         help="one of: " + ", ".join(SOURCES.keys()))
     parser.add_argument("-d", "--destination",
@@ -130,4 +161,14 @@ if __name__ == "__main__":
     main(args.source, args.destination, vars(args), 
         parse=args.trees,
         sessionthresh=args.threshold,
-        resessionize=args.resessionize)
+        sessionize=args.resessionize,
+        batchsize=args.batchsize,
+        copy=args.copy,
+        in_database=args.in_database,
+        checkpoint=args.checkpoint,
+        parsecache=args.parsecache,
+        processes=args.processes,
+        chunksize=args.chunksize,
+        timelimit=args.timelimit,
+        maxlength=args.maxlength,
+        quarantine=args.quarantine)
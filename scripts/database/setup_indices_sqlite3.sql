@@ -0,0 +1,4 @@
+create index if not exists sessions_user_id on sessions(user_id);
+create index if not exists parsetrees_query_id on parsetrees(query_id);
+create index if not exists queries_session_id on queries(session_id);
+create index if not exists queries_user_id on queries(user_id);
@@ -1,23 +1,10 @@
 
 from queryutils.databases import PostgresDB
-from queryutils.parse import tokenize_query
+from queryutils.parse import TokenizedQuery
 
 def print_eval_portions(query):
-    eval = []
-    push = False
-    for token in tokenize_query(query):
-        if token.type == "PIPE":
-            if len(eval) > 0:
-                print " ".join(eval)
-                eval = []
-            push = False
-        if push:
-            eval.append(token.value)
-            continue
-        if token.type == "EVAL":
-            push = True
-            eval.append(token.value)
-            continue
+    for eval in TokenizedQuery(query).evals:
+        print eval
 
 l = "lupe"
 p = PostgresDB(l, l, l)
@@ -0,0 +1,141 @@
+import json
+import shutil
+import signal
+import unittest
+from os import path
+from queryutils import csvparser
+from queryutils.budget import RECURSION, TIMEOUT, TOO_LONG, ParseBudget, Quarantine
+from queryutils.parse import configure_parse_budget, configure_parse_cache, parse_query, try_parse
+from tempfile import mkdtemp
+from time import time
+
+
+class Counter(object):
+    """A parse function that counts its calls and returns its input.
+    """
+
+    def __init__(self):
+        self.ncalls = 0
+
+    def __call__(self, text):
+        self.ncalls += 1
+        return text
+
+
+def spin(text):
+    while True:
+        pass
+
+def recurse(text):
+    raise RuntimeError("maximum recursion depth exceeded")
+
+def wrapped_recursion(text):
+    raise Exception("Failed to parse stage", RuntimeError("maximum recursion depth exceeded"))
+
+def fail(text):
+    raise ValueError("not a budget problem")
+
+
+class ParseBudgetTestCase(unittest.TestCase):
+    """
+    Tests for queryutils.budget.ParseBudget and Quarantine
+    """
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.path = path.join(self.tmpdir, "quarantine.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_within_budget(self):
+        counter = Counter()
+        budget = ParseBudget(seconds=1., max_length=10, quarantine=Quarantine(self.path))
+        self.assertEqual(budget.parse("search a", counter), ("search a", None))
+        self.assertEqual(counter.ncalls, 1)
+        self.assertFalse(path.isfile(self.path))
+
+    def test_too_long(self):
+        counter = Counter()
+        budget = ParseBudget(seconds=None, max_length=10)
+        self.assertEqual(budget.parse("search " + "a" * 10, counter), (None, TOO_LONG))
+        self.assertEqual(counter.ncalls, 0)
+
+    def test_timeout(self):
+        handler = signal.getsignal(signal.SIGALRM)
+        budget = ParseBudget(seconds=0.1, max_length=None)
+        start = time()
+        self.assertEqual(budget.parse("search a", spin), (None, TIMEOUT))
+        self.assertTrue(time() - start < 5.)
+        self.assertEqual(signal.getsignal(signal.SIGALRM), handler)
+        self.assertEqual(budget.parse("search a", Counter()), ("search a", None))
+
+    def test_recursion(self):
+        budget = ParseBudget(seconds=None, max_length=None)
+        self.assertEqual(budget.parse("search a", recurse), (None, RECURSION))
+        self.assertEqual(budget.parse("search a", wrapped_recursion), (None, RECURSION))
+        self.assertRaises(ValueError, budget.parse, "search a", fail)
+
+    def test_skipped_on_rerun(self):
+        budget = ParseBudget(seconds=0.1, max_length=20, quarantine=Quarantine(self.path))
+        self.assertEqual(budget.parse("search slow", spin), (None, TIMEOUT))
+        self.assertEqual(budget.parse("search " + "a" * 20, Counter()), (None, TOO_LONG))
+        with open(self.path, "a") as quarantinefile:
+            quarantinefile.write("{\"key\": \"cut sho") # a line cut short by an interrupted run
+        counter = Counter()
+        rerun = ParseBudget(seconds=0.1, max_length=100, quarantine=Quarantine(self.path))
+        self.assertEqual(rerun.parse("search slow", counter), (None, "quarantined (%s)" % TIMEOUT))
+        self.assertEqual(rerun.parse("search " + "a" * 20, counter), (None, "quarantined (%s)" % TOO_LONG))
+        self.assertEqual(rerun.parse("search fast", counter), ("search fast", None))
+        self.assertEqual(counter.ncalls, 1)
+
+    def test_quarantine_records(self):
+        quarantine = Quarantine(self.path)
+        quarantine.add("search caf\xc3\xa9 " + "x" * 500, TIMEOUT, 1.23456)
+        with open(self.path) as quarantinefile:
+            records = [json.loads(line) for line in quarantinefile]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["reason"], TIMEOUT)
+        self.assertEqual(records[0]["seconds"], 1.235)
+        self.assertEqual(records[0]["length"], 513)
+        self.assertTrue(records[0]["text"].startswith(u"search caf\xe9 x"))
+        self.assertEqual(Quarantine(self.path).reason("search caf\xc3\xa9 " + "x" * 500), TIMEOUT)
+
+
+class ParseQueryBudgetTestCase(unittest.TestCase):
+    """
+    Tests for parsing with a budget with queryutils.parse.parse_query
+    """
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        users = {}
+        csvparser.get_users_from_file(path.join(thisdir, "data/format2014.csv"), users)
+        self.texts = [query.text for user in users.itervalues() for query in user.queries]
+        self.tmpdir = mkdtemp()
+        self.path = path.join(self.tmpdir, "quarantine.jsonl")
+        configure_parse_cache(max_size=0)
+
+    def tearDown(self):
+        configure_parse_budget(seconds=None, max_length=None, quarantine=None)
+        configure_parse_cache()
+        shutil.rmtree(self.tmpdir)
+
+    def test_quarantined_on_rerun(self):
+        longest = max(len(text) for text in self.texts)
+        configure_parse_budget(seconds=None, max_length=longest - 1, quarantine=self.path)
+        parsetrees = [parse_query(text) for text in self.texts]
+        self.assertEqual(len([p for p in parsetrees if p is None]), len([t for t in self.texts if len(t) == longest]))
+        configure_parse_budget(seconds=None, max_length=None, quarantine=self.path)
+        for text in self.texts:
+            (parsetree, error) = try_parse(text)
+            if len(text) == longest:
+                self.assertEqual((parsetree, error), (None, "Query over parse budget: quarantined (%s)" % TOO_LONG))
+            else:
+                self.assertTrue(parsetree is not None)
+        configure_parse_budget(seconds=None, max_length=None, quarantine=None)
+        self.assertTrue(all(parse_query(text) is not None for text in self.texts))
+
+
+if __name__ == "__main__":
+    unittest.main()
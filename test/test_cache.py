@@ -0,0 +1,155 @@
+import os
+import shutil
+import unittest
+from collections import OrderedDict
+from os import path
+from queryutils import csvparser, jsonparser
+from queryutils.cache import CACHE_SUFFIX, Cache, StringReader, StringTable, arrays_from_users, \
+    read_cache_file, users_from_arrays, write_cache_file
+from queryutils.query import Query
+from queryutils.user import User
+from queryutils.versions import Version
+from tempfile import mkdtemp
+
+
+ATTRIBUTES = ["text", "time", "is_interactive", "is_realtime", "execution_time", "earliest_event",
+    "latest_event", "range", "search_type", "splunk_search_id", "saved_search_name"]
+
+
+def snapshot(users):
+    """Return the users, in order, with their queries' attributes in order.
+    """
+    out = []
+    for (key, user) in users.iteritems():
+        out.append((key, user.name, user.case_id, [tuple(getattr(query, a) for a in ATTRIBUTES) for query in user.queries]))
+        assert all(query.user is user for query in user.queries)
+    return out
+
+
+class CountingReader(object):
+    """Reads files with the given module, counting how many times it does.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.nreads = 0
+
+    def get_users_from_file(self, filename, users, fields=None):
+        self.nreads += 1
+        self.module.get_users_from_file(filename, users, fields=fields)
+
+
+class CacheTestCase(unittest.TestCase):
+    """
+    Tests for caching the users read from files with queryutils.cache.Cache
+    """
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        self.tmpdir = mkdtemp()
+        self.csvfile = path.join(self.tmpdir, "format2014.csv")
+        self.jsonfile = path.join(self.tmpdir, "format2012.json")
+        shutil.copy(path.join(thisdir, "data/format2014.csv"), self.csvfile)
+        shutil.copy(path.join(thisdir, "data/format2012.json"), self.jsonfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, module, filename):
+        users = OrderedDict()
+        module.get_users_from_file(filename, users)
+        return users
+
+    def test_arrays_round_trip(self):
+        for (module, filename) in [(csvparser, self.csvfile), (jsonparser, self.jsonfile)]:
+            users = self.read(module, filename)
+            self.assertEqual(snapshot(users_from_arrays(arrays_from_users(users))), snapshot(users))
+
+    def test_unusual_values_round_trip(self):
+        users = OrderedDict()
+        user = User(u"caf\xe9")
+        user.case_id = None
+        users[u"caf\xe9"] = user
+        for (text, time) in [(u"search na\xefve | eval x=\"\t\"", 1.5), (u"", None), (u"search \x00", -2.25)]:
+            query = Query(text, time)
+            query.is_realtime = None
+            query.is_interactive = True
+            query.range = float("inf")
+            query.user = user
+            user.queries.append(query)
+        users[u"nobody"] = User(u"nobody")
+        self.assertEqual(snapshot(users_from_arrays(arrays_from_users(users))), snapshot(users))
+
+    def test_file_round_trip(self):
+        users = self.read(csvparser, self.csvfile)
+        cachefile = path.join(self.tmpdir, "users" + CACHE_SUFFIX)
+        write_cache_file(cachefile, {"fingerprint": "test"}, arrays_from_users(users))
+        (header, arrays) = read_cache_file(cachefile)
+        self.assertEqual(header["fingerprint"], "test")
+        self.assertEqual(snapshot(users_from_arrays(arrays)), snapshot(users))
+        self.assertEqual([name for name in os.listdir(self.tmpdir) if name.endswith(CACHE_SUFFIX)],
+            ["users" + CACHE_SUFFIX])
+
+    def test_cache_reads_file_once(self):
+        for (module, filename) in [(csvparser, self.csvfile), (jsonparser, self.jsonfile)]:
+            expected = snapshot(self.read(module, filename))
+            reader = CountingReader(module)
+            for i in range(3):
+                users = OrderedDict()
+                Cache(Version.FORMAT_2014).get_users_from_file(reader, filename, users)
+                self.assertEqual(snapshot(users), expected)
+            self.assertEqual(reader.nreads, 1)
+            self.assertTrue(path.isfile(filename + CACHE_SUFFIX))
+
+    def test_cache_directory(self):
+        cachedir = path.join(self.tmpdir, "cache")
+        os.mkdir(cachedir)
+        cache = Cache(Version.FORMAT_2014, directory=cachedir)
+        reader = CountingReader(csvparser)
+        for i in range(2):
+            cache.get_users_from_file(reader, self.csvfile, OrderedDict())
+        self.assertEqual(reader.nreads, 1)
+        self.assertEqual(os.listdir(cachedir), [path.basename(cache.cache_path(self.csvfile))])
+
+    def test_stale_cache(self):
+        cache = Cache(Version.FORMAT_2014)
+        reader = CountingReader(csvparser)
+        cache.get_users_from_file(reader, self.csvfile, OrderedDict())
+        with open(self.csvfile, "a") as datafile:
+            datafile.write("case_9,adhoc,true,1.0,newuser,\"search new\",,N/A,N/A,,0.5,2014-01-13T03:47:33.910-0800\n")
+        users = OrderedDict()
+        cache.get_users_from_file(reader, self.csvfile, users)
+        self.assertEqual(reader.nreads, 2)
+        self.assertEqual(snapshot(users), snapshot(self.read(csvparser, self.csvfile)))
+        Cache(Version.FORMAT_2013).get_users_from_file(reader, self.csvfile, OrderedDict())
+        self.assertEqual(reader.nreads, 3)
+
+    def test_corrupt_cache(self):
+        cache = Cache(Version.FORMAT_2014)
+        with open(cache.cache_path(self.csvfile), "w") as cachefile:
+            cachefile.write("not a cache")
+        reader = CountingReader(csvparser)
+        users = OrderedDict()
+        cache.get_users_from_file(reader, self.csvfile, users)
+        self.assertEqual(reader.nreads, 1)
+        self.assertEqual(snapshot(users), snapshot(self.read(csvparser, self.csvfile)))
+        cache.get_users_from_file(reader, self.csvfile, OrderedDict())
+        self.assertEqual(reader.nreads, 1)
+
+    def test_fields_bypass_cache(self):
+        cache = Cache(Version.FORMAT_2014)
+        reader = CountingReader(csvparser)
+        cache.get_users_from_file(reader, self.csvfile, OrderedDict(), fields=["search"])
+        self.assertFalse(path.isfile(cache.cache_path(self.csvfile)))
+
+    def test_string_reader(self):
+        table = StringTable()
+        strings = [u"a", u"", u"caf\xe9", None, u"a"]
+        indices = [table.index(string) for string in strings]
+        reader = StringReader(*table.arrays())
+        self.assertEqual([reader[idx] for idx in indices], strings)
+        self.assertEqual(len(reader.decoded), 4) # three strings and None
+
+
+if __name__ == "__main__":
+    unittest.main()
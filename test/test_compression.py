@@ -0,0 +1,104 @@
+import bz2
+import csv
+import gzip
+import shutil
+import unittest
+from distutils.spawn import find_executable
+from os import path
+from queryutils import compression, csvparser
+from queryutils.compression import open_input
+from tempfile import mkdtemp
+
+
+def read_rows(filename):
+    with open_input(filename) as datafile:
+        return list(csv.reader(datafile))
+
+
+class CompressionTestCase(object):
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        self.tmpdir = mkdtemp()
+        self.csvfile = path.join(thisdir, "data/format2014.csv")
+        with open(self.csvfile, "rb") as datafile:
+            self.data = datafile.read()
+        self.compressed = [self.compress(gzip.GzipFile, ".gz", self.data),
+            self.compress(bz2.BZ2File, ".bz2", self.data)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def compress(self, compressor, suffix, data, name="format2014.csv"):
+        filename = path.join(self.tmpdir, name + suffix)
+        compressed = compressor(filename, "wb")
+        try:
+            compressed.write(data)
+        finally:
+            compressed.close()
+        return filename
+
+    def test_same_rows(self):
+        expected = read_rows(self.csvfile)
+        self.assertEqual(len(expected), 11)
+        for filename in self.compressed:
+            self.assertEqual(read_rows(filename), expected)
+            with open_input(filename) as datafile:
+                self.assertEqual(datafile.read(), self.data)
+
+    def test_same_users(self):
+        expected = {}
+        csvparser.get_users_from_file(self.csvfile, expected)
+        for filename in self.compressed:
+            users = {}
+            csvparser.get_users_from_file(filename, users)
+            self.assertEqual([(key, [query.text for query in user.queries]) for (key, user) in users.iteritems()],
+                [(key, [query.text for query in user.queries]) for (key, user) in expected.iteritems()])
+
+    def test_close_early(self):
+        (header, rest) = self.data.split("\n", 1)
+        data = header + "\n" + rest * 2000 # larger than a pipe's buffer
+        for (compressor, suffix) in [(gzip.GzipFile, ".gz"), (bz2.BZ2File, ".bz2")]:
+            filename = self.compress(compressor, suffix, data, name="large.csv")
+            with open_input(filename) as datafile:
+                self.assertEqual(datafile.readline(), header + "\n")
+
+    def test_corrupt(self):
+        truncated = path.join(self.tmpdir, "truncated.csv.gz")
+        with open(self.compressed[0], "rb") as datafile:
+            data = datafile.read()
+        with open(truncated, "wb") as datafile:
+            datafile.write(data[:len(data) / 2])
+        garbage = path.join(self.tmpdir, "garbage.csv.gz")
+        with open(garbage, "wb") as datafile:
+            datafile.write(self.data)
+        for filename in [truncated, garbage]:
+            self.assertRaises(IOError, read_rows, filename)
+
+
+@unittest.skipIf(find_executable("gzip") is None or find_executable("bzip2") is None,
+    "gzip and bzip2 are not installed")
+class ProcessCompressionTestCase(CompressionTestCase, unittest.TestCase):
+    """
+    Tests for decompressing input in a separate process with queryutils.compression.open_input
+    """
+    pass
+
+
+class ThreadCompressionTestCase(CompressionTestCase, unittest.TestCase):
+    """
+    Tests for decompressing input in a thread with queryutils.compression.open_input
+    """
+
+    def setUp(self):
+        super(ThreadCompressionTestCase, self).setUp()
+        self.find_executable = compression.find_executable
+        compression.find_executable = lambda command: None
+
+    def tearDown(self):
+        compression.find_executable = self.find_executable
+        super(ThreadCompressionTestCase, self).tearDown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import csv
+import gzip
+import os
+import random
+import unittest
+from os import path
+from queryutils import csvparser
+from queryutils.csvparser import Ingestion
+from queryutils.files import CSVFiles
+from queryutils.versions import Version
+from shutil import rmtree
+from tempfile import mkdtemp
+
+
+ATTRIBUTES = ["text", "time", "is_interactive", "is_realtime", "execution_time", "earliest_event",
+    "latest_event", "range", "search_type", "splunk_search_id", "saved_search_name"]
+
+USERS = [("case_123456", "alspaugh"), ("case_1", "bob"), ("case_1", "alspaugh"), ("case_2", "carol")]
+
+
+def snapshot(users):
+    """Return the users and their queries' attributes in a canonical order.
+    """
+    out = []
+    for user in users:
+        out.append((user.name, user.case_id, [tuple(getattr(query, a) for a in ATTRIBUTES) for query in user.queries]))
+        assert all(query.user is user for query in user.queries)
+    return sorted(out)
+
+
+class CSVParserTestCase(object):
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        self.tmpdir = mkdtemp()
+        with open(path.join(thisdir, "data/format2014.csv")) as datafile:
+            reader = csv.DictReader(datafile)
+            self.header = reader.fieldnames
+            rows = list(reader)
+        self.rows = []
+        for (case, name) in USERS:
+            for row in rows:
+                self.rows.append(dict(row, case_id=case, user=name))
+        self.rows[1]["search"] = "search \"multi\nline, quoted\" | stats count"
+        self.grouped = self.write_csv("grouped.csv", self.rows)
+        shuffled = list(self.rows)
+        random.Random(0).shuffle(shuffled)
+        self.shuffled = self.write_csv("shuffled.csv", shuffled)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def write_csv(self, filename, rows, opener=open):
+        filename = path.join(self.tmpdir, filename)
+        with opener(filename, "wb") as datafile:
+            writer = csv.DictWriter(datafile, self.header)
+            writer.writeheader()
+            writer.writerows(rows)
+        return filename
+
+    def read_all(self, filenames, fields=None):
+        users = {}
+        for filename in filenames:
+            csvparser.get_users_from_file(filename, users, fields=fields)
+        return users.values()
+
+
+class StreamingTestCase(CSVParserTestCase, unittest.TestCase):
+    """
+    Tests for streaming users with queryutils.csvparser.iter_users_from_file and iter_users_partitioned
+    """
+
+    def test_grouped(self):
+        users = list(csvparser.iter_users_from_file(self.grouped))
+        self.assertEqual(len(users), len(USERS))
+        self.assertEqual(snapshot(users), snapshot(self.read_all([self.grouped])))
+
+    def test_grouped_runs(self):
+        runs = {}
+        for user in csvparser.iter_users_from_file(self.shuffled):
+            merged = runs.setdefault((user.name, user.case_id), user)
+            if merged is not user:
+                for query in user.queries:
+                    query.user = merged
+                merged.queries.extend(user.queries)
+        self.assertEqual(snapshot(runs.values()), snapshot(self.read_all([self.shuffled])))
+
+    def test_partitioned(self):
+        partitioned = list(csvparser.iter_users_partitioned([self.shuffled, self.grouped], npartitions=3,
+            tmpdir=self.tmpdir))
+        self.assertEqual(len(partitioned), len(USERS))
+        self.assertEqual(snapshot(partitioned), snapshot(self.read_all([self.shuffled, self.grouped])))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["grouped.csv", "shuffled.csv"])
+
+    def test_csvfiles_ingestion(self):
+        os.mkdir(path.join(self.tmpdir, "partitions"))
+        expected = snapshot(CSVFiles(self.tmpdir, Version.FORMAT_2014).get_users_with_queries())
+        for ingestion in [Ingestion.GROUPED, Ingestion.PARTITIONED]:
+            source = CSVFiles(self.grouped, Version.FORMAT_2014, ingestion=ingestion,
+                tmpdir=path.join(self.tmpdir, "partitions"))
+            self.assertEqual(snapshot(source.get_users_with_queries()), snapshot(self.read_all([self.grouped])))
+        source = CSVFiles(self.tmpdir, Version.FORMAT_2014, ingestion=Ingestion.PARTITIONED,
+            tmpdir=path.join(self.tmpdir, "partitions"))
+        self.assertEqual(snapshot(source.get_users_with_queries()), expected)
+
+
+class ProjectionTestCase(CSVParserTestCase, unittest.TestCase):
+    """
+    Tests for reading only some columns with queryutils.csvparser.scan_rows
+    """
+
+    def assert_projected(self, filename, expected):
+        users = self.read_all([filename], fields=["search", "_time"])
+        projected = snapshot(users)
+        self.assertEqual(len(projected), len(expected))
+        for ((name, case, queries), (expected_name, expected_case, expected_queries)) in zip(projected, expected):
+            self.assertEqual((name, case), (expected_name, expected_case))
+            self.assertEqual([query[:2] for query in queries], [query[:2] for query in expected_queries])
+            self.assertTrue(all(value is None for query in queries for value in query[3:]))
+
+    def test_fields(self):
+        self.assert_projected(self.shuffled, snapshot(self.read_all([self.shuffled])))
+
+    def test_fields_compressed(self):
+        compressed = self.write_csv("shuffled.csv.gz", self.rows, opener=gzip.open)
+        expected = snapshot(self.read_all([self.grouped]))
+        self.assertEqual(snapshot(self.read_all([compressed])), expected)
+        self.assert_projected(compressed, expected)
+
+    def test_rows(self):
+        rows = list(csvparser.read_rows(self.shuffled, fields=["search", "missing"]))
+        self.assertEqual(len(rows), len(self.rows))
+        self.assertTrue(all(sorted(row.keys()) == ["case_id", "search", "user"] for row in rows))
+        self.assertTrue(any("\n" in row["search"] for row in rows))
+
+    def test_empty_file(self):
+        empty = path.join(self.tmpdir, "empty.csv")
+        open(empty, "w").close()
+        self.assertEqual(list(csvparser.read_rows(empty, fields=["search"])), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
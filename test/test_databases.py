@@ -0,0 +1,329 @@
+import os
+import re
+import shutil
+import sqlite3
+import unittest
+from os import path
+from queryutils import sql
+from queryutils.checkpoint import Checkpoint
+from queryutils.databases import COPY_COLUMNS, CopyBuffers, SQLite3DB, copy_value
+from queryutils.files import CSVFiles, JSONFiles
+from queryutils.sql import SECONDARY_INDICES
+from queryutils.versions import Version
+from splparser.parsetree import ParseTreeNode
+from tempfile import mkdtemp
+
+
+ESCAPES = { "\\": "\\", "t": "\t", "n": "\n", "r": "\r" }
+
+
+def decode_copy_line(line):
+    """Decode a line in the Postgres COPY text format as the server would.
+    """
+    values = []
+    for field in line.split("\t"):
+        if field == "\\N":
+            values.append(None)
+        else:
+            values.append(re.sub(r"\\(.)", lambda m: ESCAPES[m.group(1)], field))
+    return values
+
+
+class CopyBuffersTestCase(unittest.TestCase):
+    """
+    Tests for queryutils.databases.CopyBuffers and copy_value
+    """
+
+    def test_copy_value(self):
+        self.assertEqual(copy_value(None), "\\N")
+        self.assertEqual(copy_value(True), "t")
+        self.assertEqual(copy_value(False), "f")
+        self.assertEqual(copy_value(3), "3")
+        self.assertEqual(copy_value(0.1), "0.1")
+        self.assertEqual(copy_value(u"caf\xe9"), "caf\xc3\xa9")
+
+    def test_special_characters_round_trip(self):
+        texts = [
+            "search a\tb",
+            "search a\nb\r\nc",
+            "search a\\b | eval c=\"\\t\"",
+            "search \\N",
+            "\\",
+            u"search caf\xe9 | eval x=\"\t\"",
+        ]
+        buffers = CopyBuffers()
+        for (qid, text) in enumerate(texts):
+            buffers.write("parsetrees", (text, qid))
+        self.assertEqual(buffers.nrows, len(texts))
+        lines = buffers.buffers["parsetrees"].getvalue().split("\n")
+        self.assertEqual(lines[-1], "")
+        decoded = [decode_copy_line(line) for line in lines[:-1]]
+        self.assertEqual(len(decoded), len(texts))
+        for (qid, text) in enumerate(texts):
+            if isinstance(text, unicode):
+                text = text.encode("utf-8")
+            self.assertEqual(decoded[qid], [text, str(qid)])
+
+    def test_rows_have_every_column(self):
+        buffers = CopyBuffers()
+        row = (1, "search a\tb\nc", 1389613653.91, True, None, 0.5, None, None, None,
+            False, "adhoc", "id\\1", None, 2, None)
+        buffers.write("queries", row)
+        lines = buffers.buffers["queries"].getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        values = decode_copy_line(lines[0])
+        self.assertEqual(len(values), len(COPY_COLUMNS["queries"]))
+        self.assertEqual(values[1], "search a\tb\nc")
+        self.assertEqual(values[4], None)
+        self.assertEqual(values[11], "id\\1")
+
+    def test_clear(self):
+        buffers = CopyBuffers()
+        buffers.write("users", (1, "alspaugh", "case_1", None))
+        buffers.clear()
+        self.assertEqual(buffers.nrows, 0)
+        self.assertTrue(all(data.tell() == 0 for data in buffers.buffers.values()))
+
+
+class FailingCSVFiles(CSVFiles):
+
+    def get_users_with_queries(self, fields=None):
+        for user in CSVFiles.get_users_with_queries(self, fields=fields):
+            yield user
+            raise IOError("Source failed")
+
+
+class SQLite3DBLoadTestCase(object):
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        self.datafile = path.join(thisdir, "data/format2014.csv")
+        self.jsonfile = path.join(thisdir, "data/format2012.json")
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def new_database(self, name="test.db"):
+        db = SQLite3DB(path.join(self.tmpdir, name))
+        db.initialize_tables()
+        return db
+
+    def select(self, db, sql):
+        connection = sqlite3.connect(db.path)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def load(self, db, batch_size=3):
+        return db.bulk_load_users_and_queries(CSVFiles(self.datafile, Version.FORMAT_2014), batch_size=batch_size)
+
+    def load_both(self, db):
+        """Load the users of both test data files, with every query interactive and one suspicious.
+        """
+        checkpoint = Checkpoint(db.path + ".json")
+        db.append_users_and_queries(CSVFiles(self.datafile, Version.FORMAT_2014), checkpoint, batch_size=3)
+        db.append_users_and_queries(JSONFiles(self.jsonfile, Version.FORMAT_2012), checkpoint, batch_size=3)
+        db.execute("UPDATE queries SET is_interactive = 1, is_suspicious = 0")
+        db.execute("UPDATE queries SET is_suspicious = 1 WHERE text = 'search index=email'")
+        db.commit()
+        db.close()
+
+
+class FastLoadTestCase(SQLite3DBLoadTestCase, unittest.TestCase):
+    """
+    Tests for restoring the indices and settings after queryutils.databases.SQLite3DB.begin_fast_load
+    """
+
+    def assert_restored(self, db):
+        indices = set(name for (name,) in self.select(db, "SELECT name FROM sqlite_master WHERE type='index'"))
+        self.assertTrue(all(index in indices for (index, _, _) in SECONDARY_INDICES))
+        self.assertEqual(self.select(db, "PRAGMA journal_mode"), [("delete",)])
+        self.assertEqual(db.nconnections, 0)
+        self.assertEqual(db.connection, None)
+
+    def test_bulk_load_restores_indices(self):
+        db = self.new_database()
+        nrows = self.load(db)
+        self.assertEqual(nrows, 11)
+        self.assertEqual(self.select(db, "SELECT COUNT(*) FROM queries"), [(10,)])
+        self.assert_restored(db)
+
+    def test_failed_load_restores_indices(self):
+        db = self.new_database()
+        source = FailingCSVFiles(self.datafile, Version.FORMAT_2014)
+        self.assertRaises(IOError, db.bulk_load_users_and_queries, source)
+        self.assert_restored(db)
+
+    def test_load_parsed_restores_indices(self):
+        db = self.new_database()
+        self.load(db)
+        nrows = db.load_parsed(batch_size=3)
+        self.assertEqual(nrows, 10)
+        self.assertEqual(self.select(db, "SELECT COUNT(*) FROM parsetrees"), [(10,)])
+        self.assert_restored(db)
+
+    def test_failed_index_closes(self):
+        db = self.new_database()
+        indices = sql.SECONDARY_INDICES
+        sql.SECONDARY_INDICES = indices + [("queries_missing", "queries", "missing")]
+        try:
+            self.assertRaises(sqlite3.OperationalError, self.load, db)
+        finally:
+            sql.SECONDARY_INDICES = indices
+        self.assertEqual(db.nconnections, 0)
+        self.assertEqual(db.connection, None)
+        self.assertEqual(self.select(db, "SELECT COUNT(*) FROM queries"), [(10,)])
+
+
+class GetSessionsTestCase(SQLite3DBLoadTestCase, unittest.TestCase):
+    """
+    Tests for reading sessions with queryutils.databases.Database.get_sessions
+    """
+
+    def setUp(self):
+        super(GetSessionsTestCase, self).setUp()
+        self.db = self.new_database()
+        self.load_both(self.db)
+        self.db.sessionize_queries(threshold=60., remove_suspicious=True)
+
+    def expected_sessions(self):
+        sessions = {}
+        for (sid, qid) in self.select(self.db, "SELECT session_id, id FROM queries \
+                WHERE session_id IS NOT NULL ORDER BY session_id, time, id"):
+            sessions.setdefault(sid, []).append(qid)
+        return sorted((sid, qids) for (sid, qids) in sessions.iteritems() if len(qids) > 1)
+
+    def test_get_sessions(self):
+        sessions = list(self.db.get_sessions())
+        expected = self.expected_sessions()
+        self.assertTrue(len(expected) > 2)
+        self.assertEqual([(session.id, [query.id for query in session.queries]) for session in sessions], expected)
+        users = {}
+        for session in sessions:
+            user = session.queries[0].user
+            self.assertTrue(users.setdefault(user.id, user) is user)
+            self.assertTrue(user.sessions[session.id] is session)
+            for query in session.queries:
+                self.assertTrue(query.session is session)
+                self.assertTrue(query.user is user)
+        self.assertEqual(len(users), 2)
+        self.assertEqual(self.db.nconnections, 0)
+
+    def test_get_sessions_parsed(self):
+        self.db.load_parsed()
+        sessions = list(self.db.get_sessions(parsed=True))
+        self.assertEqual([(session.id, [query.id for query in session.queries]) for session in sessions],
+            self.expected_sessions())
+        for session in sessions:
+            self.assertTrue(all(isinstance(query.parsetree, ParseTreeNode) for query in session.queries))
+
+
+@unittest.skipIf(sqlite3.sqlite_version_info < (3, 25, 0), "SQLite is too old for window functions")
+class SessionizeInDatabaseTestCase(SQLite3DBLoadTestCase, unittest.TestCase):
+    """
+    Tests for queryutils.databases.Database.sessionize_queries with in_database against the Python path
+    """
+
+    def sessionize(self, name, threshold, in_database):
+        db = self.new_database(name)
+        self.load_both(db)
+        db.sessionize_queries(threshold=threshold, remove_suspicious=True, in_database=in_database)
+        self.assertEqual(db.nconnections, 0)
+        sessions = self.select(db, "SELECT id, user_id FROM sessions ORDER BY id")
+        queries = self.select(db, "SELECT id, session_id FROM queries ORDER BY id")
+        return (sessions, queries)
+
+    def assert_same_sessions(self, threshold):
+        (sessions, queries) = self.sessionize("python.db", threshold, False)
+        self.assertEqual(self.sessionize("window.db", threshold, True), (sessions, queries))
+        return (sessions, queries)
+
+    def test_short_threshold(self):
+        (sessions, queries) = self.assert_same_sessions(60.)
+        self.assertTrue(len(sessions) > 4)
+        self.assertEqual(len([qid for (qid, sid) in queries if sid is None]), 2) # the suspicious ones
+
+    def test_default_threshold(self):
+        self.assert_same_sessions(30.*60.)
+
+    def test_resessionize(self):
+        db = self.new_database()
+        self.load_both(db)
+        db.sessionize_queries(threshold=60., remove_suspicious=True, in_database=True)
+        db.sessionize_queries(threshold=30.*60., remove_suspicious=True, in_database=True)
+        self.assertEqual(self.select(db, "SELECT id, user_id FROM sessions ORDER BY id"),
+            self.sessionize("python.db", 30.*60., False)[0])
+
+
+class CheckpointTestCase(SQLite3DBLoadTestCase, unittest.TestCase):
+    """
+    Tests for loading only new queries with queryutils.databases.Database.append_users_and_queries
+    """
+
+    NEW_ROW = "case_9,adhoc,true,1.0,newuser,\"search new\",,N/A,N/A,,0.5,2014-01-13T03:47:33.910-0800\n"
+    PARTIAL_ROW = "case_123456,adhoc,false,2.0,alspaugh,\"search multi\nline"
+    REST_OF_ROW = " | stats count\",,N/A,N/A,,0.1,2014-01-13T03:48:33.910-0800\n"
+
+    def setUp(self):
+        super(CheckpointTestCase, self).setUp()
+        self.datadir = path.join(self.tmpdir, "data")
+        os.mkdir(self.datadir)
+        shutil.copy(self.datafile, path.join(self.datadir, "a.csv"))
+        self.checkpoint = path.join(self.tmpdir, "checkpoint.json")
+
+    def append(self, db, parsed=False, processes=None):
+        source = CSVFiles(self.datadir, Version.FORMAT_2014)
+        return db.append_users_and_queries(source, Checkpoint(self.checkpoint), parsed=parsed,
+            processes=processes, chunk_size=2, batch_size=3)
+
+    def write(self, filename, data):
+        with open(path.join(self.datadir, filename), "a") as datafile:
+            datafile.write(data)
+
+    def contents(self, db):
+        return (self.select(db, "SELECT users.name, users.case_id, text, time, execution_time, is_realtime \
+                FROM queries JOIN users ON users.id = queries.user_id ORDER BY 1, 2, 3, 4"),
+            self.select(db, "SELECT text, parsetree FROM parsetrees JOIN queries ON queries.id = parsetrees.query_id \
+                ORDER BY 1, 2"))
+
+    def resume(self, parsed=False, processes=None):
+        db = self.new_database("appended.db")
+        self.assertEqual(self.append(db, parsed=parsed, processes=processes), 21 if parsed else 11)
+        self.assertEqual(self.append(db, parsed=parsed, processes=processes), 0)
+        self.write("a.csv", self.NEW_ROW + self.PARTIAL_ROW)
+        shutil.copy(self.datafile, path.join(self.datadir, "b.csv"))
+        self.assertEqual(self.append(db, parsed=parsed, processes=processes), 23 if parsed else 12)
+        self.write("a.csv", self.REST_OF_ROW)
+        self.assertEqual(self.append(db, parsed=parsed, processes=processes), 2 if parsed else 1)
+        self.assertEqual(db.nconnections, 0)
+        return db
+
+    def loaded_at_once(self, parsed=False):
+        db = self.new_database("full.db")
+        db.bulk_load_users_and_queries(CSVFiles(self.datadir, Version.FORMAT_2014))
+        if parsed:
+            db.load_parsed()
+        return db
+
+    def test_resume(self):
+        db = self.resume()
+        self.assertEqual(self.contents(db), self.contents(self.loaded_at_once()))
+        self.assertEqual(self.select(db, "SELECT COUNT(*) FROM users"), [(2,)])
+
+    def test_resume_parsed(self):
+        db = self.resume(parsed=True, processes=2)
+        self.assertEqual(self.contents(db), self.contents(self.loaded_at_once(parsed=True)))
+
+    def test_unsaved_checkpoint(self):
+        db = self.new_database()
+        source = CSVFiles(self.datadir, Version.FORMAT_2014)
+        checkpoint = Checkpoint(self.checkpoint)
+        list(source.get_new_users_with_queries(checkpoint))
+        self.assertFalse(path.isfile(self.checkpoint))
+        self.assertEqual(self.append(db), 11)
+
+
+if __name__ == "__main__":
+    unittest.main()
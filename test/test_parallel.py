@@ -0,0 +1,135 @@
+import os
+import unittest
+from os import path
+from queryutils import csvparser, jsonparser
+from queryutils.files import CSVFiles, JSONFiles
+from queryutils.parallel import parse_queries
+from queryutils.parse import configure_parse_cache
+from queryutils.versions import Version
+from shutil import rmtree
+from tempfile import mkdtemp
+
+
+ATTRIBUTES = ["text", "time", "is_interactive", "is_realtime", "execution_time", "search_type",
+    "splunk_search_id", "saved_search_name"]
+
+
+def snapshot(users):
+    """Return the users, in order, with their queries' attributes in order.
+    """
+    out = []
+    for (key, user) in users.iteritems():
+        out.append((key, user.name, user.case_id, [tuple(getattr(query, a) for a in ATTRIBUTES) for query in user.queries]))
+        assert all(query.user is user for query in user.queries)
+    return out
+
+
+class ParallelReadTestCase(unittest.TestCase):
+    """
+    Tests for reading directories of files in parallel with queryutils.parallel.get_users_from_files
+    """
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        self.tmpdir = mkdtemp()
+        self.csvdir = path.join(self.tmpdir, "csv")
+        self.jsondir = path.join(self.tmpdir, "json")
+        self.copy_with_users(path.join(thisdir, "data/format2014.csv"), self.csvdir, ".csv")
+        self.copy_with_users(path.join(thisdir, "data/format2012.json"), self.jsondir, ".json")
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def copy_with_users(self, filename, directory, suffix):
+        """Copy the file into the directory several times, some with the user renamed.
+        """
+        with open(filename) as datafile:
+            data = datafile.read()
+        os.mkdir(directory)
+        for (idx, name) in enumerate(["alspaugh", "bob", "alspaugh", "carol", "bob"]):
+            with open(path.join(directory, "%d%s" % (idx, suffix)), "w") as copy:
+                copy.write(data.replace("alspaugh", name))
+
+    def assert_same_users(self, module, directory, fields=None):
+        serial = {}
+        module.get_users_from_directory(directory, serial, fields=fields)
+        for processes in [2, 3]:
+            parallel = {}
+            module.get_users_from_directory(directory, parallel, processes=processes, fields=fields)
+            self.assertEqual(snapshot(parallel), snapshot(serial))
+        return serial
+
+    def test_csv_directory(self):
+        users = self.assert_same_users(csvparser, self.csvdir)
+        self.assertEqual(len(users), 3)
+        self.assertEqual(sorted(len(user.queries) for user in users.values()), [10, 20, 20])
+
+    def test_csv_directory_fields(self):
+        self.assert_same_users(csvparser, self.csvdir, fields=["search", "_time"])
+
+    def test_json_directory(self):
+        users = self.assert_same_users(jsonparser, self.jsondir)
+        self.assertEqual(len(users), 3)
+
+    def test_files(self):
+        for (source, directory, version) in [(CSVFiles, self.csvdir, Version.FORMAT_2014),
+                (JSONFiles, self.jsondir, Version.FORMAT_2012)]:
+            serial = [(user.name, len(user.queries)) for user in source(directory, version).get_users_with_queries()]
+            parallel = [(user.name, len(user.queries))
+                for user in source(directory, version, processes=2).get_users_with_queries()]
+            self.assertEqual(parallel, serial)
+
+
+class ParseQueriesTestCase(unittest.TestCase):
+    """
+    Tests for parsing queries in a pool with queryutils.parallel.parse_queries
+    """
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        self.datafile = path.join(thisdir, "data/format2014.csv")
+        users = {}
+        csvparser.get_users_from_file(self.datafile, users)
+        texts = [query.text for user in users.itervalues() for query in user.queries]
+        texts = texts[:5] + ["search a | stats count by b | ", ""] + texts[5:] + texts[:3]
+        self.queries = [(100 - idx, text) for (idx, text) in enumerate(texts)]
+        configure_parse_cache(max_size=0)
+        self.expected = list(parse_queries(self.queries))
+
+    def tearDown(self):
+        configure_parse_cache()
+
+    def test_serial_results(self):
+        self.assertEqual([qid for (qid, _, _) in self.expected], [qid for (qid, _) in self.queries])
+        failed = [qid for (qid, dumped, error) in self.expected if dumped is None]
+        self.assertEqual(failed, [95, 94])
+        self.assertTrue(all(error is not None for (qid, dumped, error) in self.expected if dumped is None))
+        self.assertTrue(all(error is None for (qid, dumped, error) in self.expected if dumped is not None))
+
+    def test_in_order(self):
+        for (processes, chunk_size) in [(2, 1), (3, 3), (2, 100)]:
+            results = list(parse_queries(self.queries, processes=processes, chunk_size=chunk_size))
+            self.assertEqual([result[:2] for result in results], [result[:2] for result in self.expected])
+
+    def test_in_order_with_cache(self):
+        cache = configure_parse_cache()
+        results = list(parse_queries(self.queries, processes=2, chunk_size=4))
+        self.assertEqual([result[:2] for result in results], [result[:2] for result in self.expected])
+        nmisses = cache.nmisses
+        nhits = cache.nhits
+        self.assertEqual(nhits + nmisses, len(self.queries))
+        results = list(parse_queries(self.queries, processes=2, chunk_size=4))
+        self.assertEqual([result[:2] for result in results], [result[:2] for result in self.expected])
+        self.assertEqual((cache.nhits, cache.nmisses), (nhits + len(self.queries), nmisses))
+
+    def test_files(self):
+        serial = [(parsetree.query_id, parsetree.dumps()) for parsetree in CSVFiles(self.datafile,
+            Version.FORMAT_2014).get_parsetrees()]
+        parallel = [(parsetree.query_id, parsetree.dumps()) for parsetree in CSVFiles(self.datafile,
+            Version.FORMAT_2014, processes=2).get_parsetrees(chunk_size=3)]
+        self.assertEqual(len(serial), 10)
+        self.assertEqual(parallel, serial)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import random
+import unittest
+from os import path
+from queryutils import csvparser, jsonparser
+from queryutils.parse import TokenizedQuery, find_stage_offsets, split_query_into_raw_stages, \
+    split_query_into_stages, tokenize_query
+
+
+QUERIES = [
+    "",
+    "   ",
+    "search foo",
+    "search foo | stats count by bar",
+    "search  foo   |  eval bar = baz , qux=quux  ",
+    "|metadata type=sourcetypes|sort - totalCount",
+    "search foo=\"a|b\" | eval x='[c|d]' | `macro(1|2)`",
+    "search a [search b | head 1] | stats count",
+    "search a [search b [search c | head 1] | head 2] trailing | stats count",
+    "search a [search b | head 1",
+    "search a ] | stats count",
+    "search a \"unterminated | stats count",
+    "search a \\| b | eval c=\"d\\\"|e\" | head",
+    "search a\\\\| b",
+    "search a \\[ b | head",
+    "search a\"b\"c | head",
+    "| | search a ||",
+    "search caf\xc3\xa9 | eval na\xc3\xafve=1",
+]
+
+ALPHABET = "ab |[]\"'`\\="
+
+
+class StageSplittingTestCase(unittest.TestCase):
+    """
+    Tests for queryutils.parse.find_stage_offsets against split_query_into_stages
+    """
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        users = {}
+        csvparser.get_users_from_file(path.join(thisdir, "data/format2014.csv"), users)
+        jsonparser.get_users_from_file(path.join(thisdir, "data/format2012.json"), users)
+        self.queries = list(QUERIES)
+        self.queries.extend(query.text for user in users.itervalues() for query in user.queries)
+        rand = random.Random(0)
+        for i in range(2000):
+            length = rand.randint(0, 20)
+            self.queries.append("".join(rand.choice(ALPHABET) for j in range(length)))
+
+    def assert_same_stages(self, query):
+        offsets = find_stage_offsets(query)
+        text = TokenizedQuery(query).text
+        stages = [" ".join(token.value for token in tokenize_query(text[start:end])) for (start, end) in offsets]
+        self.assertEqual(stages, split_query_into_stages(query), repr(query))
+        self.assertEqual(offsets, TokenizedQuery(query).stage_offsets, repr(query))
+
+    def test_same_stages_as_lexer(self):
+        for query in self.queries:
+            self.assert_same_stages(query)
+
+    def test_raw_stages_keep_spacing(self):
+        stages = split_query_into_raw_stages("search  foo   |  eval bar = baz , qux=quux  ")
+        self.assertEqual(stages, ["search  foo", "|  eval bar = baz , qux=quux"])
+
+    def test_raw_stages_of_subsearch(self):
+        stages = split_query_into_raw_stages("search a [search b | head 1] | stats count")
+        self.assertEqual(stages, ["search a [search b | head 1]", "| stats count"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+import shutil
+import sqlite3
+import unittest
+from os import path
+from queryutils import csvparser, parse, parsecache
+from queryutils.parse import configure_parse_cache, parse_query, tokenize_query
+from queryutils.parsecache import PARSETREE, TOKENS, ParseCache
+from tempfile import mkdtemp
+
+
+BAD_QUERY = "search a | stats count by b | "
+
+
+class CountingAtexit(object):
+    """Records the functions registered to run at exit instead of registering them.
+    """
+
+    def __init__(self):
+        self.registered = []
+
+    def register(self, function):
+        self.registered.append(function)
+
+
+class ParseCacheTestCase(unittest.TestCase):
+    """
+    Tests for queryutils.parsecache.ParseCache
+    """
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.path = path.join(self.tmpdir, "parses.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assert_stats(self, cache, hits, disk_hits, misses):
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["disk_hits"], stats["misses"]), (hits, disk_hits, misses))
+
+    def test_hits_and_misses(self):
+        cache = ParseCache(max_size=10)
+        self.assertEqual(cache.lookup(PARSETREE, "search a"), (False, None))
+        cache.store(PARSETREE, "search a", "tree")
+        cache.store(PARSETREE, "search b", None)
+        self.assertEqual(cache.lookup(PARSETREE, "search a"), (True, "tree"))
+        self.assertEqual(cache.lookup(PARSETREE, "search b"), (True, None))
+        self.assertEqual(cache.lookup(TOKENS, "search a"), (False, None))
+        self.assertEqual(cache.lookup(PARSETREE, "search a "), (False, None))
+        self.assert_stats(cache, 2, 0, 3)
+        cache.clear()
+        self.assert_stats(cache, 0, 0, 0)
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_least_recently_used_evicted(self):
+        cache = ParseCache(max_size=2)
+        cache.store(PARSETREE, "a", "1")
+        cache.store(PARSETREE, "b", "2")
+        cache.lookup(PARSETREE, "a")
+        cache.store(PARSETREE, "c", "3")
+        self.assertEqual(cache.lookup(PARSETREE, "b"), (False, None))
+        self.assertEqual(cache.lookup(PARSETREE, "a"), (True, "1"))
+        self.assertEqual(cache.lookup(PARSETREE, "c"), (True, "3"))
+        self.assertEqual(cache.stats()["size"], 2)
+
+    def test_disabled(self):
+        cache = ParseCache(max_size=0)
+        self.assertFalse(cache.enabled)
+        cache.store(PARSETREE, "a", "1")
+        self.assertEqual(cache.lookup(PARSETREE, "a"), (False, None))
+        self.assertTrue(ParseCache(max_size=0, path=self.path).enabled)
+
+    def test_disk(self):
+        cache = ParseCache(max_size=0, path=self.path, commit_size=3)
+        for i in range(5):
+            cache.store(PARSETREE, "search %d" % i, str(i))
+        self.assertEqual(self.count_rows(), 3)
+        self.assertEqual(cache.lookup(PARSETREE, "search 4"), (True, "4")) # not yet written
+        cache.close()
+        self.assertEqual(self.count_rows(), 5)
+        reopened = ParseCache(max_size=10, path=self.path)
+        self.assertEqual(reopened.lookup(PARSETREE, "search 1"), (True, "1"))
+        self.assertEqual(reopened.lookup(PARSETREE, "search 1"), (True, "1"))
+        self.assertEqual(reopened.lookup(PARSETREE, "search 9"), (False, None))
+        self.assert_stats(reopened, 1, 1, 1)
+        reopened.close()
+
+    def test_closes_at_exit_once(self):
+        counting = CountingAtexit()
+        original = parsecache.atexit
+        parsecache.atexit = counting
+        try:
+            cache = ParseCache(max_size=0, path=self.path, commit_size=1)
+            for i in range(3):
+                cache.store(PARSETREE, "search %d" % i, str(i))
+                cache.close()
+        finally:
+            parsecache.atexit = original
+        self.assertEqual(counting.registered, [cache.close])
+        self.assertEqual(self.count_rows(), 3)
+
+    def count_rows(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute("SELECT COUNT(*) FROM parses").fetchone()[0]
+        finally:
+            connection.close()
+
+
+class ParseQueryCacheTestCase(unittest.TestCase):
+    """
+    Tests for caching the results of queryutils.parse.parse_query and tokenize_query
+    """
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        users = {}
+        csvparser.get_users_from_file(path.join(thisdir, "data/format2014.csv"), users)
+        self.texts = [query.text for user in users.itervalues() for query in user.queries]
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        configure_parse_cache()
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_query(self):
+        configure_parse_cache(max_size=0)
+        expected = [parse_query(text) for text in self.texts]
+        cache = configure_parse_cache()
+        first = [parse_query(text) for text in self.texts]
+        second = [parse_query(text) for text in self.texts]
+        ntexts = len(set(self.texts))
+        self.assertEqual((cache.nhits, cache.nmisses), (len(self.texts) * 2 - ntexts, ntexts))
+        for (parsetree, cached) in zip(expected, second):
+            self.assertEqual(cached.dumps(), parsetree.dumps())
+        self.assertTrue(all(a is not b for (a, b) in zip(first, second)))
+        second[0].children = []
+        self.assertEqual(parse_query(self.texts[0]).dumps(), expected[0].dumps())
+
+    def test_failures_cached(self):
+        cache = configure_parse_cache()
+        self.assertEqual(parse_query(BAD_QUERY), None)
+        self.assertEqual(parse_query(BAD_QUERY), None)
+        self.assertEqual((cache.nhits, cache.nmisses), (1, 1))
+
+    def test_tokenize_query(self):
+        configure_parse_cache(max_size=0)
+        expected = [[(token.type, token.value) for token in tokenize_query(text)] for text in self.texts]
+        cache = configure_parse_cache()
+        for i in range(2):
+            tokens = [[(token.type, token.value) for token in tokenize_query(text)] for text in self.texts]
+            self.assertEqual(tokens, expected)
+        self.assertEqual(cache.nmisses, len(set(self.texts)))
+
+    def test_disk_across_runs(self):
+        cachefile = path.join(self.tmpdir, "parses.db")
+        configure_parse_cache(max_size=0, path=cachefile)
+        expected = [parse_query(text).dumps() for text in self.texts]
+        cache = configure_parse_cache(path=cachefile)
+        self.assertEqual([parse_query(text).dumps() for text in self.texts], expected)
+        self.assertEqual(cache.nmisses, 0)
+        self.assertEqual(cache.ndisk_hits, len(set(self.texts)))
+
+    def test_disabled(self):
+        cache = configure_parse_cache(max_size=0)
+        for i in range(2):
+            parsetrees = [parse_query(text) for text in self.texts]
+        self.assertTrue(all(parsetree is not None for parsetree in parsetrees))
+        self.assertEqual(cache.stats(), {"hits": 0, "disk_hits": 0, "misses": 0, "size": 0})
+        self.assertTrue(parse.parse_cache is cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
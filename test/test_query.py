@@ -0,0 +1,90 @@
+import random
+import unittest
+from os import path
+from queryutils import csvparser, jsonparser
+from queryutils.query import MAX_INTERVAL, ENTROPY_NBUCKETS, SECONDS, Query, QueryGroup, \
+    interarrival_arrays, interarrival_metrics
+
+
+def query_group(times, user_id=1, other_times=[]):
+    copies = []
+    for time in times:
+        query = Query("search foo", time)
+        query.user_id = user_id
+        copies.append(query)
+    for time in other_times:
+        query = Query("search foo", time)
+        query.user_id = user_id + 1
+        copies.append(query)
+    group = QueryGroup(copies[0])
+    group.copies = copies
+    return group
+
+
+class InterarrivalMetricsTestCase(unittest.TestCase):
+    """
+    Tests for queryutils.query.interarrival_metrics against the QueryGroup methods
+    """
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        users = {}
+        csvparser.get_users_from_file(path.join(thisdir, "data/format2014.csv"), users)
+        jsonparser.get_users_from_file(path.join(thisdir, "data/format2012.json"), users)
+        self.times = [[query.time for query in user.queries] for user in users.itervalues()]
+        bucket = MAX_INTERVAL / ENTROPY_NBUCKETS
+        rand = random.Random(0)
+        self.groups = [
+            [100.],
+            [100., 200.],
+            [100., 100., 100.],
+            [0., SECONDS, 2*SECONDS, 3*SECONDS, 5*SECONDS],
+            [0., bucket, 2*bucket, 3*bucket + 1e-3],
+            [0., MAX_INTERVAL, 2*MAX_INTERVAL + 1.],
+            [0., 2*MAX_INTERVAL, 4*MAX_INTERVAL],
+        ]
+        self.groups.extend(self.times)
+        for i in range(50):
+            start = rand.uniform(0., 1e9)
+            self.groups.append([start + rand.expovariate(1. / rand.choice([1., 60., 3600., 1e5]))
+                for j in range(rand.randint(1, 30))])
+
+    def expected(self, group):
+        return (group.interarrival_entropy(), group.interarrival_consistency(), group.interarrival_clockness())
+
+    def assert_close(self, actual, expected):
+        if expected != expected:
+            self.assertTrue(actual != actual, "%r is not nan" % actual)
+        else:
+            self.assertAlmostEqual(actual, expected, places=9)
+
+    def test_same_metrics_as_query_groups(self):
+        groups = [query_group(times) for times in self.groups]
+        intervals, offsets = interarrival_arrays(groups)
+        entropy, consistency, clockness = interarrival_metrics(intervals, offsets)
+        for (idx, times) in enumerate(self.groups):
+            expected = self.expected(query_group(times))
+            for (actual, value) in zip((entropy[idx], consistency[idx], clockness[idx]), expected):
+                self.assert_close(actual, value)
+
+    def test_only_this_users_copies(self):
+        groups = [query_group(times[:1], other_times=times[1:]) for times in self.times]
+        intervals, offsets = interarrival_arrays(groups)
+        self.assertEqual(len(intervals), 0)
+        entropy, consistency, clockness = interarrival_metrics(intervals, offsets)
+        self.assertEqual(list(clockness), [-1.] * len(groups))
+
+    def test_intervals_stored_on_groups(self):
+        groups = [query_group(times) for times in self.times]
+        intervals, offsets = interarrival_arrays(groups)
+        for (idx, group) in enumerate(groups):
+            self.assertEqual(list(intervals[offsets[idx]:offsets[idx+1]]), query_group(self.times[idx]).interarrival_intervals())
+
+    def test_no_groups(self):
+        intervals, offsets = interarrival_arrays([])
+        entropy, consistency, clockness = interarrival_metrics(intervals, offsets)
+        self.assertEqual((len(entropy), len(consistency), len(clockness)), (0, 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
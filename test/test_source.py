@@ -0,0 +1,88 @@
+import shutil
+import unittest
+from os import listdir, path
+from queryutils.files import CSVFiles, JSONFiles
+from queryutils.query import Query
+from queryutils.source import DataSource, QueryGroupKey, QUERY_GROUP_KEYS
+from queryutils.versions import Version
+from tempfile import mkdtemp
+
+
+def snapshot(copies):
+    """Return the attributes of each of the given queries, in order, without their users and sessions.
+    """
+    out = []
+    for query in copies:
+        attributes = query.attributes()
+        del attributes["user"]
+        del attributes["session"]
+        out.append(sorted(attributes.items()))
+    return out
+
+
+class ListSource(DataSource):
+    """A source whose interactive queries are the given list.
+    """
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def get_interactive_queries(self, parsed=False):
+        return iter(self.queries)
+
+
+class QueryGroupsTestCase(unittest.TestCase):
+    """
+    Tests for grouping queries in memory and on disk with queryutils.source.DataSource.get_query_groups
+    """
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        queries = list(CSVFiles(path.join(thisdir, "data/format2014.csv"), Version.FORMAT_2014).get_interactive_queries())
+        queries += list(JSONFiles(path.join(thisdir, "data/format2012.json"), Version.FORMAT_2012).get_interactive_queries())
+        queries += [Query(u"search caf\xe9", 1389613653.5), Query("", None)]
+        self.queries = []
+        for (idx, query) in enumerate(queries * 3): # every text has copies
+            copy = Query(query.text, query.time)
+            copy.update(query.attributes())
+            copy.id = idx
+            if idx % 4 == 0:
+                copy.time = float(idx)
+            self.queries.append(copy)
+        self.source = ListSource(self.queries)
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_on_disk_same_as_in_memory(self):
+        for key in [QueryGroupKey.TEXT, QueryGroupKey.HASH]:
+            keyfn = QUERY_GROUP_KEYS[key]
+            expected = sorted(snapshot(copies) for copies in self.source._group_queries(self.queries, keyfn))
+            self.assertTrue(len(expected) > 3)
+            self.assertTrue(all(len(copies) >= 3 for copies in expected))
+            for npartitions in [1, 3, 16]:
+                groups = list(self.source._group_queries_on_disk(self.queries, keyfn, self.tmpdir, npartitions))
+                self.assertEqual(sorted(snapshot(copies) for copies in groups), expected)
+                self.assertTrue(all(query.user is None and query.session is None for copies in groups for query in copies))
+            self.assertEqual(listdir(self.tmpdir), [])
+
+    def test_hash_same_as_text(self):
+        groups = {}
+        for key in [QueryGroupKey.TEXT, QueryGroupKey.HASH]:
+            groups[key] = sorted([query.id for query in copies]
+                for copies in self.source._group_queries(self.queries, QUERY_GROUP_KEYS[key]))
+        self.assertEqual(groups[QueryGroupKey.HASH], groups[QueryGroupKey.TEXT])
+
+    def test_get_query_groups(self):
+        for key in [QueryGroupKey.TEXT, QueryGroupKey.HASH]:
+            expected = sorted((group.id, [query.id for query in group.copies])
+                for group in self.source.get_query_groups(key=key))
+            self.assertEqual(len(expected), len(self.queries))
+            spilled = sorted((group.id, [query.id for query in group.copies])
+                for group in self.source.get_query_groups(key=key, spill_dir=self.tmpdir, npartitions=4))
+            self.assertEqual(spilled, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
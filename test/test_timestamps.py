@@ -0,0 +1,83 @@
+import csv
+import random
+import unittest
+from os import path
+from queryutils.jsonparser import splunk_result_iter
+from queryutils.timestamps import TimestampDecoder, decode_with_dateutil
+
+
+OFFSETS = ["", "Z", "-0800", "+0000", "+0530", "-03:30", "+14:00"]
+
+
+class TimestampDecoderTestCase(unittest.TestCase):
+    """
+    Tests for queryutils.timestamps.TimestampDecoder against dateutil
+    """
+
+    def setUp(self):
+        thisdir = path.dirname(path.realpath(__file__))
+        with open(path.join(thisdir, "data/format2014.csv")) as datafile:
+            self.csv_timestamps = [row["_time"] for row in csv.DictReader(datafile)]
+        self.json_timestamps = [result["_time"] for result in splunk_result_iter([path.join(thisdir, "data/format2012.json")])
+            if "_time" in result]
+        rand = random.Random(0)
+        self.timestamps = []
+        for i in range(2000):
+            timestamp = "%04d-%02d-%02d%s%02d:%02d:%02d" % (rand.randint(1970, 2037), rand.randint(1, 12),
+                rand.randint(1, 28), rand.choice("T "), rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59))
+            fraction = rand.randint(0, 6)
+            if fraction > 0:
+                timestamp += "." + "".join(rand.choice("0123456789") for j in range(fraction))
+            self.timestamps.append(timestamp + rand.choice(OFFSETS))
+
+    def assert_same_as_dateutil(self, timestamps):
+        decoder = TimestampDecoder()
+        for timestamp in timestamps:
+            self.assertEqual(decoder.decode(timestamp), decode_with_dateutil(timestamp), timestamp)
+        return decoder
+
+    def test_test_data(self):
+        self.assertEqual(len(self.csv_timestamps), 10)
+        self.assertTrue(len(self.json_timestamps) > 0)
+        for timestamps in [self.csv_timestamps, self.json_timestamps]:
+            decoder = self.assert_same_as_dateutil(timestamps)
+            self.assertEqual(decoder.nfallbacks, 0)
+
+    def test_generated(self):
+        decoder = self.assert_same_as_dateutil(self.timestamps)
+        self.assertEqual(decoder.nfallbacks, 0)
+
+    def test_same_hour(self):
+        timestamps = ["2014-01-13T03:%02d:%02d.%03d-0800" % (m, s, s * 7) for m in range(60) for s in range(0, 60, 7)]
+        decoder = self.assert_same_as_dateutil(timestamps)
+        self.assertEqual(len(decoder.prefixes), 1)
+
+    def test_leap_day(self):
+        self.assert_same_as_dateutil(["2012-02-29T23:59:59.999999+0100", "2000-02-29 00:00:00Z"])
+
+    def test_fallback(self):
+        decoder = self.assert_same_as_dateutil(["2014-01-13T03:47:33.910-0800", "Jan 13 2014 03:47:33",
+            "2014-01-13", "2014-01-13T03:47:33.910-0800"])
+        self.assertEqual(decoder.nfallbacks, 2)
+
+    def test_out_of_range(self):
+        invalid = ["2014-02-30T03:47:33.910-0800", "2014-02-29T00:00:00Z", "2014-01-00T03:47:33",
+            "2014-13-13T03:47:33", "2014-00-13T03:47:33", "2014-01-13T25:00:00.000-0800", "2014-01-13T24:00:00",
+            "2014-01-13T03:60:00", "2014-01-13T03:47:60.5", "2014-01-13T03:47:33+2500", "0000-01-13T03:47:33"]
+        decoder = TimestampDecoder()
+        decoder.decode("2014-01-13T03:47:33.910-0800")
+        for timestamp in invalid:
+            self.assertRaises(ValueError, decode_with_dateutil, timestamp)
+            self.assertRaises(ValueError, decoder.decode, timestamp)
+        self.assertEqual(decoder.nfallbacks, len(invalid))
+        self.assertEqual(len(decoder.prefixes), 1)
+        self.assert_same_as_dateutil(["2012-02-29T23:59:59Z", "2014-01-31T23:59:59+23:59", "2014-01-13T03:47:33+0575"])
+
+    def test_unknown_format(self):
+        decoder = self.assert_same_as_dateutil(["Mon Jan 13 03:47:33 2014"])
+        self.assertEqual(decoder.format, None)
+        self.assert_same_as_dateutil(["Mon Jan 13 03:47:33 2014", "2014-01-13T03:47:33.910-0800"])
+
+
+if __name__ == "__main__":
+    unittest.main()